@@ -1,28 +1,49 @@
 from __future__ import annotations
 
-import itertools
+import bisect
+import hashlib
 import json
-from functools import cache
-from typing import TYPE_CHECKING, Any
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import cached_property, partial
+from glob import glob
+from typing import TYPE_CHECKING, Any, NamedTuple
 
 import numpy as np
 import torch
+from pymatgen.core import Structure
 from torch import LongTensor, Tensor
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
-from aviary import PKG_DIR
+from aviary.data import (
+    FeatureCache,
+    ParquetShardDataset,
+    SlimPickleMixin,
+    batch_edge_offsets,
+    batch_ptr,
+    csr_gather,
+    element_feature_table,
+    get_identifier_rows,
+    get_target_columns,
+    load_element_embedding,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Sequence
+    from concurrent.futures import Executor
 
     import pandas as pd
-    from pymatgen.core import Structure
 
 
-class CrystalGraphData(Dataset):
+class CrystalGraphData(SlimPickleMixin, Dataset):
     """Dataset class for the CGCNN structure model."""
 
+    # JSON element embedding is only needed to build elem_fea_table
+    _pickle_exclude = ("elem_features",)
+
     def __init__(
         self,
         df: pd.DataFrame,
@@ -34,6 +55,10 @@ class CrystalGraphData(Dataset):
         max_num_nbr: int = 12,
         dmin: float = 0,
         step: float = 0.2,
+        cache_dir: str | None = None,
+        n_jobs: int = 1,
+        executor: Executor | None = None,
+        feature_cache: FeatureCache | None = None,
     ):
         """Featurize crystal structures into neighborhood graphs with this data class
         for CGCNN.
@@ -53,18 +78,28 @@ class CrystalGraphData(Dataset):
                 Defaults to 12.
             dmin (float, optional): minimum distance in Gaussian basis. Defaults to 0.
             step (float, optional): increment size of Gaussian basis. Defaults to 0.2.
+            cache_dir (str, optional): Directory in which to persist featurized crystal
+                graphs. Graphs are keyed by structure hash, radius and max_num_nbr and
+                memory-mapped on later runs so they are never recomputed. Defaults to
+                None meaning graphs are only kept in memory.
+            n_jobs (int, optional): Number of worker processes to featurize structures
+                with. -1 means use all CPUs. Defaults to 1.
+            executor (Executor, optional): Existing executor (e.g. a shared
+                ProcessPoolExecutor) to featurize structures with. Defaults to None.
+            feature_cache (FeatureCache, optional): Store for featurized samples.
+                Pass a FeatureCache with a memory budget to bound memory or a
+                SharedMemoryFeatureCache to share samples across DataLoader workers.
+                Defaults to None meaning an unbounded FeatureCache.
         """
         self.task_dict = task_dict
         self.identifiers = list(identifiers)
+        self.feature_cache = FeatureCache() if feature_cache is None else feature_cache
 
         self.radius = radius
         self.max_num_nbr = max_num_nbr
 
-        if elem_embedding in ("matscholar200", "cgcnn92", "megnet16", "onehot112"):
-            elem_embedding = f"{PKG_DIR}/embeddings/element/{elem_embedding}.json"
-
-        with open(elem_embedding) as file:
-            self.elem_features = json.load(file)
+        self.elem_embedding = elem_embedding
+        self.elem_features = load_element_embedding(elem_embedding)
 
         for key, value in self.elem_features.items():
             self.elem_features[key] = np.array(value, dtype=float)
@@ -76,37 +111,47 @@ class CrystalGraphData(Dataset):
                     f"{len(value)}, expected {self.elem_emb_len}"
                 )
 
+        # lookup table from atomic number to element features
+        self.elem_fea_table = element_feature_table(self.elem_features, np.float64)
+
         self.gaussian_dist_func = GaussianDistance(dmin=dmin, dmax=radius, step=step)
         self.nbr_fea_dim = self.gaussian_dist_func.embedding_size
 
         self.df = df
         self.structure_col = structure_col
 
-        all_isolated, some_isolated = {}, {}
+        # featurize every structure exactly once, __getitem__ only reads from the cache
+        self.graph_cache = CrystalGraphCache(radius, max_num_nbr, cache_dir=cache_dir)
+        graph_rows = self.graph_cache.add(
+            self.df[structure_col], n_jobs=n_jobs, executor=executor
+        )
 
-        desc = "Pre-check that all structures are valid, i.e. none have isolated atoms."
-        for idx, struct in tqdm(
-            self.df[structure_col].items(), total=len(df), desc=desc, disable=None
+        all_isolated, some_isolated = {}, {}
+        n_sites, n_edges, n_connected = self.graph_cache.connectivity(graph_rows)
+        for idx, n_edge, n_conn, n_site in zip(
+            self.df.index, n_edges, n_connected, n_sites
         ):
-            self_idx, nbr_idx, _ = get_structure_neighbor_info(
-                struct, radius, max_num_nbr
-            )
-            material_ids = [idx, *self.df.loc[idx][self.identifiers]]
-            if 0 in (len(self_idx), len(nbr_idx)):
-                all_isolated[idx] = material_ids
-            elif set(self_idx) != set(range(len(struct))):
-                some_isolated[idx] = material_ids
+            if n_edge == 0:
+                all_isolated[idx] = [idx, *self.df.loc[idx][self.identifiers]]
+            elif n_conn != n_site:
+                some_isolated[idx] = [idx, *self.df.loc[idx][self.identifiers]]
 
         isolated = set(all_isolated) | set(some_isolated)
         if len(isolated) > 0:
             # drop the data points that do not give rise to dense crystal graphs
-            self.df = self.df.drop(index=isolated)
+            keep = ~self.df.index.isin(isolated)
+            self.df = self.df[keep]
+            graph_rows = graph_rows[keep]
 
             print(f"dropping {len(isolated):,} structures:")
             for type, ids in (("only", all_isolated), ("some", some_isolated)):
                 joined_ids = "\n\t".join(map(str, ids.values()))
                 print(f"  {len(ids)} have {type} isolated atoms:\n\t{joined_ids}")
 
+        self.graph_rows = graph_rows
+        self.ids = get_identifier_rows(self.df, self.identifiers)
+        self.targets = get_target_columns(self.df, self.task_dict)
+
         self.n_targets = []
         for target, task_type in self.task_dict.items():
             if task_type == "regression":
@@ -124,68 +169,162 @@ class CrystalGraphData(Dataset):
         df_repr = f"cols=[{', '.join(self.df)}], len={len(self.df)}"
         return f"{type(self).__name__}({df_repr}, task_dict={self.task_dict})"
 
-    # Cache loaded structures
-    @cache  # noqa: B019
     def __getitem__(self, idx: int):
-        """Get an entry out of the Dataset.
+        """Get an entry out of the Dataset, featurizing it on first access.
 
         Args:
             idx (int): index of entry in Dataset
 
         Returns:
             tuple containing:
-            - tuple[Tensor, Tensor, LongTensor, LongTensor]: CGCNN model inputs
+            - tuple[LongTensor, Tensor, Tensor, LongTensor, LongTensor]: CGCNN model
+              inputs (atomic numbers and occupancies of the species on each site,
+              both of shape (n_sites, max species per site) and zero-padded,
+              Gaussian expanded neighbor distances, self and neighbor indices)
             - list[Tensor | LongTensor]: regression or classification targets
             - list[str | int]: identifiers like material_id, composition
         """
-        # NOTE sites must be given in fractional coordinates
-        # TODO try if converting to np array speeds this up due to np's faster indexing
-        row = self.df.iloc[idx]
-        struct = row[self.structure_col]
-        material_ids = [self.df.index[idx], *row[self.identifiers]]
-
-        # atom features for disordered sites
-        site_atoms = [atom.species.as_dict() for atom in struct]
-        atom_features = np.vstack(
-            [
-                np.sum([self.elem_features[el] * amt for el, amt in site.items()], axis=0)
-                for site in site_atoms
-            ]
-        )
+        return self.feature_cache.get(idx, self.featurize)
 
-        self_idx, nbr_idx, nbr_dist = get_structure_neighbor_info(
-            struct, self.radius, self.max_num_nbr
-        )
+    def featurize(self, idx: int):
+        """Featurize a single entry of the Dataset without caching.
 
-        if len(self_idx) == 0:
-            raise ValueError(f"All atoms in {material_ids} are isolated")
-        if len(nbr_idx) == 0:
-            raise ValueError(
-                f"Empty nbr_idx. should not happen but did for {material_ids}"
-            )
-        if set(self_idx) != set(range(len(struct))):
-            raise ValueError(f"At least one atom in {material_ids} is isolated")
+        Args:
+            idx (int): index of entry in Dataset
+
+        Returns:
+            tuple: same as __getitem__
+        """
+        idx = range(len(self))[idx]  # resolve negative indices
+        material_ids = [self.df.index[idx], *self.ids[idx]]
+
+        graph = self.graph_cache[self.graph_rows[idx]]
+
+        atom_z, atom_occu = self._atom_species(graph, material_ids)
+
+        self_idx, nbr_idx, nbr_dist = graph.self_idx, graph.nbr_idx, graph.nbr_dist
 
         nbr_dist = self.gaussian_dist_func.expand(nbr_dist)
 
-        atom_fea_t = Tensor(atom_features)
         nbr_dist_t = Tensor(nbr_dist)
-        self_idx_t = LongTensor(self_idx)
-        nbr_idx_t = LongTensor(nbr_idx)
+        self_idx_t = torch.from_numpy(self_idx.astype(np.int64))
+        nbr_idx_t = torch.from_numpy(nbr_idx.astype(np.int64))
 
-        targets: list[Tensor | LongTensor] = []
-        for target, task_type in self.task_dict.items():
-            if task_type == "regression":
-                targets.append(Tensor([row[target]]))
-            elif task_type == "classification":
-                targets.append(LongTensor([row[target]]))
+        targets = [col[idx].reshape(1) for col in self.targets]
+
+        inputs = (
+            torch.from_numpy(atom_z),
+            torch.from_numpy(atom_occu),
+            nbr_dist_t,
+            self_idx_t,
+            nbr_idx_t,
+        )
+        return (inputs, targets, *material_ids)
+
+    def _atom_species(
+        self, graph: CrystalGraph, material_ids: list
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Atomic numbers and occupancies of the species on each site, padded with
+        zeros to the largest number of species on any site of the structure. Ordered
+        structures thus give one column of atomic numbers and one of ones.
+        """
+        if np.isnan(self.elem_fea_table[graph.species_z, 0]).any():
+            raise ValueError(f"{material_ids} contains element types not in embedding")
+
+        # species are stored grouped by site, slot is their rank within their site
+        n_species = np.bincount(graph.species_site, minlength=graph.n_sites)
+        site_start = np.cumsum(n_species) - n_species
+        slot = np.arange(len(graph.species_site)) - site_start[graph.species_site]
+        atom_z = np.zeros((graph.n_sites, n_species.max(initial=1)), dtype=np.int64)
+        atom_occu = np.zeros(atom_z.shape, dtype=np.float32)
+        atom_z[graph.species_site, slot] = graph.species_z
+        atom_occu[graph.species_site, slot] = graph.species_occu[:, 0]
+        return atom_z, atom_occu
+
+    def graph_sizes(self) -> tuple[np.ndarray, np.ndarray]:
+        """Number of sites and edges of each entry's crystal graph, see
+        BudgetBatchSampler.
+        """
+        n_sites, n_edges, _ = self.graph_cache.connectivity(self.graph_rows)
+        return n_sites, n_edges
+
+    @cached_property
+    def graph_arrays(self) -> dict[str, np.ndarray | Tensor]:
+        """Crystal graphs of all entries concatenated into CSR arrays with per-entry
+        site and edge offsets. Built on first use by get_batch(). Neighbor distances
+        are stored raw and only Gaussian expanded for the edges of each batch, which
+        would otherwise take nbr_fea_dim floats per edge of the whole dataset.
+        """
+        graphs = [self.graph_cache[row] for row in self.graph_rows]
+        atom_z, atom_occu = zip(
+            *(
+                self._atom_species(graph, [self.df.index[idx], *self.ids[idx]])
+                for idx, graph in enumerate(graphs)
+            )
+        )
+        # pad all sites to the largest number of species on any site of the dataset
+        width = max(arr.shape[1] for arr in atom_z)
+
+        return {
+            "site_ptr": np.cumsum([0, *(graph.n_sites for graph in graphs)]),
+            "edge_ptr": np.cumsum([0, *(len(graph.self_idx) for graph in graphs)]),
+            "atom_z": np.concatenate([_pad_cols(arr, width) for arr in atom_z]),
+            "atom_occu": np.concatenate([_pad_cols(arr, width) for arr in atom_occu]),
+            "self_idx": np.concatenate([graph.self_idx for graph in graphs]),
+            "nbr_idx": np.concatenate([graph.nbr_idx for graph in graphs]),
+            "nbr_dist": np.concatenate([graph.nbr_dist for graph in graphs]),
+        }
+
+    def get_batch(self, rows: Sequence[int] | np.ndarray) -> tuple[Any, ...]:
+        """Gather a batch straight from the CSR graph_arrays with vectorized ops.
+
+        Gives the same result as collate_batch([self[row] for row in rows]) without
+        per-sample tensors, see InMemoryDataLoader.from_dataset().
+
+        Args:
+            rows (list[int] | np.ndarray): Indices of the entries in the batch.
+
+        Returns:
+            tuple: same as collate_batch()
+        """
+        rows = np.arange(len(self))[rows]  # resolve negative indices
+        arrays = self.graph_arrays
+        site_idx, n_sites = csr_gather(arrays["site_ptr"], rows)
+        edge_idx, n_edges = csr_gather(arrays["edge_ptr"], rows)
+
+        n_sites = torch.from_numpy(n_sites)
+        edge_offsets = batch_edge_offsets(n_sites, torch.from_numpy(n_edges))
+        self_idx, nbr_idx = (
+            torch.from_numpy(arrays[key][edge_idx].astype(np.int64)) + edge_offsets
+            for key in ("self_idx", "nbr_idx")
+        )
+
+        # drop the padding columns no site of the batch needs, like collate_batch
+        atom_occu = arrays["atom_occu"][site_idx]
+        width = int((atom_occu > 0).sum(axis=1).max(initial=1))
+        inputs = (
+            torch.from_numpy(arrays["atom_z"][site_idx, :width]),
+            torch.from_numpy(atom_occu[:, :width]),
+            Tensor(self.gaussian_dist_func.expand(arrays["nbr_dist"][edge_idx])),
+            self_idx,
+            nbr_idx,
+            torch.arange(len(rows)).repeat_interleave(n_sites),
+            batch_ptr(n_sites),
+        )
+        targets = tuple(col[torch.from_numpy(rows)][:, None] for col in self.targets)
+        ids = [self.ids[row] for row in rows]
 
-        return ((atom_fea_t, nbr_dist_t, self_idx_t, nbr_idx_t), targets, *material_ids)
+        return (inputs, targets, tuple(self.df.index[rows]), *zip(*ids))
+
+
+def _pad_cols(arr: np.ndarray, width: int) -> np.ndarray:
+    """Zero-pad the columns of a 2D array to width."""
+    return np.pad(arr, ((0, 0), (0, width - arr.shape[1])))
 
 
 def collate_batch(
     samples: tuple[
-        tuple[Tensor, Tensor, LongTensor, LongTensor],
+        tuple[LongTensor, Tensor, Tensor, LongTensor, LongTensor],
         list[Tensor | LongTensor],
         list[str | int],
     ],
@@ -195,7 +334,8 @@ def collate_batch(
     Args:
         samples (list[tuple]): for each data point a tuple containing:
             tuple[
-                atom_fea (Tensor): atom features
+                atom_z (LongTensor): atomic numbers of the species on each site
+                atom_occu (Tensor): occupancies of the species on each site
                 nbr_dist (Tensor): distance between neighboring atoms
                 self_idx (LongTensor): indices of atoms in the structure
                 nbr_idx (LongTensor): indices of neighboring atoms
@@ -206,59 +346,125 @@ def collate_batch(
 
     Returns:
         tuple[
-            tuple[Tensor, Tensor, LongTensor, LongTensor, LongTensor]: batched CGCNN
-                model inputs,
+            tuple[LongTensor, Tensor, Tensor, LongTensor * 4]: batched CGCNN model
+                inputs. Species columns are zero-padded to the largest number of
+                species on any site of the batch. The last entry holds the CSR
+                offsets of the atoms of each crystal, which marks all indices as
+                sorted and gives the number of crystals,
             tuple[Tensor | LongTensor]: Target values for different tasks,
             *tuple[str | int]: identifiers like material_id, composition
         ]
     """
-    batch_atom_fea = []
-    batch_nbr_dist = []
-    batch_self_idx = []
-    batch_nbr_idx = []
-    crystal_atom_idx = []
-    batch_targets = []
-    batch_identifiers = []
-    base_idx = 0
-
-    for idx, (inputs, target, *identifiers) in enumerate(samples):
-        atom_fea, nbr_dist, self_idx, nbr_idx = inputs
-        n_sites = atom_fea.shape[0]  # number of atoms for this crystal
-
-        # batch the features together
-        batch_atom_fea.append(atom_fea)
-        batch_nbr_dist.append(nbr_dist)
-
-        # mappings from bonds to atoms
-        batch_self_idx.append(self_idx + base_idx)
-        batch_nbr_idx.append(nbr_idx + base_idx)
-
-        # mapping from atoms to crystals
-        crystal_atom_idx.extend([idx] * n_sites)
-
-        # batch the targets and identifiers
-        batch_targets.append(target)
-        batch_identifiers.append(identifiers)
-
-        # increment the id counter
-        base_idx += n_sites
-
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    atom_fea = torch.cat(batch_atom_fea, dim=0).to(device)
-    nbr_dist = torch.cat(batch_nbr_dist, dim=0).to(device)
-    self_idx = torch.cat(batch_self_idx, dim=0).to(device)
-    nbr_idx = torch.cat(batch_nbr_idx, dim=0).to(device)
-    cry_idx = LongTensor(crystal_atom_idx).to(device)
+    inputs, targets, *identifiers = zip(*samples)
+    atom_z, atom_occu, nbr_dist, self_idx, nbr_idx = zip(*inputs)
+
+    # number of atoms in each crystal and mapping from atoms to crystals
+    n_sites = torch.tensor([len(z) for z in atom_z])
+    # pad the species of all sites to the largest number on any site of the batch,
+    # only needed if the batch mixes ordered and disordered structures
+    width = max(z.shape[1] for z in atom_z)
+    if any(z.shape[1] != width for z in atom_z):
+        atom_z, atom_occu = (
+            [
+                torch.nn.functional.pad(tensor, (0, width - tensor.shape[1]))
+                for tensor in tensors
+            ]
+            for tensors in (atom_z, atom_occu)
+        )
+    cry_idx = torch.arange(len(samples)).repeat_interleave(n_sites)
+
+    # mappings from bonds to atoms
+    n_edges = torch.tensor([len(idx) for idx in self_idx])
+    edge_offsets = batch_edge_offsets(n_sites, n_edges)
+    self_idx = torch.cat(self_idx) + edge_offsets
+    nbr_idx = torch.cat(nbr_idx) + edge_offsets
 
+    # tensors stay on CPU so DataLoader workers can collate and pin memory,
+    # BaseModelClass moves each batch to the model's device
     return (
-        (atom_fea, nbr_dist, self_idx, nbr_idx, cry_idx),
-        tuple(
-            torch.stack(b_target, dim=0).to(device) for b_target in zip(*batch_targets)
+        (
+            torch.cat(atom_z),
+            torch.cat(atom_occu),
+            torch.cat(nbr_dist),
+            self_idx,
+            nbr_idx,
+            cry_idx,
+            batch_ptr(n_sites),
         ),
-        *zip(*batch_identifiers),
+        tuple(torch.stack(b_target) for b_target in zip(*targets)),
+        *identifiers,
     )
 
 
+class CrystalGraphStreamData(ParquetShardDataset):
+    """Stream CrystalGraphData samples out of Parquet shards too large to fit in
+    memory, see ParquetShardDataset. Parquet cannot hold pymatgen objects so
+    structure_col must hold JSON strings (Structure.to_json()) or dicts
+    (Structure.as_dict()), which are only turned into Structures one row group at a
+    time. Use with torch.utils.data.DataLoader and collate_batch like
+    CrystalGraphData.
+    """
+
+    def __init__(
+        self,
+        path: str | Sequence[str],
+        task_dict: dict[str, str],
+        structure_col: str = "structure",
+        identifiers: Sequence[str] = (),
+        shuffle: bool = False,
+        shuffle_buffer: int = 1024,
+        prefetch: int = 1,
+        seed: int = 0,
+        **kwargs: Any,
+    ) -> None:
+        """Index the row groups of all shards.
+
+        Args:
+            path (str | Sequence[str]): Directory holding *.parquet shards, a single
+                Parquet file or a list of them.
+            task_dict ({target: task}): task dict for multi-task learning
+            structure_col (str, optional): Column holding the serialized structures.
+                Defaults to "structure".
+            identifiers (list[str], optional): Columns for distinguishing data
+                points. Defaults to ().
+            shuffle (bool, optional): Whether to shuffle row groups and samples.
+                Defaults to False.
+            shuffle_buffer (int, optional): Number of samples to draw randomly from
+                if shuffle=True. Defaults to 1024.
+            prefetch (int, optional): Number of row groups to featurize ahead on a
+                background thread. Defaults to 1.
+            seed (int, optional): Seed for shuffling. Defaults to 0.
+            **kwargs: Passed to CrystalGraphData, e.g. radius or cache_dir.
+        """
+        super().__init__(
+            path,
+            featurize=partial(
+                _crystal_graph_data_from_json,
+                task_dict=task_dict,
+                structure_col=structure_col,
+                identifiers=identifiers,
+                **kwargs,
+            ),
+            columns=list(dict.fromkeys([structure_col, *identifiers, *task_dict])),
+            shuffle=shuffle,
+            shuffle_buffer=shuffle_buffer,
+            prefetch=prefetch,
+            seed=seed,
+        )
+
+
+def _crystal_graph_data_from_json(
+    df: pd.DataFrame, structure_col: str = "structure", **kwargs: Any
+) -> CrystalGraphData:
+    """Deserialize the structures of a row group and featurize them."""
+    df = df.copy()
+    df[structure_col] = [
+        Structure.from_dict(json.loads(struct) if isinstance(struct, str) else struct)
+        for struct in df[structure_col]
+    ]
+    return CrystalGraphData(df, structure_col=structure_col, **kwargs)
+
+
 class GaussianDistance:
     """Expands the distance by Gaussian basis. Unit: angstrom."""
 
@@ -327,22 +533,450 @@ def get_structure_neighbor_info(
     )
 
     if max_num_nbr is not None:
-        _center_indices: list[int] = []
-        _neighbor_indices: list[int] = []
-        _neighbor_dists: list[float] = []
+        keep = nearest_neighbor_mask(site_indices, neighbor_dists, max_num_nbr)
+        site_indices = site_indices[keep]
+        neighbor_indices = neighbor_indices[keep]
+        neighbor_dists = neighbor_dists[keep]
 
-        for _, idx_group in itertools.groupby(  # group by site index
-            zip(site_indices, neighbor_indices, neighbor_dists), key=lambda x: x[0]
-        ):
-            site_indices, neighbor_idx, neighbor_dist = zip(
-                *sorted(idx_group, key=lambda x: x[2])  # sort by distance
+    return site_indices, neighbor_indices, neighbor_dists
+
+
+def get_structures_neighbor_info(
+    structures: Sequence[Structure],
+    radius: float = 5,
+    max_num_nbr: int | None = 12,
+    pbar: bool = False,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Get neighbors for every site in many structures at once. The neighbor search
+    runs per structure but truncation to the nearest max_num_nbr neighbors is done in
+    a single vectorized pass over the bonds of all structures.
+
+    Args:
+        structures (list[Structure]): pymatgen Structures to get neighbors for
+        radius (float, optional): Radius to search for neighbors. Defaults to 5.
+        max_num_nbr (int, optional): Maximum number of neighbors to return. Defaults
+            to 12.
+        pbar (bool, optional): Whether to display a progress bar. Defaults to False.
+
+    Returns:
+        tuple containing:
+        - np.ndarray: CSR offsets of length len(structures) + 1 such that the bonds of
+            structure i are ptr[i]:ptr[i + 1] in the following arrays
+        - np.ndarray: Site indices (local to each structure)
+        - np.ndarray: Neighbor indices (local to each structure)
+        - np.ndarray: Distances between sites and neighbors
+    """
+    site_indices, neighbor_indices, neighbor_dists = [], [], []
+    n_bonds, n_sites = [], []
+    desc = "Finding neighbors"
+    for struct in tqdm(structures, desc=desc, disable=None if pbar else True):
+        site_idx, nbr_idx, _, nbr_dist = struct.get_neighbor_list(
+            radius, numerical_tol=1e-8
+        )
+        site_indices.append(site_idx)
+        neighbor_indices.append(nbr_idx)
+        neighbor_dists.append(nbr_dist)
+        n_bonds.append(len(site_idx))
+        n_sites.append(len(struct))
+
+    site_idx = np.concatenate([np.empty(0, dtype=np.int64), *site_indices])
+    nbr_idx = np.concatenate([np.empty(0, dtype=np.int64), *neighbor_indices])
+    nbr_dist = np.concatenate([np.empty(0, dtype=np.float64), *neighbor_dists])
+    n_bonds_arr = np.array(n_bonds, dtype=np.int64)
+
+    if max_num_nbr is not None:
+        # offset site indices to make them unique across structures
+        site_offsets = np.cumsum([0, *n_sites[:-1]], dtype=np.int64)
+        global_site_idx = site_idx + np.repeat(site_offsets, n_bonds_arr)
+        keep = nearest_neighbor_mask(global_site_idx, nbr_dist, max_num_nbr)
+
+        site_idx, nbr_idx, nbr_dist = site_idx[keep], nbr_idx[keep], nbr_dist[keep]
+        struct_idx = np.repeat(np.arange(len(n_bonds_arr)), n_bonds_arr)[keep]
+        n_bonds_arr = np.bincount(struct_idx, minlength=len(n_bonds_arr))
+
+    ptr = np.concatenate([[0], np.cumsum(n_bonds_arr)])
+
+    return ptr, site_idx, nbr_idx, nbr_dist
+
+
+def nearest_neighbor_mask(
+    site_indices: np.ndarray, neighbor_dists: np.ndarray, max_num_nbr: int
+) -> np.ndarray:
+    """Select the max_num_nbr nearest neighbors of every site.
+
+    Bonds are lexsorted by site and then distance. The rank of each bond within its
+    site's group is its sorted position minus the position of the group's first bond.
+    Bonds with rank < max_num_nbr are kept. lexsort is stable so ties in distance keep
+    their original order.
+
+    Args:
+        site_indices (np.ndarray): Site index of each bond, sorted or grouped by site.
+        neighbor_dists (np.ndarray): Length of each bond.
+        max_num_nbr (int): Maximum number of neighbors per site.
+
+    Returns:
+        np.ndarray: Indices into the bond arrays of the kept bonds, ordered by site
+            and then by distance.
+    """
+    order = np.lexsort((neighbor_dists, site_indices))
+    sorted_sites = site_indices[order]
+
+    is_group_start = np.ones(len(order), dtype=bool)
+    is_group_start[1:] = sorted_sites[1:] != sorted_sites[:-1]
+    group_starts = np.flatnonzero(is_group_start)
+    group_sizes = np.diff(np.append(group_starts, len(order)))
+    rank = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+
+    return order[rank < max_num_nbr]
+
+
+class CrystalGraph(NamedTuple):
+    """Featurized crystal graph of a single structure as stored in CrystalGraphCache.
+    Site, self and neighbor indices are local to the structure.
+    """
+
+    n_sites: int
+    species_z: np.ndarray  # atomic number of each species on each site
+    species_occu: np.ndarray  # occupancy of each species, shape (n_species, 1)
+    species_site: np.ndarray  # site index of each species
+    self_idx: np.ndarray
+    nbr_idx: np.ndarray
+    nbr_dist: np.ndarray
+
+
+class CrystalGraphCache(SlimPickleMixin):
+    """Content-addressed store of crystal graphs in CSR format.
+
+    Each structure is featurized into its site species, self/neighbor indices and raw
+    neighbor distances exactly once. Graphs are keyed by a hash of the structure so
+    duplicates are only computed once. If a cache_dir is given, every batch of newly
+    featurized graphs is written as a chunk of .npy files to a subdirectory specific
+    to the chunk format version, radius and max_num_nbr. Chunks are memory-mapped on
+    load so later training and prediction runs as well as DataLoader workers share the
+    page cache instead of recomputing or copying graphs.
+    """
+
+    arrays = (
+        "hashes",
+        "site_ptr",
+        "species_ptr",
+        "edge_ptr",
+        "n_connected",
+        "species_z",
+        "species_occu",
+        "species_site",
+        "self_idx",
+        "nbr_idx",
+        "nbr_dist",
+    )
+    # bump whenever arrays change so chunks of older versions are not loaded
+    format_version = 2
+    # rebuilt from the hashes of each chunk after unpickling
+    _pickle_exclude = ("hash_to_row",)
+
+    def __init__(
+        self,
+        radius: float = 5,
+        max_num_nbr: int | None = 12,
+        cache_dir: str | None = None,
+    ) -> None:
+        """Open a crystal graph cache, loading all existing chunks from cache_dir.
+
+        Args:
+            radius (float, optional): Cut-off radius for neighborhood. Defaults to 5.
+            max_num_nbr (int, optional): maximum number of neighbors to consider.
+                Defaults to 12.
+            cache_dir (str, optional): Directory to persist featurized graphs in.
+                Defaults to None meaning graphs are only kept in memory.
+        """
+        self.radius = radius
+        self.max_num_nbr = max_num_nbr
+
+        self.cache_dir = None
+        if cache_dir is not None:
+            version = f"v{self.format_version}"
+            self.cache_dir = f"{cache_dir}/{version}-{radius=}-{max_num_nbr=}"
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.chunks: list[dict[str, np.ndarray]] = []
+        self.chunk_offsets: list[int] = []  # global row of each chunk's 1st graph
+        self.hash_to_row: dict[str, int] = {}
+
+        if self.cache_dir is not None:
+            for chunk_dir in sorted(glob(f"{self.cache_dir}/chunk-*")):
+                self._append_chunk(
+                    {
+                        key: np.load(f"{chunk_dir}/{key}.npy", mmap_mode="r")
+                        for key in self.arrays
+                    }
+                )
+
+    def __len__(self) -> int:
+        return len(self.hash_to_row)
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(radius={self.radius}, max_num_nbr="
+            f"{self.max_num_nbr}, cache_dir={self.cache_dir}, len={len(self)})"
+        )
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        super().__setstate__(state)
+        chunks, self.chunks, self.chunk_offsets = self.chunks, [], []
+        self.hash_to_row = {}
+        for chunk in chunks:
+            self._append_chunk(chunk)
+
+    def _append_chunk(self, chunk: dict[str, np.ndarray]) -> None:
+        offset = sum(len(c["hashes"]) for c in self.chunks)
+        self.chunks.append(chunk)
+        self.chunk_offsets.append(offset)
+        for local_row, hash in enumerate(chunk["hashes"].astype(str).tolist()):
+            self.hash_to_row[hash] = offset + local_row
+
+    def add(
+        self,
+        structures: Sequence[Structure],
+        n_jobs: int = 1,
+        executor: Executor | None = None,
+    ) -> np.ndarray:
+        """Featurize all structures not yet in the cache and return the cache rows of
+        all structures.
+
+        Args:
+            structures (list[Structure]): pymatgen Structures to add.
+            n_jobs (int, optional): Number of worker processes to featurize new
+                structures with. -1 means use all CPUs. Defaults to 1.
+            executor (Executor, optional): Existing executor to submit featurization
+                chunks to instead of starting a process pool. Defaults to None.
+
+        Returns:
+            np.ndarray: Cache row of each structure in the same order as structures.
+        """
+        hashes = [structure_hash(struct) for struct in structures]
+
+        new_structs: dict[str, Structure] = {}
+        for hash, struct in zip(hashes, structures):
+            if hash not in self.hash_to_row:
+                new_structs.setdefault(hash, struct)
+
+        if new_structs:
+            chunk = featurize_crystal_graphs(
+                list(new_structs.values()),
+                self.radius,
+                self.max_num_nbr,
+                n_jobs=n_jobs,
+                executor=executor,
             )
-            _center_indices.extend(site_indices[:max_num_nbr])
-            _neighbor_indices.extend(neighbor_idx[:max_num_nbr])
-            _neighbor_dists.extend(neighbor_dist[:max_num_nbr])
+            chunk["hashes"] = np.array(list(new_structs), dtype="S40")
+            if self.cache_dir is not None:
+                chunk = self._write_chunk(chunk)
+            self._append_chunk(chunk)
 
-        site_indices = np.array(_center_indices)
-        neighbor_indices = np.array(_neighbor_indices)
-        neighbor_dists = np.array(_neighbor_dists)
+        return np.array([self.hash_to_row[hash] for hash in hashes], dtype=np.int64)
 
-    return site_indices, neighbor_indices, neighbor_dists
+    def _write_chunk(self, chunk: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        """Save a chunk to disk and return it memory-mapped. Chunks are written to a
+        temporary directory first and then renamed so that concurrent runs never see
+        partially written chunks.
+        """
+        name = f"chunk-{uuid.uuid4().hex}"
+        tmp_dir = f"{self.cache_dir}/.tmp-{name}"
+        os.makedirs(tmp_dir)
+        for key, arr in chunk.items():
+            np.save(f"{tmp_dir}/{key}.npy", arr)
+        os.rename(tmp_dir, f"{self.cache_dir}/{name}")
+
+        return {
+            key: np.load(f"{self.cache_dir}/{name}/{key}.npy", mmap_mode="r")
+            for key in self.arrays
+        }
+
+    def _locate(self, row: int) -> tuple[dict[str, np.ndarray], int]:
+        chunk_idx = bisect.bisect_right(self.chunk_offsets, row) - 1
+        return self.chunks[chunk_idx], row - self.chunk_offsets[chunk_idx]
+
+    def __getitem__(self, row: int) -> CrystalGraph:
+        """Get the crystal graph stored in a given cache row."""
+        chunk, local_row = self._locate(row)
+        site_start, site_end = chunk["site_ptr"][local_row : local_row + 2]
+        spec_start, spec_end = chunk["species_ptr"][local_row : local_row + 2]
+        edge_start, edge_end = chunk["edge_ptr"][local_row : local_row + 2]
+
+        return CrystalGraph(
+            n_sites=int(site_end - site_start),
+            species_z=chunk["species_z"][spec_start:spec_end],
+            species_occu=chunk["species_occu"][spec_start:spec_end, None],
+            species_site=chunk["species_site"][spec_start:spec_end],
+            self_idx=chunk["self_idx"][edge_start:edge_end],
+            nbr_idx=chunk["nbr_idx"][edge_start:edge_end],
+            nbr_dist=chunk["nbr_dist"][edge_start:edge_end],
+        )
+
+    def connectivity(
+        self, rows: Sequence[int]
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the number of sites, edges and sites with at least one neighbor for the
+        graphs in the given cache rows.
+
+        Args:
+            rows (list[int]): Cache rows to check.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: Number of sites, edges and
+                connected sites for each row.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = np.zeros((3, len(rows)), dtype=np.int64)
+        chunk_idx = np.searchsorted(self.chunk_offsets, rows, side="right") - 1
+        for idx in np.unique(chunk_idx):
+            chunk, mask = self.chunks[idx], chunk_idx == idx
+            local_rows = rows[mask] - self.chunk_offsets[idx]
+            counts[0, mask] = np.diff(chunk["site_ptr"])[local_rows]
+            counts[1, mask] = np.diff(chunk["edge_ptr"])[local_rows]
+            counts[2, mask] = chunk["n_connected"][local_rows]
+
+        return counts[0], counts[1], counts[2]
+
+
+def featurize_crystal_graphs(
+    structures: Sequence[Structure],
+    radius: float = 5,
+    max_num_nbr: int | None = 12,
+    n_jobs: int = 1,
+    executor: Executor | None = None,
+    pbar: bool = True,
+) -> dict[str, np.ndarray]:
+    """Featurize structures into site species and neighbor lists in CSR format.
+
+    With n_jobs > 1 or an executor, structures are split into chunks that are
+    featurized in worker processes. Chunk results are merged in the original order.
+
+    Args:
+        structures (list[Structure]): pymatgen Structures to featurize.
+        radius (float, optional): Cut-off radius for neighborhood. Defaults to 5.
+        max_num_nbr (int, optional): Maximum number of neighbors per site. Defaults
+            to 12.
+        n_jobs (int, optional): Number of worker processes. -1 means use all CPUs. If
+            an executor is passed, only used to decide the number of chunks.
+            Defaults to 1.
+        executor (Executor, optional): Executor to map chunks over. Defaults to None
+            meaning a ProcessPoolExecutor with n_jobs workers if n_jobs != 1.
+        pbar (bool, optional): Whether to display a progress bar. Defaults to True.
+
+    Returns:
+        dict[str, np.ndarray]: site_ptr, species_ptr and edge_ptr offsets of length
+            len(structures) + 1, n_connected (number of sites with at least one
+            neighbor per structure) and the concatenated per-structure arrays
+            species_z, species_occu, species_site, self_idx, nbr_idx and nbr_dist.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+
+    if n_jobs > 1 or executor is not None:
+        # several chunks per worker to balance load across structures of varying size
+        n_chunks = min(len(structures), 4 * max(n_jobs, 1))
+        bounds = np.linspace(0, len(structures), n_chunks + 1).astype(int)
+        chunks = [structures[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        featurize = partial(
+            featurize_crystal_graphs,
+            radius=radius,
+            max_num_nbr=max_num_nbr,
+            pbar=False,
+        )
+
+        with ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(ProcessPoolExecutor(n_jobs))
+            desc = f"Featurizing crystal graphs ({n_chunks} chunks)"
+            results = list(
+                tqdm(
+                    executor.map(featurize, chunks),
+                    total=n_chunks,
+                    desc=desc,
+                    disable=None if pbar else True,
+                )
+            )
+
+        return concat_crystal_graphs(results)
+
+    n_species = []
+    species_z, species_occu, species_site = [], [], []
+
+    for struct in structures:
+        n_species.append(0)
+        for site_idx, site in enumerate(struct):
+            for specie, amt in site.species.items():
+                species_z.append(specie.Z)
+                species_occu.append(amt)
+                species_site.append(site_idx)
+                n_species[-1] += 1
+
+    edge_ptr, self_idx, nbr_idx, nbr_dist = get_structures_neighbor_info(
+        structures, radius, max_num_nbr, pbar=pbar
+    )
+
+    # count sites with at least one neighbor to detect isolated atoms
+    site_ptr = np.cumsum([0, *map(len, structures)], dtype=np.int64)
+    struct_idx = np.repeat(np.arange(len(structures)), np.diff(edge_ptr))
+    connected_sites = np.unique(self_idx + site_ptr[struct_idx])
+    n_connected = np.diff(np.searchsorted(connected_sites, site_ptr))
+
+    return {
+        "site_ptr": site_ptr,
+        "species_ptr": np.cumsum([0, *n_species], dtype=np.int64),
+        "edge_ptr": edge_ptr,
+        "n_connected": n_connected.astype(np.int64),
+        "species_z": np.array(species_z, dtype=np.int16),
+        "species_occu": np.array(species_occu, dtype=np.float64),
+        "species_site": np.array(species_site, dtype=np.int32),
+        "self_idx": self_idx.astype(np.int32),
+        "nbr_idx": nbr_idx.astype(np.int32),
+        "nbr_dist": nbr_dist.astype(np.float32),
+    }
+
+
+def concat_crystal_graphs(
+    chunks: Sequence[dict[str, np.ndarray]],
+) -> dict[str, np.ndarray]:
+    """Merge featurized crystal graph chunks from featurize_crystal_graphs() in order.
+
+    Args:
+        chunks (list[dict[str, np.ndarray]]): Featurized chunks.
+
+    Returns:
+        dict[str, np.ndarray]: Single chunk with rebased CSR offsets.
+    """
+    merged = {}
+    for key in chunks[0]:
+        if key.endswith("_ptr"):
+            offsets = np.cumsum([0, *(chunk[key][-1] for chunk in chunks[:-1])])
+            merged[key] = np.concatenate(
+                [chunk[key][:-1] + offset for chunk, offset in zip(chunks, offsets)]
+                + [[offsets[-1] + chunks[-1][key][-1]]]
+            ).astype(np.int64)
+        else:
+            merged[key] = np.concatenate([chunk[key] for chunk in chunks])
+
+    return merged
+
+
+def structure_hash(struct: Structure) -> str:
+    """Hash a structure's lattice, fractional coordinates and site species. Used as
+    content address in CrystalGraphCache.
+
+    Args:
+        struct (Structure): pymatgen Structure
+
+    Returns:
+        str: 40-character hex digest
+    """
+    sha1 = hashlib.sha1()
+    # adding 0.0 turns -0.0 into 0.0 so both hash the same
+    sha1.update((np.round(struct.lattice.matrix, 8) + 0.0).tobytes())
+    sha1.update((np.round(struct.frac_coords, 8) + 0.0).tobytes())
+    species = ";".join(
+        ",".join(f"{sp}:{amt:.8g}" for sp, amt in site.species.items()) for site in struct
+    )
+    sha1.update(species.encode())
+    return sha1.hexdigest()
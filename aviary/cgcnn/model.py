@@ -9,7 +9,8 @@ from torch import LongTensor, Tensor, nn
 
 from aviary.core import BaseModelClass
 from aviary.networks import SimpleNetwork
-from aviary.scatter import scatter_reduce
+from aviary.scatter import scatter_reduce, segment_ptr
+from aviary.segments import FrozenElementEmbedding
 
 if TYPE_CHECKING:
     from collections.abc import Sequence
@@ -37,6 +38,7 @@ class CrystalGraphConvNet(BaseModelClass):
         h_fea_len: int = 128,
         n_trunk: int = 1,
         n_hidden: int = 1,
+        elem_embedding: str | None = "cgcnn92",
         **kwargs,
     ) -> None:
         """Initialize CrystalGraphConvNet.
@@ -58,10 +60,18 @@ class CrystalGraphConvNet(BaseModelClass):
                 Defaults to 1.
             n_hidden (int, optional): Number of hidden layers after trunk for each task.
                 Defaults to 1.
+            elem_embedding (str, optional): Element embedding to look up features of
+                atomic number inputs in. One of "matscholar200", "cgcnn92", "megnet16",
+                "onehot112" or path to a custom embedding file. Must be the one of the
+                dataset since it emits atomic numbers. None means inputs are
+                precomputed element features. Defaults to "cgcnn92" like the
+                dataset.
             **kwargs: Additional keyword arguments to pass to BaseModelClass.
         """
         super().__init__(robust=robust, **kwargs)
 
+        self.elem_lookup = FrozenElementEmbedding(elem_emb_len, elem_embedding)
+
         desc_dict = {
             "elem_emb_len": elem_emb_len,
             "nbr_fea_len": nbr_fea_len,
@@ -74,6 +84,7 @@ class CrystalGraphConvNet(BaseModelClass):
         model_params = {
             "robust": robust,
             "n_targets": n_targets,
+            "elem_embedding": self.elem_lookup.elem_embedding,
             "h_fea_len": h_fea_len,
             "n_hidden": n_hidden,
             **desc_dict,
@@ -94,36 +105,82 @@ class CrystalGraphConvNet(BaseModelClass):
 
     def forward(
         self,
-        atom_fea: Tensor,
+        atom_z: LongTensor,
+        atom_occu: Tensor,
         nbr_fea: Tensor,
         self_idx: LongTensor,
         nbr_idx: LongTensor,
         crystal_atom_idx: LongTensor,
+        crystal_atom_ptr: LongTensor | None = None,
     ) -> tuple[Tensor, ...]:
         """Forward pass.
 
         Args:
-            atom_fea (Tensor): Atom features from atom type
+            atom_z (LongTensor): Atomic numbers of the species on each site of shape
+                (n_sites, max species per site), zero-padded. Can also be
+                precomputed element features of shape (n_sites, max species per
+                site, elem_emb_len) if the model has no elem_embedding.
+            atom_occu (Tensor): Occupancies of the species on each site, zero for
+                padding. The atom features of a site are the occupancy-weighted sum
+                of the element features of its species.
             nbr_fea (Tensor): Bond features of each atom's neighbors
             self_idx (LongTensor): Mapping of Tensor rows to each nodes
             nbr_idx (LongTensor): Indices of the neighbors of each atom
             crystal_atom_idx (LongTensor): Mapping from the crystal idx to atom idx
+            crystal_atom_ptr (LongTensor, optional): CSR offsets of the atoms of each
+                crystal as emitted by collate_batch, which marks all indices of the
+                batch as sorted to reduce them segment-wise. Its length also gives
+                the number of crystals without reading crystal_atom_idx back from the
+                device. Defaults to None.
 
         Returns:
             tuple[Tensor, ...]: tuple of predictions for all targets
         """
-        atom_fea = self.node_nn(atom_fea, nbr_fea, self_idx, nbr_idx)
-
-        crys_fea = scatter_reduce(atom_fea, crystal_atom_idx, dim=0, reduce="mean")
-
-        # NOTE required to match the reference implementation
-        crys_fea = nn.functional.softplus(crys_fea)
+        crys_fea = self.material_features(
+            atom_z,
+            atom_occu,
+            nbr_fea,
+            self_idx,
+            nbr_idx,
+            crystal_atom_idx,
+            crystal_atom_ptr,
+        )
 
         crys_fea = F.relu(self.trunk_nn(crys_fea))
 
         # apply neural network to map from learned features to target
         return tuple(output_nn(crys_fea) for output_nn in self.output_nns)
 
+    def material_features(
+        self,
+        atom_z: LongTensor,
+        atom_occu: Tensor,
+        nbr_fea: Tensor,
+        self_idx: LongTensor,
+        nbr_idx: LongTensor,
+        crystal_atom_idx: LongTensor,
+        crystal_atom_ptr: LongTensor | None = None,
+    ) -> Tensor:
+        """Convolve the crystal graphs and pool their atoms into crystal features.
+        Takes the same inputs as forward().
+
+        Returns:
+            Tensor: Crystal features of each material
+        """
+        species_fea = self.elem_lookup(atom_z)
+        atom_fea = (species_fea * atom_occu.unsqueeze(-1)).sum(dim=1)
+        self_ptr = None
+        if crystal_atom_ptr is not None:
+            self_ptr = segment_ptr(self_idx, len(atom_fea))
+        atom_fea = self.node_nn(atom_fea, nbr_fea, self_idx, nbr_idx, self_ptr)
+
+        crys_fea = scatter_reduce(
+            atom_fea, crystal_atom_idx, dim=0, reduce="mean", ptr=crystal_atom_ptr
+        )
+
+        # NOTE required to match the reference implementation
+        return nn.functional.softplus(crys_fea)
+
 
 class DescriptorNetwork(nn.Module):
     """The Descriptor Network is the message passing section of the CrystalGraphConvNet
@@ -161,6 +218,7 @@ class DescriptorNetwork(nn.Module):
         nbr_fea: Tensor,
         self_idx: LongTensor,
         nbr_idx: LongTensor,
+        self_ptr: LongTensor | None = None,
     ) -> Tensor:
         """Forward pass.
 
@@ -169,6 +227,8 @@ class DescriptorNetwork(nn.Module):
             nbr_fea (Tensor): Bond features of each atom's M neighbors
             self_idx (LongTensor): Mapping from the crystal idx to atom idx
             nbr_idx (LongTensor): Indices of M neighbors of each atom
+            self_ptr (LongTensor, optional): CSR offsets of self_idx if the bonds are
+                sorted by atom. Defaults to None.
 
         Returns:
             Tensor: Atom hidden features after convolution
@@ -176,7 +236,7 @@ class DescriptorNetwork(nn.Module):
         atom_fea = self.embedding(atom_fea)
 
         for conv_func in self.convs:
-            atom_fea = conv_func(atom_fea, nbr_fea, self_idx, nbr_idx)
+            atom_fea = conv_func(atom_fea, nbr_fea, self_idx, nbr_idx, self_ptr)
 
         return atom_fea
 
@@ -209,6 +269,7 @@ class CGCNNConv(nn.Module):
         nbr_fea: Tensor,
         self_idx: LongTensor,
         nbr_idx: LongTensor,
+        self_ptr: LongTensor | None = None,
     ) -> Tensor:
         """Forward pass.
 
@@ -217,6 +278,8 @@ class CGCNNConv(nn.Module):
             nbr_fea (Tensor): Bond features of each atom's neighbors
             self_idx (LongTensor): _description_
             nbr_idx (LongTensor): Indices of M neighbors of each atom
+            self_ptr (LongTensor, optional): CSR offsets of self_idx if the bonds are
+                sorted by atom. Defaults to None.
 
         Returns:
             Tensor: Atom hidden features after convolution
@@ -236,7 +299,14 @@ class CGCNNConv(nn.Module):
 
         # take the elementwise product of the filter and core
         nbr_msg = filter_fea * core_fea
-        nbr_summed = scatter_reduce(nbr_msg, self_idx, dim=0, reduce="sum")
+        nbr_summed = scatter_reduce(
+            nbr_msg,
+            self_idx,
+            dim=0,
+            dim_size=len(atom_in_fea),
+            reduce="sum",
+            ptr=self_ptr,
+        )
 
         nbr_summed = self.bn2(nbr_summed)
         return self.softplus2(atom_in_fea + nbr_summed)
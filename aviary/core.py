@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import gc
 import os
 import shutil
 from abc import ABC
@@ -112,6 +111,7 @@ class BaseModelClass(nn.Module, ABC):
         try:
             for epoch in range(start_epoch, start_epoch + epochs):
                 self.epoch += 1
+                set_epoch(train_loader, epoch)
                 # Training
                 if verbose:
                     print(f"Epoch: [{epoch}/{start_epoch + epochs - 1}]")
@@ -204,9 +204,6 @@ class BaseModelClass(nn.Module, ABC):
 
                 scheduler.step()
 
-                # catch memory leak
-                gc.collect()
-
                 if writer == "wandb":
                     wandb.log({"train": train_metrics, "validation": val_metrics})
 
@@ -245,7 +242,8 @@ class BaseModelClass(nn.Module, ABC):
 
         Returns:
             dict[str, dict["Loss" | "MAE" | "RMSE" | "Accuracy" | "F1", np.ndarray]]:
-                nested dictionary for each target of metrics averaged over an epoch.
+                nested dictionary for each target of metrics averaged over an epoch,
+                weighting each batch by its number of samples.
         """
         if action == "evaluate":
             self.eval()
@@ -257,16 +255,21 @@ class BaseModelClass(nn.Module, ABC):
         epoch_metrics: dict[str, dict[str, list[float]]] = defaultdict(
             lambda: defaultdict(list)
         )
+        # batches can hold different numbers of samples (last batch, budget batching)
+        batch_sizes: list[int] = []
 
         # *_ discards identifiers like material_id and formula which we don't need when
         # training tqdm(disable=None) means suppress output in non-tty (e.g. CI/log
         # files) but keep in terminal (i.e. tty mode) https://git.io/JnBOi
         for inputs, targets_list, *_ in tqdm(data_loader, disable=None if pbar else True):
             inputs = [  # noqa: PLW2901
-                tensor.to(self.device) if hasattr(tensor, "to") else tensor
+                tensor.to(self.device, non_blocking=True)
+                if hasattr(tensor, "to")
+                else tensor
                 for tensor in inputs
             ]
             outputs = self(*inputs)
+            batch_sizes.append(len(targets_list[0]))
 
             mixed_loss: Tensor = 0  # type: ignore[assignment]
 
@@ -279,7 +282,7 @@ class BaseModelClass(nn.Module, ABC):
                 if task == "regression":
                     assert normalizer is not None
                     targets = normalizer.norm(targets).squeeze()  # noqa: PLW2901
-                    targets = targets.to(self.device)  # noqa: PLW2901
+                    targets = targets.to(self.device, non_blocking=True)  # noqa: PLW2901
 
                     if self.robust:
                         preds, log_std = output.unbind(dim=1)
@@ -294,7 +297,7 @@ class BaseModelClass(nn.Module, ABC):
                     target_metrics["MSE"].append(float(error.pow(2).mean()))
 
                 elif task == "classification":
-                    targets = targets.to(self.device)  # noqa: PLW2901
+                    targets = targets.to(self.device, non_blocking=True)  # noqa: PLW2901
 
                     if self.robust:
                         pre_logits, log_std = output.chunk(2, dim=1)
@@ -333,7 +336,7 @@ class BaseModelClass(nn.Module, ABC):
         avrg_metrics: dict[str, dict[str, float]] = {}
         for target, per_batch_metrics in epoch_metrics.items():
             avrg_metrics[target] = {
-                metric_key: np.array(values).mean().squeeze().round(4)
+                metric_key: np.average(values, weights=batch_sizes).round(4)
                 for metric_key, values in per_batch_metrics.items()
             }
             # take sqrt at the end to get correct epoch RMSE as per-batch averaged RMSE
@@ -383,7 +386,9 @@ class BaseModelClass(nn.Module, ABC):
             data_loader, disable=True if not verbose else None
         ):
             inputs = [  # noqa: PLW2901
-                tensor.to(self.device) if hasattr(tensor, "to") else tensor
+                tensor.to(self.device, non_blocking=True)
+                if hasattr(tensor, "to")
+                else tensor
                 for tensor in inputs
             ]
             preds = self(*inputs)  # forward pass to get model preds
@@ -425,14 +430,31 @@ class BaseModelClass(nn.Module, ABC):
 
         for inputs, *_ in data_loader:
             inputs = [  # noqa: PLW2901
-                tensor.to(self.device) if hasattr(tensor, "to") else tensor
+                tensor.to(self.device, non_blocking=True)
+                if hasattr(tensor, "to")
+                else tensor
                 for tensor in inputs
             ]
-            output = self.trunk_nn(self.material_nn(*inputs)).cpu().numpy()
+            output = self.trunk_nn(self.material_features(*inputs)).cpu().numpy()
             features.append(output)
 
         return np.vstack(features)
 
+    def material_features(self, *inputs: Tensor) -> Tensor:
+        """Material representation of a batch that is fed to the trunk network.
+
+        Models that transform their inputs before or after material_nn (e.g. looking
+        up element features or pooling atoms into crystals) override this so that
+        featurize() sees the same features as forward().
+
+        Args:
+            *inputs (Tensor): Batch inputs as passed to forward()
+
+        Returns:
+            Tensor: Material features of shape (n_materials, n_features)
+        """
+        return self.material_nn(*inputs)
+
     @property
     def num_params(self) -> int:
         """Return number of trainable parameters in model."""
@@ -522,6 +544,25 @@ class Normalizer:
         return instance
 
 
+def set_epoch(loader: DataLoader | InMemoryDataLoader, epoch: int) -> None:
+    """Pass the epoch to everything of a loader that shuffles per epoch, like the
+    loader itself, its (batch) sampler (e.g. DistributedSampler, BudgetBatchSampler)
+    and a streamed dataset (ParquetShardDataset), so each epoch gets a new order.
+
+    Args:
+        loader (DataLoader | InMemoryDataLoader): Loader to prepare for epoch.
+        epoch (int): Index of the epoch about to be iterated.
+    """
+    for obj in (
+        loader,
+        getattr(loader, "sampler", None),
+        getattr(loader, "batch_sampler", None),
+        getattr(loader, "dataset", None),
+    ):
+        if hasattr(obj, "set_epoch"):
+            obj.set_epoch(epoch)
+
+
 def save_checkpoint(
     state: dict[str, Any], is_best: bool, model_name: str, run_id: int
 ) -> None:
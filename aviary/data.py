@@ -1,14 +1,41 @@
 from __future__ import annotations
 
+import json
+import math
+import mmap
+import os
+import queue
+import threading
+import weakref
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Callable
+from functools import lru_cache
+from glob import glob
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple
 
 import numpy as np
+import pandas as pd
+import torch
+from pymatgen.core import Element
+from torch.utils.data import IterableDataset, Sampler, Subset, get_worker_info
+
+from aviary import PKG_DIR
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
 
 if TYPE_CHECKING:
-    from collections.abc import Iterator
+    from collections.abc import Hashable, Iterable, Iterator, Sequence
+
+    from torch import LongTensor, Tensor
+    from torch.utils.data import Dataset
+
+MAX_Z = max(el.Z for el in Element)
 
-    from torch import Tensor
+# built-in element embeddings and their number of features
+ELEM_EMBEDDINGS = {"matscholar200": 200, "cgcnn92": 92, "megnet16": 16, "onehot112": 112}
 
 
 @dataclass
@@ -26,6 +53,32 @@ class InMemoryDataLoader:
             loaders to speedup inference. Defaults to 64.
         shuffle (bool, optional): If True, shuffle the data *in-place* whenever an
             iterator is created from this object. Defaults to False.
+        batch_sampler (Iterable[Sequence[int]], optional): Yields the row indices of
+            each batch, e.g. a LengthBucketSampler or BudgetBatchSampler. Overrides
+            batch_size and shuffle. Samplers other than a fixed list of batches must
+            be seeded if world_size > 1. Defaults to None.
+        prefetch (int, optional): Number of batches to prepare ahead on a background
+            thread while the current one is consumed, see BatchPrefetcher. Defaults
+            to 0 meaning batches are collated synchronously in __next__.
+        rank (int, optional): Index of this process among world_size data-parallel
+            processes. Each process only iterates over its own shard of the rows
+            (or of the batches of batch_sampler). Defaults to 0.
+        world_size (int, optional): Number of data-parallel processes. Defaults to 1.
+        drop_last (bool, optional): If world_size does not divide the number of rows
+            (or batches), drop the surplus so all shards have equal length instead
+            of padding the shards by repeating rows from the start. Defaults to False.
+        seed (int, optional): Seed for the per-epoch shuffle permutation so that all
+            ranks agree on it. Defaults to None meaning the global NumPy RNG is used
+            if world_size is 1 and seed 0 otherwise.
+
+    Seeded permutations depend on the epoch, which is incremented whenever an
+    iterator is created. Call set_epoch() at the start of every epoch like for
+    DistributedSampler to keep ranks in sync, e.g. when resuming training.
+
+    Graph datasets (CompositionData, WyckoffData, CrystalGraphData) which implement
+    get_batch(rows) can be loaded with InMemoryDataLoader.from_dataset(). Their
+    batches are then gathered straight from the dataset's CSR arrays instead of going
+    through per-sample __getitem__ and collate_batch.
     """
 
     # each item must be indexable (usually torch.tensor, np.array or pd.Series)
@@ -33,36 +86,991 @@ class InMemoryDataLoader:
     collate_fn: Callable
     batch_size: int = 64
     shuffle: bool = False
+    batch_sampler: Iterable[Sequence[int]] | None = None
+    prefetch: int = 0
+    rank: int = 0
+    world_size: int = 1
+    drop_last: bool = False
+    seed: int | None = None
 
     def __post_init__(self):
         self.dataset_len = len(self.tensors[0])
         if not all(len(t) == self.dataset_len for t in self.tensors):
             raise ValueError("All tensors must have the same length in dim 0")
+        if self.prefetch < 0:
+            raise ValueError(f"{self.prefetch=} must be non-negative")
+        if not 0 <= self.rank < self.world_size:
+            raise ValueError(f"{self.rank=} must be in [0, {self.world_size=})")
+        if self.seed is None and self.world_size > 1:
+            self.seed = 0  # all ranks must draw the same permutation
+        if (
+            self.world_size > 1
+            and self.batch_sampler is not None
+            and not isinstance(self.batch_sampler, (list, tuple))
+            and getattr(self.batch_sampler, "seed", None) is None
+        ):
+            raise ValueError(
+                f"batch_sampler must be seeded with {self.world_size=} so all ranks "
+                "draw the same batches, e.g. pass seed to BudgetBatchSampler"
+            )
+        self.epoch = 0
+        self._prefetcher: weakref.ref[BatchPrefetcher] | None = None
+
+    @classmethod
+    def from_dataset(cls, dataset: Dataset | Subset, **kwargs: Any) -> InMemoryDataLoader:
+        """Create an in-memory loader for a graph dataset that holds all its samples
+        in CSR arrays and implements get_batch(rows).
+
+        Args:
+            dataset (Dataset | Subset): Dataset with a get_batch(rows) method that
+                returns the same batch as collate_batch([dataset[row] for row in
+                rows]), or a Subset of one.
+            **kwargs: Passed to InMemoryDataLoader, e.g. batch_size and shuffle.
+
+        Returns:
+            InMemoryDataLoader: Yields batches in the same format as a DataLoader
+                with the dataset's collate_batch.
+        """
+        dataset, rows = subset_rows(dataset)
+        if not hasattr(dataset, "get_batch"):
+            raise ValueError(f"{type(dataset).__name__} does not implement get_batch()")
+        return cls([rows], collate_fn=dataset.get_batch, **kwargs)
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch which seeds the shuffle permutation of the next iterator.
+
+        Also forwarded to batch_sampler if it implements set_epoch().
+        """
+        self.epoch = epoch
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
 
     def __iter__(self) -> Iterator[tuple[Tensor, ...]]:
-        self.indices = np.random.permutation(self.dataset_len) if self.shuffle else None
-        self.current_idx = 0
-        return self
+        # stop the background thread of an unfinished previous epoch
+        prev_prefetcher = self._prefetcher and self._prefetcher()
+        if prev_prefetcher is not None:
+            prev_prefetcher.close()
+        epoch = self.epoch
+        self.epoch += 1
+
+        if self.batch_sampler is not None:
+            # draw all index batches here so the sampler's RNG is only ever used by
+            # the calling thread, also when prefetching
+            index_batches = self.batch_sampler
+            if self.prefetch or self.world_size > 1:
+                index_batches = self._shard(list(index_batches))
+            batches = (
+                self.collate_fn(*(t[np.asarray(idx)] for t in self.tensors))
+                for idx in index_batches
+            )
+        else:
+            if self.shuffle and self.seed is not None:
+                rng = np.random.default_rng([self.seed, epoch])
+                self.indices = rng.permutation(self.dataset_len)
+            elif self.shuffle:
+                self.indices = np.random.permutation(self.dataset_len)
+            elif self.world_size > 1:
+                self.indices = np.arange(self.dataset_len)
+            else:
+                self.indices = None  # slice rows in order
+            if self.indices is not None:
+                self.indices = self._shard(self.indices)
+            self.current_idx = 0
+            if not self.prefetch:
+                return self
+            batches = (
+                self._get_batch(self.indices, start_idx)
+                for start_idx in range(0, self.n_rows, self.batch_size)
+            )
+
+        if not self.prefetch:
+            return batches
+        prefetcher = BatchPrefetcher(batches, depth=self.prefetch)
+        self._prefetcher = weakref.ref(prefetcher)
+        return prefetcher
 
     def __next__(self) -> tuple[Tensor, ...]:
         start_idx = self.current_idx
-        if start_idx >= self.dataset_len:
+        if start_idx >= self.n_rows:
             raise StopIteration
 
+        batch = self._get_batch(self.indices, start_idx)
+
+        self.current_idx += self.batch_size
+        return batch
+
+    def _get_batch(self, indices: np.ndarray | None, start_idx: int) -> Any:
+        """Slice and collate the batch starting at start_idx of an epoch."""
         end_idx = start_idx + self.batch_size
 
-        if self.indices is None:  # shuffle=False
+        if indices is None:  # shuffle=False
             slices = (t[start_idx:end_idx] for t in self.tensors)
         else:
-            idx = self.indices[start_idx:end_idx]
+            idx = indices[start_idx:end_idx]
             slices = (t[idx] for t in self.tensors)
 
-        batch = self.collate_fn(*slices)
+        return self.collate_fn(*slices)
 
-        self.current_idx += self.batch_size
-        return batch
+    def _shard_len(self, n_items: int) -> int:
+        """Number of rows or batches of each rank's shard."""
+        if self.drop_last:
+            return n_items // self.world_size
+        return -(-n_items // self.world_size)  # ceil
+
+    def _shard(self, items: Sequence[Any] | np.ndarray) -> Sequence[Any] | np.ndarray:
+        """Every world_size-th row (or batch) starting at rank, padded by wrapping
+        around to the start or truncated so all ranks get the same number.
+        """
+        if self.world_size == 1:
+            return items
+        total = self._shard_len(len(items)) * self.world_size
+        if isinstance(items, np.ndarray):
+            return np.resize(items, total)[self.rank :: self.world_size]
+        padded = [items[idx % len(items)] for idx in range(total)] if items else []
+        return padded[self.rank :: self.world_size]
+
+    @property
+    def n_rows(self) -> int:
+        """Number of rows this rank iterates over per epoch."""
+        return self._shard_len(self.dataset_len)
 
     def __len__(self) -> int:
         """Get the number of batches in this data loader."""
-        n_batches, remainder = divmod(self.dataset_len, self.batch_size)
+        if self.batch_sampler is not None:
+            return self._shard_len(len(self.batch_sampler))
+        n_batches, remainder = divmod(self.n_rows, self.batch_size)
         return n_batches + bool(remainder)
+
+
+class BatchPrefetcher:
+    """Iterator preparing the next batches of another iterator on a background
+    thread while the current batch is consumed.
+
+    Up to depth batches are handed over through a bounded queue. Exceptions raised
+    while preparing a batch are re-raised by __next__ in the consuming thread. The
+    thread is stopped and joined once the batches are exhausted, on error, on close()
+    and when the prefetcher is garbage collected, e.g. after breaking out of a loop.
+    """
+
+    def __init__(self, batches: Iterable[Any], depth: int = 2) -> None:
+        """Start prefetching.
+
+        Args:
+            batches (Iterable[Any]): Iterable of batches, e.g. a generator which
+                slices and collates them.
+            depth (int, optional): Maximum number of batches prepared ahead.
+                Defaults to 2.
+        """
+        if depth < 1:
+            raise ValueError(f"{depth=} must be positive")
+        self.queue: queue.Queue[tuple[Any, BaseException | None]] = queue.Queue(
+            maxsize=depth
+        )
+        self.stop_event = threading.Event()
+        self.exhausted = False
+        # the thread must not reference self, else the prefetcher is never collected
+        self.thread = threading.Thread(
+            target=_prefetch_batches,
+            args=(iter(batches), self.queue, self.stop_event),
+            name="BatchPrefetcher",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def __iter__(self) -> BatchPrefetcher:
+        return self
+
+    def __next__(self) -> Any:
+        if self.exhausted:
+            raise StopIteration
+        batch, exc = self.queue.get()
+        if exc is not None or batch is _END_OF_BATCHES:
+            self.close()
+        if exc is not None:
+            raise exc
+        if batch is _END_OF_BATCHES:
+            raise StopIteration
+        return batch
+
+    def close(self) -> None:
+        """Stop the background thread and drop all prefetched batches."""
+        self.exhausted = True
+        self.stop_event.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def __del__(self) -> None:
+        if hasattr(self, "thread"):
+            self.close()
+
+
+_END_OF_BATCHES = object()  # sentinel marking exhausted BatchPrefetcher input
+
+
+def _prefetch_batches(
+    batches: Iterator[Any],
+    batch_queue: queue.Queue[tuple[Any, BaseException | None]],
+    stop_event: threading.Event,
+) -> None:
+    """Background thread target of BatchPrefetcher."""
+
+    def put(item: tuple[Any, BaseException | None]) -> bool:
+        # wake up regularly to notice when the consumer stopped iterating
+        while not stop_event.is_set():
+            try:
+                batch_queue.put(item, timeout=0.05)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    try:
+        for batch in batches:
+            if not put((batch, None)):
+                return
+    except Exception as exc:  # re-raised in the consuming thread
+        put((None, exc))
+        return
+    put((_END_OF_BATCHES, None))
+
+
+class BudgetBatchSampler(Sampler[list[int]]):
+    """Batch sampler packing graphs into batches of at most max_nodes nodes and/or
+    max_edges edges instead of a fixed number of samples.
+
+    A fixed batch size gives very uneven batches when graph sizes vary, e.g. 128
+    large CGCNN cells can have 100x the edges of 128 binaries. Budgets bound the
+    memory of every batch instead. Rows are visited in (shuffled) order and a new
+    batch is started whenever the next row would exceed a budget. Rows exceeding a
+    budget on their own get a batch to themselves.
+
+    Can be passed as batch_sampler to InMemoryDataLoader or torch DataLoader. Since
+    batches hold different numbers of samples, BaseModelClass.evaluate() weights
+    per-batch metrics by sample count.
+    """
+
+    def __init__(
+        self,
+        n_nodes: Sequence[int],
+        n_edges: Sequence[int] | None = None,
+        max_nodes: int | None = None,
+        max_edges: int | None = None,
+        max_samples: int | None = None,
+        shuffle: bool = True,
+        seed: int | None = None,
+    ) -> None:
+        """Initialize the sampler.
+
+        Args:
+            n_nodes (Sequence[int]): Number of nodes of each graph.
+            n_edges (Sequence[int], optional): Number of edges of each graph. Required
+                if max_edges is set. Defaults to None.
+            max_nodes (int, optional): Maximum number of nodes per batch. Defaults to
+                None meaning no limit.
+            max_edges (int, optional): Maximum number of edges per batch. Defaults to
+                None meaning no limit.
+            max_samples (int, optional): Maximum number of graphs per batch. Defaults
+                to None meaning no limit.
+            shuffle (bool, optional): Whether to pack rows in a new random order every
+                epoch. Defaults to True.
+            seed (int, optional): Seed which together with the epoch seeds the
+                shuffle of every epoch, required when sharding batches across
+                data-parallel ranks. Defaults to None meaning the global NumPy RNG
+                like InMemoryDataLoader.
+        """
+        budgets = {"max_nodes": max_nodes, "max_edges": max_edges}
+        if all(budget is None for budget in (*budgets.values(), max_samples)):
+            raise ValueError("Set at least one of max_nodes, max_edges, max_samples")
+        budgets["max_samples"] = max_samples
+        for key, budget in budgets.items():
+            if budget is not None and budget < 1:
+                raise ValueError(f"{key}={budget} must be positive")
+        if max_edges is not None and n_edges is None:
+            raise ValueError("n_edges is required to limit the number of edges")
+
+        self.n_nodes = np.asarray(n_nodes, dtype=np.int64)
+        self.n_edges = (
+            np.zeros_like(self.n_nodes)
+            if n_edges is None
+            else np.asarray(n_edges, dtype=np.int64)
+        )
+        if self.n_nodes.shape != self.n_edges.shape:
+            raise ValueError(
+                f"n_nodes and n_edges must have the same length, got "
+                f"{len(self.n_nodes)} and {len(self.n_edges)}"
+            )
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        self.max_samples = max_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches: list[list[int]] | None = None  # batches of the latest epoch
+
+    @classmethod
+    def from_dataset(cls, dataset: Dataset | Subset, **kwargs: Any) -> BudgetBatchSampler:
+        """Create a sampler for a graph dataset implementing graph_sizes().
+
+        Args:
+            dataset (Dataset | Subset): CompositionData, WyckoffData or
+                CrystalGraphData or a Subset of one. The sampler yields indices into
+                the Subset.
+            **kwargs: Passed to BudgetBatchSampler, e.g. max_nodes and max_edges.
+
+        Returns:
+            BudgetBatchSampler: Sampler over the rows of dataset.
+        """
+        dataset, rows = subset_rows(dataset)
+        if not hasattr(dataset, "graph_sizes"):
+            raise ValueError(f"{type(dataset).__name__} does not implement graph_sizes()")
+        n_nodes, n_edges = dataset.graph_sizes()
+        return cls(n_nodes[rows], n_edges[rows], **kwargs)
+
+    def _pack(self, rows: np.ndarray) -> list[list[int]]:
+        """Greedily pack rows in the given order into batches within budget."""
+        max_nodes, max_edges, max_samples = (
+            math.inf if budget is None else budget
+            for budget in (self.max_nodes, self.max_edges, self.max_samples)
+        )
+        batches: list[list[int]] = []
+        batch: list[int] = []
+        batch_nodes = batch_edges = 0
+        for row, n_nodes, n_edges in zip(
+            rows.tolist(), self.n_nodes[rows].tolist(), self.n_edges[rows].tolist()
+        ):
+            if batch and (
+                batch_nodes + n_nodes > max_nodes
+                or batch_edges + n_edges > max_edges
+                or len(batch) >= max_samples
+            ):
+                batches.append(batch)
+                batch, batch_nodes, batch_edges = [], 0, 0
+            batch.append(row)
+            batch_nodes += n_nodes
+            batch_edges += n_edges
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch which seeds the shuffle of the next iterator, like
+        InMemoryDataLoader.set_epoch().
+        """
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[list[int]]:
+        epoch = self.epoch
+        self.epoch += 1
+        rng = (
+            np.random if self.seed is None else np.random.default_rng([self.seed, epoch])
+        )
+        n_rows = len(self.n_nodes)
+        rows = rng.permutation(n_rows) if self.shuffle else np.arange(n_rows)
+        self.batches = self._pack(rows)
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        """Get the number of batches of the latest epoch (or of packing the rows in
+        dataset order if no epoch was drawn yet). Shuffled epochs can differ by a few
+        batches.
+        """
+        if self.batches is None:
+            self.batches = self._pack(np.arange(len(self.n_nodes)))
+        return len(self.batches)
+
+
+def subset_rows(dataset: Dataset | Subset) -> tuple[Dataset, np.ndarray]:
+    """Unwrap (nested) Subsets into their underlying dataset and row indices.
+
+    Args:
+        dataset (Dataset | Subset): Dataset or Subset of one.
+
+    Returns:
+        tuple[Dataset, np.ndarray]: Underlying dataset and the indices of its rows
+            in the Subset.
+    """
+    rows = np.arange(len(dataset))
+    while isinstance(dataset, Subset):
+        rows = np.asarray(dataset.indices)[rows]
+        dataset = dataset.dataset
+    return dataset, rows
+
+
+class ParquetShardDataset(IterableDataset):
+    """Stream samples out of a directory of Parquet shards without loading the whole
+    dataset into memory.
+
+    Row groups are read one at a time and passed as a DataFrame to featurize, which
+    returns a map-style dataset (e.g. CompositionData) whose samples are then yielded
+    one by one. Featurizing the next row groups happens on a background thread, at
+    most prefetch of them are held in memory ahead of the one being consumed.
+
+    For training, shuffle=True shuffles the order of row groups every epoch and mixes
+    samples across row groups with a shuffle buffer. Like DistributedSampler, call
+    set_epoch() at the start of every epoch to get a different order per epoch. With
+    num_workers > 0, each DataLoader worker streams every num_workers-th row group of
+    the (shuffled) list, so every sample is seen exactly once per epoch.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike | Sequence[str],
+        featurize: Callable[[pd.DataFrame], Sequence[Any]],
+        columns: Sequence[str] | None = None,
+        shuffle: bool = False,
+        shuffle_buffer: int = 1024,
+        prefetch: int = 1,
+        seed: int = 0,
+    ) -> None:
+        """Index the row groups of all shards.
+
+        Args:
+            path (str | os.PathLike | Sequence[str]): Directory holding *.parquet
+                shards, a single Parquet file or a list of them.
+            featurize (Callable[[pd.DataFrame], Sequence]): Turns the DataFrame of one
+                row group into a sequence of samples. Must be picklable to be used
+                with DataLoader workers, e.g. a functools.partial of a Dataset class.
+            columns (Sequence[str], optional): Columns to read. Defaults to None
+                meaning all columns.
+            shuffle (bool, optional): Whether to shuffle row groups and samples.
+                Defaults to False.
+            shuffle_buffer (int, optional): Number of samples to draw randomly from
+                if shuffle=True. Larger buffers mix samples from more row groups at
+                the cost of memory. Defaults to 1024.
+            prefetch (int, optional): Number of row groups to read and featurize
+                ahead on a background thread. 0 featurizes them synchronously.
+                Defaults to 1.
+            seed (int, optional): Seed for shuffling. Defaults to 0.
+        """
+        if pq is None:
+            raise ImportError("pyarrow is required to stream Parquet shards")
+        if shuffle_buffer < 1:
+            raise ValueError(f"{shuffle_buffer=} must be positive")
+
+        if isinstance(path, (str, os.PathLike)):
+            path = os.fspath(path)
+            files = sorted(glob(f"{path}/*.parquet")) if os.path.isdir(path) else [path]
+        else:
+            files = list(map(os.fspath, path))
+        if len(files) == 0:
+            raise ValueError(f"No Parquet shards found in {path=}")
+
+        self.row_groups: list[tuple[str, int]] = []
+        self.n_rows = 0
+        for file in files:
+            metadata = pq.ParquetFile(file).metadata
+            self.row_groups += [(file, idx) for idx in range(metadata.num_row_groups)]
+            self.n_rows += metadata.num_rows
+
+        self.featurize = featurize
+        self.columns = None if columns is None else list(columns)
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch = prefetch
+        self.seed = seed
+        self.epoch = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(n_row_groups={len(self.row_groups)}, "
+            f"n_rows={self.n_rows}, shuffle={self.shuffle})"
+        )
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch which seeds the shuffled order of row groups and samples."""
+        self.epoch = epoch
+
+    def worker_row_groups(self) -> list[tuple[str, int]]:
+        """Row groups streamed by the current DataLoader worker this epoch.
+
+        Returns:
+            list[tuple[str, int]]: Paths of the shards and indices of the row groups.
+        """
+        row_groups = self.row_groups
+        if self.shuffle:
+            # same seed in every worker so their row groups are disjoint
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(
+                len(row_groups)
+            )
+            row_groups = [row_groups[idx] for idx in order]
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            row_groups = row_groups[worker_info.id :: worker_info.num_workers]
+        return row_groups
+
+    def read_row_group(self, file: str, idx: int) -> pd.DataFrame:
+        """Read a single row group into a DataFrame, restoring its index if stored."""
+        table = pq.ParquetFile(file).read_row_group(
+            idx, columns=self.columns, use_pandas_metadata=True
+        )
+        return table.to_pandas()
+
+    def __iter__(self) -> Iterator[Any]:
+        datasets: Iterator[Sequence[Any]] = (
+            self.featurize(self.read_row_group(*row_group))
+            for row_group in self.worker_row_groups()
+        )
+        if self.prefetch > 0:
+            datasets = BatchPrefetcher(datasets, depth=self.prefetch)
+        samples = (dataset[idx] for dataset in datasets for idx in range(len(dataset)))
+        if not self.shuffle:
+            yield from samples
+            return
+
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+        buffer: list[Any] = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            # emit a random buffered sample and put the new one in its place
+            idx = rng.integers(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        for idx in rng.permutation(len(buffer)):
+            yield buffer[idx]
+
+
+def nbytes(obj: Any) -> int:
+    """Get the number of bytes held by all tensors and arrays in a (nested) sample.
+
+    Args:
+        obj (Any): Tensor, array or (nested) tuple/list/dict thereof. Other objects
+            like identifier strings are counted as 0 bytes.
+
+    Returns:
+        int: Total number of bytes.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(nbytes(item) for item in obj.values())
+    return 0
+
+
+class FeatureCache:
+    """Bounded least-recently-used store for featurized dataset samples.
+
+    Replaces functools.cache on Dataset.__getitem__ which is unbounded and keeps the
+    dataset alive. Each dataset owns its own FeatureCache so samples are freed with
+    the dataset. Note that every DataLoader worker process holds its own copy of the
+    cache (and its counters). Use SharedMemoryFeatureCache to share one copy.
+    """
+
+    def __init__(self, max_bytes: int | None = None, max_items: int | None = None):
+        """Create an empty feature cache.
+
+        Args:
+            max_bytes (int, optional): Memory budget for tensors and arrays held in
+                the cache. Least recently used samples are evicted once exceeded.
+                Defaults to None meaning no limit.
+            max_items (int, optional): Maximum number of cached samples. Defaults to
+                None meaning no limit.
+        """
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.store: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.store
+
+    def __repr__(self) -> str:
+        stats = ", ".join(f"{key}={val}" for key, val in self.stats.items())
+        return f"{type(self).__name__}({stats})"
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        """Counters for cache hits, misses, evictions and current size."""
+        n_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+            "evictions": self.evictions,
+            "items": len(self),
+            "nbytes": self.nbytes,
+        }
+
+    def get(self, key: Hashable, compute: Callable[[Hashable], Any]) -> Any:
+        """Get the cached sample for key, computing and storing it on a miss.
+
+        Args:
+            key (Hashable): Cache key, usually the dataset index.
+            compute (Callable): Function mapping key to the sample to be cached.
+
+        Returns:
+            Any: Cached or freshly computed sample.
+        """
+        if key in self.store:
+            self.hits += 1
+            self.store.move_to_end(key)
+            return self.store[key][0]
+
+        self.misses += 1
+        value = self.prepare(compute(key))
+        size = nbytes(value)
+        if self.max_bytes is None or size <= self.max_bytes:
+            self.store[key] = (value, size)
+            self.nbytes += size
+            self.evict()
+        return value
+
+    def prepare(self, value: Any) -> Any:
+        """Hook for subclasses to transform samples before they are stored."""
+        return value
+
+    def evict(self) -> None:
+        """Drop least recently used samples until the cache is within budget."""
+        while self.store and (
+            (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            or (self.max_items is not None and len(self.store) > self.max_items)
+        ):
+            _, (_, size) = self.store.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def warm(self, keys: Iterable[Hashable], compute: Callable[[Hashable], Any]) -> None:
+        """Fill the cache ahead of time, e.g. before DataLoader workers are started.
+
+        Args:
+            keys (Iterable[Hashable]): Keys to compute, usually range(len(dataset)).
+            compute (Callable): Function mapping key to the sample to be cached.
+        """
+        for key in keys:
+            self.get(key, compute)
+
+    def clear(self) -> None:
+        """Remove all samples and reset counters."""
+        self.store.clear()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+
+class SharedMemoryFeatureCache(FeatureCache):
+    """FeatureCache that moves sample tensors into shared memory.
+
+    When a dataset using this cache is sent to DataLoader worker processes (fork or
+    spawn), cached tensors are passed as shared-memory handles so all workers on a
+    node read one copy instead of each holding a duplicate. Call warm() in the main
+    process before creating workers. Samples first computed inside a worker are only
+    visible to that worker.
+    """
+
+    def prepare(self, value: Any) -> Any:
+        """Move all tensors in a (nested) sample into shared memory."""
+        if isinstance(value, torch.Tensor):
+            return value.share_memory_()
+        if isinstance(value, tuple):
+            return tuple(self.prepare(item) for item in value)
+        if isinstance(value, list):
+            return [self.prepare(item) for item in value]
+        return value
+
+
+class SlimPickleMixin:
+    """Make a dataset cheap to send to DataLoader worker processes.
+
+    With the spawn or forkserver start method, every worker receives a pickled copy
+    of the dataset. __getstate__ therefore drops the attributes in _pickle_exclude
+    (e.g. JSON embedding dicts only needed in __init__), keeps only the index of the
+    dataframe and moves numeric NumPy arrays and tensors into shared memory. torch's
+    multiprocessing pickler then sends them as shared-memory handles, so all workers
+    read one copy instead of each unpickling its own. Memory-mapped arrays are sent
+    as their file path and mapped again. The attributes of the dataset itself are
+    rebound to the shared-memory arrays, so they are moved only once and reused when
+    the dataset is pickled again for the next worker or epoch.
+
+    With plain pickle (e.g. torch.save) shared tensors are serialized by value, so
+    the slim state still round-trips. The dataframe of an unpickled dataset has no
+    columns, all per-sample data lives in the compact arrays built in __init__.
+    """
+
+    _pickle_exclude: tuple[str, ...] = ()
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = {}
+        for key, value in list(self.__dict__.items()):
+            if key in self._pickle_exclude:
+                continue
+            if isinstance(value, pd.DataFrame):
+                state[key] = value[[]]  # index only, features are stored as arrays
+                continue
+            # rebind the attribute to views of the shared memory so the arrays are
+            # not held twice and are found already shared when pickled again
+            shared = self.__dict__[key] = _move_to_shared_memory(value)
+            state[key] = _share_arrays(shared)
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update({key: _unshare_arrays(val) for key, val in state.items()})
+
+
+class _SharedArray(NamedTuple):
+    """NumPy array moved into a shared-memory tensor for pickling."""
+
+    tensor: Tensor
+
+
+class _MappedArray(NamedTuple):
+    """Memory-mapped .npy file to map again after unpickling."""
+
+    filename: str
+
+
+def _is_mapped(value: np.ndarray) -> bool:
+    """Whether value is a whole .npy file loaded by np.load(mmap_mode='r')."""
+    return isinstance(value, np.memmap) and isinstance(value.base, mmap.mmap)
+
+
+def _shared_tensor(value: np.ndarray) -> Tensor | None:
+    """Shared-memory tensor of which value is the full NumPy view, else None."""
+    base = value.base
+    if (
+        isinstance(base, torch.Tensor)
+        and base.is_shared()
+        and base.data_ptr() == value.ctypes.data
+        and tuple(base.shape) == value.shape
+        and value.flags.c_contiguous
+    ):
+        return base
+    return None
+
+
+def _move_to_shared_memory(value: Any) -> Any:
+    """Recursively replace arrays and tensors in value with copies in shared memory,
+    NumPy arrays by NumPy views of them. Values already shared are returned as is.
+    """
+    if isinstance(value, np.ndarray) and value.dtype.kind in "biuf":
+        if _is_mapped(value) or _shared_tensor(value) is not None:
+            return value
+        return torch.from_numpy(np.ascontiguousarray(value)).share_memory_().numpy()
+    if isinstance(value, torch.Tensor):
+        return value.share_memory_() if value.device.type == "cpu" else value
+    if isinstance(value, dict):
+        return {key: _move_to_shared_memory(val) for key, val in value.items()}
+    if isinstance(value, list):
+        return [_move_to_shared_memory(val) for val in value]
+    if type(value) is tuple:
+        return tuple(_move_to_shared_memory(val) for val in value)
+    return value
+
+
+def _share_arrays(value: Any) -> Any:
+    """Recursively replace arrays in value, as returned by _move_to_shared_memory,
+    with handles to pickle.
+    """
+    if isinstance(value, np.ndarray) and _is_mapped(value):
+        return _MappedArray(value.filename)
+    if isinstance(value, np.ndarray) and value.dtype.kind in "biuf":
+        return _SharedArray(_shared_tensor(value))
+    if isinstance(value, dict):
+        return {key: _share_arrays(val) for key, val in value.items()}
+    if isinstance(value, list):
+        return [_share_arrays(val) for val in value]
+    if type(value) is tuple:
+        return tuple(_share_arrays(val) for val in value)
+    return value
+
+
+def _unshare_arrays(value: Any) -> Any:
+    """Inverse of _share_arrays, NumPy arrays are views of the shared memory."""
+    if isinstance(value, _SharedArray):
+        return value.tensor.numpy()
+    if isinstance(value, _MappedArray):
+        return np.load(value.filename, mmap_mode="r")
+    if isinstance(value, dict):
+        return {key: _unshare_arrays(val) for key, val in value.items()}
+    if isinstance(value, list):
+        return [_unshare_arrays(val) for val in value]
+    if type(value) is tuple:
+        return tuple(_unshare_arrays(val) for val in value)
+    return value
+
+
+def load_element_embedding(elem_embedding: str) -> dict[str, list[float]]:
+    """Load element features from a built-in embedding or a JSON file.
+
+    Args:
+        elem_embedding (str): One of "matscholar200", "cgcnn92", "megnet16",
+            "onehot112" or path to a JSON file mapping element symbols to features.
+
+    Returns:
+        dict[str, list[float]]: Map from element symbols to features.
+    """
+    if elem_embedding in ELEM_EMBEDDINGS:
+        elem_embedding = f"{PKG_DIR}/embeddings/element/{elem_embedding}.json"
+
+    with open(elem_embedding) as file:
+        return json.load(file)
+
+
+def element_feature_table(
+    elem_features: dict[str, Sequence[float]], dtype: np.dtype = np.float32
+) -> np.ndarray:
+    """Arrange element features into a lookup table indexed by atomic number.
+
+    Args:
+        elem_features (dict[str, list[float]]): Map from element symbols to features.
+            Keys that are not element symbols (e.g. "Null") are ignored.
+        dtype (np.dtype, optional): dtype of the table. Defaults to np.float32.
+
+    Returns:
+        np.ndarray: Array of shape (MAX_Z + 1, n_features). Rows of elements missing
+            from elem_features are NaN.
+    """
+    emb_len = len(next(iter(elem_features.values())))
+    table = np.full((MAX_Z + 1, emb_len), np.nan, dtype=dtype)
+    for key, value in elem_features.items():
+        if Element.is_valid_symbol(key):
+            table[Element(key).Z] = value
+    return table
+
+
+def get_target_columns(df: pd.DataFrame, task_dict: dict[str, str]) -> list[Tensor]:
+    """Convert target columns to tensors once so samples are pure tensor indexing.
+
+    Args:
+        df (pd.DataFrame): Dataframe holding the targets.
+        task_dict (dict[str, "regression" | "classification"]): Map from target
+            names to task type.
+
+    Returns:
+        list[Tensor]: float32 tensor for each regression and int64 tensor for each
+            classification target, each of shape (len(df),).
+    """
+    targets = []
+    for target, task in task_dict.items():
+        if task == "regression":
+            targets.append(torch.tensor(df[target].to_numpy(dtype=float)).float())
+        elif task == "classification":
+            targets.append(torch.tensor(df[target].to_numpy(dtype=np.int64)))
+    return targets
+
+
+def get_identifier_rows(
+    df: pd.DataFrame, identifiers: Sequence[str]
+) -> list[tuple[Any, ...]]:
+    """Get the identifiers of each row as a tuple of Python objects.
+
+    Args:
+        df (pd.DataFrame): Dataframe holding the identifier columns.
+        identifiers (list[str]): Column names.
+
+    Returns:
+        list[tuple]: Identifier values for each row of df.
+    """
+    if len(identifiers) == 0:
+        return [()] * len(df)
+    return list(zip(*(df[col].tolist() for col in identifiers)))
+
+
+@lru_cache(maxsize=1024)
+def fully_connected_edges(n_nodes: int, n_graphs: int = 1) -> tuple[Tensor, Tensor]:
+    """Edge indices of n_graphs disjoint fully connected graphs (with self-loops)
+    of n_nodes each with nodes numbered consecutively, e.g. the augmentations of a
+    Wren sample.
+
+    Templates are cached per (n_nodes, n_graphs) and shared by all callers so they
+    must not be modified in place.
+
+    Args:
+        n_nodes (int): Number of nodes per graph.
+        n_graphs (int, optional): Number of graphs. Defaults to 1.
+
+    Returns:
+        tuple[LongTensor, LongTensor]: self and neighbor index of each edge, both of
+            shape (n_graphs * n_nodes**2,).
+    """
+    offsets = torch.arange(n_graphs).repeat_interleave(n_nodes**2) * n_nodes
+    self_idx = torch.arange(n_nodes).repeat_interleave(n_nodes).repeat(n_graphs)
+    nbr_idx = torch.arange(n_nodes).repeat(n_nodes * n_graphs)
+    return self_idx + offsets, nbr_idx + offsets
+
+
+def batch_fully_connected_edges(n_nodes: LongTensor) -> tuple[Tensor, Tensor]:
+    """Edge indices of a batch of fully connected graphs (with self-loops) in one go.
+
+    Gives the same edges as concatenating fully_connected_edges(n) of each graph
+    shifted by the number of nodes in the graphs before it.
+
+    Args:
+        n_nodes (LongTensor): Number of nodes of each graph in the batch.
+
+    Returns:
+        tuple[LongTensor, LongTensor]: self and neighbor index of each edge, both of
+            shape (sum(n_nodes**2),).
+    """
+    n_edges = n_nodes**2
+    total_edges = int(n_edges.sum())
+    node_offsets = (n_nodes.cumsum(0) - n_nodes).repeat_interleave(
+        n_edges, output_size=total_edges
+    )
+    edge_offsets = (n_edges.cumsum(0) - n_edges).repeat_interleave(
+        n_edges, output_size=total_edges
+    )
+    edge_graph_size = n_nodes.repeat_interleave(n_edges, output_size=total_edges)
+    # position of each edge within its graph's block of n**2 edges
+    edge_pos = torch.arange(total_edges) - edge_offsets
+    self_idx = node_offsets + edge_pos.div(edge_graph_size, rounding_mode="floor")
+    nbr_idx = node_offsets + edge_pos % edge_graph_size
+    return self_idx, nbr_idx
+
+
+def batch_edge_offsets(n_nodes: LongTensor, n_edges: LongTensor) -> LongTensor:
+    """Node index offset of each edge when concatenating graphs into a batch.
+
+    Args:
+        n_nodes (LongTensor): Number of nodes of each graph in the batch.
+        n_edges (LongTensor): Number of edges of each graph in the batch.
+
+    Returns:
+        LongTensor: Number of nodes in all preceding graphs for each edge, shape
+            (sum(n_edges),). Add to per-graph self/neighbor indices to batch them.
+    """
+    return (n_nodes.cumsum(0) - n_nodes).repeat_interleave(
+        n_edges, output_size=int(n_edges.sum())
+    )
+
+
+def batch_ptr(n_nodes: LongTensor) -> LongTensor:
+    """CSR offsets of the nodes of each graph when concatenating graphs into a batch.
+
+    Args:
+        n_nodes (LongTensor): Number of nodes of each graph in the batch.
+
+    Returns:
+        LongTensor: Offsets ptr of shape (len(n_nodes) + 1,) such that the nodes of
+            graph i are ptr[i]:ptr[i + 1].
+    """
+    return torch.cat([n_nodes.new_zeros(1), n_nodes.cumsum(0)])
+
+
+def csr_gather(ptr: np.ndarray, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Flat indices of the CSR segments ptr[row]:ptr[row + 1] of the given rows.
+
+    Args:
+        ptr (np.ndarray): Segment offsets of shape (n_rows + 1,).
+        rows (np.ndarray): Rows whose segments to gather, in output order.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Concatenated indices of all segments and the
+            length of each segment.
+    """
+    starts = ptr[rows]
+    counts = ptr[rows + 1] - starts
+    # shift positions in the output to positions in the CSR arrays segment by segment
+    shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return np.arange(len(shifts)) + shifts, counts
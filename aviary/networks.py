@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import math
 from typing import TYPE_CHECKING
 
+import torch
+import torch.nn.functional as F
 from torch import Tensor, nn
 
 if TYPE_CHECKING:
@@ -127,3 +130,117 @@ class ResidualNetwork(nn.Module):
         output_dim = self.fc_out.out_features
         activation = type(self.acts[0]).__name__
         return f"{type(self).__name__}({input_dim=}, {output_dim=}, {activation=})"
+
+
+class GroupedLinear(nn.Module):
+    """num_heads independent linear layers with stacked weights.
+
+    Applies y[:, h] = x[:, h] @ weight[h].T + bias[h] for all heads in one batched
+    matmul. If the input has no head dimension it is shared by all heads, which is a
+    single GEMM against the weights of all heads concatenated.
+    """
+
+    def __init__(self, in_features: int, out_features: int, num_heads: int) -> None:
+        """Create grouped linear layers.
+
+        Args:
+            in_features (int): Number of input features of each head
+            out_features (int): Number of output features of each head
+            num_heads (int): Number of independent heads
+        """
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.num_heads = num_heads
+        self.weight = nn.Parameter(torch.empty(num_heads, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(num_heads, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self) -> None:
+        """Initialize every head like a separate nn.Linear."""
+        bound = 1 / math.sqrt(self.in_features)
+        for weight in self.weight:
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x: Tensor) -> Tensor:
+        """Map x of shape (N, in_features) or (N, num_heads, in_features) to
+        (N, num_heads, out_features).
+        """
+        if x.dim() == 2:
+            out = F.linear(x, self.weight.flatten(0, 1), self.bias.flatten())
+            return out.view(len(x), self.num_heads, self.out_features)
+        # batched over heads with the rows of each head strided, no copy of x
+        out = torch.baddbmm(
+            self.bias.unsqueeze(1), x.transpose(0, 1), self.weight.transpose(1, 2)
+        )
+        return out.transpose(0, 1)
+
+    def __repr__(self) -> str:
+        in_features, out_features = self.in_features, self.out_features
+        num_heads = self.num_heads
+        return f"{type(self).__name__}({in_features=}, {out_features=}, {num_heads=})"
+
+
+class MultiHeadNetwork(nn.Module):
+    """num_heads independent SimpleNetworks evaluated together.
+
+    The layers are GroupedLinear, so each layer of all heads is one batched matmul
+    instead of one small GEMM per head. Parameter names match those of a
+    SimpleNetwork with an extra leading head dimension.
+    """
+
+    def __init__(
+        self,
+        input_dim: int,
+        output_dim: int,
+        hidden_layer_dims: Sequence[int],
+        num_heads: int,
+        activation: type[nn.Module] = nn.LeakyReLU,
+    ) -> None:
+        """Create a multi-head feed forward neural network.
+
+        Args:
+            input_dim (int): Number of input features
+            output_dim (int): Number of output features of each head
+            hidden_layer_dims (list[int]): List of hidden layer sizes of each head
+            num_heads (int): Number of independent heads
+            activation (type[nn.Module], optional): Which activation function to use.
+                Defaults to nn.LeakyReLU.
+        """
+        super().__init__()
+
+        dims = [input_dim, *list(hidden_layer_dims)]
+
+        self.fcs = nn.ModuleList(
+            GroupedLinear(dims[idx], dims[idx + 1], num_heads)
+            for idx in range(len(dims) - 1)
+        )
+
+        self.acts = nn.ModuleList(activation() for _ in range(len(dims) - 1))
+
+        self.fc_out = GroupedLinear(dims[-1], output_dim, num_heads)
+
+    def forward(self, x: Tensor) -> Tensor:
+        """Map x of shape (N, input_dim) to (N, num_heads, output_dim)."""
+        for fc, act in zip(self.fcs, self.acts):
+            x = act(fc(x))
+
+        return self.fc_out(x)
+
+    def reset_parameters(self) -> None:
+        """Reinitialize network weights using PyTorch defaults."""
+        for fc in self.fcs:
+            fc.reset_parameters()
+
+        self.fc_out.reset_parameters()
+
+    def __repr__(self) -> str:
+        input_dim = self.fcs[0].in_features if self.fcs else self.fc_out.in_features
+        output_dim = self.fc_out.out_features
+        num_heads = self.fc_out.num_heads
+        activation = type(self.acts[0]).__name__ if self.acts else None
+        return (
+            f"{type(self).__name__}({input_dim=}, {output_dim=}, {num_heads=}, "
+            f"{activation=})"
+        )
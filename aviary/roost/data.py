@@ -1,26 +1,44 @@
 from __future__ import annotations
 
-import json
-from functools import cache
+import re
+from collections import defaultdict
+from functools import cache, lru_cache, partial
 from typing import TYPE_CHECKING, Any
 
 import numpy as np
 import torch
-from pymatgen.core import Composition
+from pymatgen.core import Composition, Element
+from pymatgen.core.periodic_table import get_el_sp
 from torch import LongTensor, Tensor
 from torch.utils.data import Dataset
 
-from aviary import PKG_DIR
+from aviary.data import (
+    FeatureCache,
+    ParquetShardDataset,
+    SlimPickleMixin,
+    batch_edge_offsets,
+    batch_fully_connected_edges,
+    batch_ptr,
+    csr_gather,
+    element_feature_table,
+    fully_connected_edges,
+    get_identifier_rows,
+    get_target_columns,
+    load_element_embedding,
+)
 
 if TYPE_CHECKING:
-    from collections.abc import Sequence
+    from collections.abc import Iterable, Sequence
 
     import pandas as pd
 
 
-class CompositionData(Dataset):
+class CompositionData(SlimPickleMixin, Dataset):
     """Dataset class for the Roost composition model."""
 
+    # JSON element embedding is only needed to build elem_fea_table
+    _pickle_exclude = ("elem_features",)
+
     def __init__(
         self,
         df: pd.DataFrame,
@@ -28,6 +46,8 @@ class CompositionData(Dataset):
         elem_embedding: str = "matscholar200",
         inputs: str = "composition",
         identifiers: Sequence[str] = ("material_id", "composition"),
+        feature_cache: FeatureCache | None = None,
+        collate_edges: bool = False,
     ):
         """Data class for Roost models.
 
@@ -43,6 +63,13 @@ class CompositionData(Dataset):
             identifiers (list, optional): df columns for distinguishing data points.
                 Will be copied over into the model's output CSV. Defaults to
                 ["material_id", "composition"].
+            feature_cache (FeatureCache, optional): Store for featurized samples.
+                Pass a FeatureCache with a memory budget to bound memory or a
+                SharedMemoryFeatureCache to share samples across DataLoader workers.
+                Defaults to None meaning an unbounded FeatureCache.
+            collate_edges (bool, optional): If True, samples hold no edge indices and
+                collate_batch builds them for the whole batch at once instead.
+                Defaults to False.
         """
         if len(identifiers) != 2:
             raise AssertionError("Two identifiers are required")
@@ -51,14 +78,47 @@ class CompositionData(Dataset):
         self.task_dict = task_dict
         self.identifiers = list(identifiers)
         self.df = df
+        self.feature_cache = FeatureCache() if feature_cache is None else feature_cache
+        self.collate_edges = collate_edges
 
-        if elem_embedding in ["matscholar200", "cgcnn92", "megnet16", "onehot112"]:
-            elem_embedding = f"{PKG_DIR}/embeddings/element/{elem_embedding}.json"
-
-        with open(elem_embedding) as file:
-            self.elem_features = json.load(file)
+        self.elem_embedding = elem_embedding
+        self.elem_features = load_element_embedding(elem_embedding)
 
         self.elem_emb_len = len(next(iter(self.elem_features.values())))
+        self.elem_fea_table = element_feature_table(self.elem_features)
+
+        # parse all compositions once into flat arrays with per-sample offsets so
+        # samples are built by array slicing without touching the dataframe
+        self.ids = get_identifier_rows(self.df, self.identifiers)
+        self.targets = get_target_columns(self.df, self.task_dict)
+
+        n_elems, elem_z, elem_weights = [], [], []
+        el_amts_col = parse_formulas(self.df[self.inputs])
+        for el_amts, material_ids in zip(el_amts_col, self.ids):
+            if len(el_amts) == 0:
+                raise ValueError(
+                    f"{list(material_ids)} composition cannot be parsed into elements"
+                )
+            elements, amounts = zip(*el_amts)
+            try:
+                elem_z += [Element(el).Z for el in elements]
+            except ValueError as exc:
+                raise ValueError(
+                    f"{list(material_ids)} composition cannot be parsed into elements"
+                ) from exc
+            weights = np.array(amounts)
+            elem_weights.append(weights / weights.sum())
+            n_elems.append(len(elements))
+
+        self.elem_ptr = np.cumsum([0, *n_elems], dtype=np.int64)
+        self.elem_z = np.array(elem_z, dtype=np.int64)
+        self.elem_weights = np.concatenate(elem_weights or [np.zeros(0)])[:, None]
+
+        missing = np.isnan(self.elem_fea_table[self.elem_z]).any(axis=1)
+        if missing.any():
+            bad_rows = np.searchsorted(self.elem_ptr, missing.nonzero()[0], "right") - 1
+            bad_ids = [list(self.ids[row]) for row in np.unique(bad_rows)]
+            raise ValueError(f"{bad_ids} contain element types not in embedding")
 
         self.n_targets = []
         for target, task in self.task_dict.items():
@@ -75,68 +135,227 @@ class CompositionData(Dataset):
         df_repr = f"cols=[{', '.join(self.df.columns)}], len={len(self.df)}"
         return f"{type(self).__name__}({df_repr}, task_dict={self.task_dict})"
 
-    # Cache data for faster training
-    @cache  # noqa: B019
     def __getitem__(self, idx: int):
-        """Get an entry out of the Dataset.
+        """Get an entry out of the Dataset, featurizing it on first access.
 
         Args:
             idx (int): index of entry in Dataset
 
         Returns:
             tuple: containing
-            - tuple[Tensor, Tensor, LongTensor, LongTensor]: Roost model inputs
+            - tuple[Tensor, LongTensor, LongTensor, LongTensor]: Roost model inputs
+              (element weights, atomic numbers, self and neighbor indices). The
+              indices are left out if collate_edges is True.
             - list[Tensor | LongTensor]: regression or classification targets
             - list[str | int]: identifiers like material_id, composition
         """
-        row = self.df.iloc[idx]
-        composition = row[self.inputs]
-        material_ids = row[self.identifiers].to_list()
-
-        comp_dict = Composition(composition).get_el_amt_dict()
-        elements = list(comp_dict)
-
-        weights = list(comp_dict.values())
-        weights = np.atleast_2d(weights).T / np.sum(weights)
-
-        try:
-            elem_fea = np.vstack([self.elem_features[element] for element in elements])
-        except AssertionError as exc:
-            raise AssertionError(
-                f"{material_ids} contains element types not in embedding"
-            ) from exc
-        except ValueError as exc:
-            raise ValueError(
-                f"{material_ids} composition cannot be parsed into elements"
-            ) from exc
-
-        n_elems = len(elements)
-        self_idx = []
-        nbr_idx = []
-        for elem_idx in range(n_elems):
-            self_idx += [elem_idx] * n_elems
-            nbr_idx += list(range(n_elems))
-
-        # convert all data to tensors
-        elem_weights = Tensor(weights)
-        elem_fea = Tensor(elem_fea)
-        self_idx = LongTensor(self_idx)
-        nbr_idx = LongTensor(nbr_idx)
-
-        targets = []
-        for target in self.task_dict:
-            if self.task_dict[target] == "regression":
-                targets.append(Tensor([row[target]]))
-            elif self.task_dict[target] == "classification":
-                targets.append(LongTensor([row[target]]))
-
-        return (
-            (elem_weights, elem_fea, self_idx, nbr_idx),
-            targets,
-            *material_ids,
+        return self.feature_cache.get(idx, self.featurize)
+
+    def featurize(self, idx: int):
+        """Featurize a single entry of the Dataset without caching.
+
+        Args:
+            idx (int): index of entry in Dataset
+
+        Returns:
+            tuple: same as __getitem__
+        """
+        idx = range(len(self))[idx]  # resolve negative indices
+        start, end = self.elem_ptr[idx], self.elem_ptr[idx + 1]
+
+        elem_weights = torch.tensor(self.elem_weights[start:end], dtype=torch.float32)
+        # atomic numbers, element features are looked up inside the model
+        elem_fea = torch.tensor(self.elem_z[start:end])
+        inputs = (elem_weights, elem_fea)
+        if not self.collate_edges:
+            inputs += fully_connected_edges(int(end - start))
+
+        targets = [col[idx].reshape(1) for col in self.targets]
+        material_ids = self.ids[idx]
+
+        return (inputs, targets, *material_ids)
+
+    def graph_sizes(self) -> tuple[np.ndarray, np.ndarray]:
+        """Number of nodes and edges of each entry's fully connected element graph,
+        see BudgetBatchSampler.
+        """
+        n_nodes = np.diff(self.elem_ptr)
+        return n_nodes, n_nodes**2
+
+    def get_batch(self, rows: Sequence[int] | np.ndarray) -> tuple[Any, ...]:
+        """Gather a batch straight from the CSR arrays with vectorized ops.
+
+        Gives the same result as collate_batch([self[row] for row in rows]) without
+        per-sample tensors, see InMemoryDataLoader.from_dataset().
+
+        Args:
+            rows (list[int] | np.ndarray): Indices of the entries in the batch.
+
+        Returns:
+            tuple: same as collate_batch()
+        """
+        rows = np.arange(len(self))[rows]  # resolve negative indices
+        elem_idx, n_elems = csr_gather(self.elem_ptr, rows)
+
+        n_sites = torch.from_numpy(n_elems)
+        self_idx, nbr_idx = batch_fully_connected_edges(n_sites)
+        inputs = (
+            torch.from_numpy(self.elem_weights[elem_idx]).float(),
+            torch.from_numpy(self.elem_z[elem_idx]),
+            self_idx,
+            nbr_idx,
+            torch.arange(len(rows)).repeat_interleave(n_sites),
+            batch_ptr(n_sites),
+        )
+        targets = tuple(col[torch.from_numpy(rows)][:, None] for col in self.targets)
+
+        return (inputs, targets, *zip(*(self.ids[row] for row in rows)))
+
+
+# formula grammar of pymatgen.core.Composition
+RE_FORMULA_INVALID = re.compile(r"[\s\d.*/]*$")
+RE_FORMULA_GROUP = re.compile(r"([A-Z][a-z]*)\s*([-*\.e\d]*)")
+RE_FORMULA_PAREN = re.compile(r"\(([^\(\)]+)\)\s*([\.e\d]*)")
+# normalize brackets to parentheses and drop @ in metallofullerenes like Y3N@C80
+FORMULA_TRANSLATION = str.maketrans("[]{}", "()()", "@")
+AMOUNT_TOLERANCE = 1e-8  # same as Composition.amount_tolerance
+
+
+class CompositionStreamData(ParquetShardDataset):
+    """Stream CompositionData samples out of Parquet shards too large to fit in
+    memory, see ParquetShardDataset. Use with torch.utils.data.DataLoader and
+    collate_batch like CompositionData.
+    """
+
+    def __init__(
+        self,
+        path: str | Sequence[str],
+        task_dict: dict[str, str],
+        inputs: str = "composition",
+        identifiers: Sequence[str] = ("material_id", "composition"),
+        shuffle: bool = False,
+        shuffle_buffer: int = 1024,
+        prefetch: int = 1,
+        seed: int = 0,
+        **kwargs: Any,
+    ) -> None:
+        """Index the row groups of all shards.
+
+        Args:
+            path (str | Sequence[str]): Directory holding *.parquet shards, a single
+                Parquet file or a list of them.
+            task_dict (dict[str, "regression" | "classification"]): Map from target
+                names to task type.
+            inputs (str, optional): Column holding the compositions. Defaults to
+                "composition".
+            identifiers (list, optional): Columns for distinguishing data points.
+                Defaults to ("material_id", "composition").
+            shuffle (bool, optional): Whether to shuffle row groups and samples.
+                Defaults to False.
+            shuffle_buffer (int, optional): Number of samples to draw randomly from
+                if shuffle=True. Defaults to 1024.
+            prefetch (int, optional): Number of row groups to featurize ahead on a
+                background thread. Defaults to 1.
+            seed (int, optional): Seed for shuffling. Defaults to 0.
+            **kwargs: Passed to CompositionData, e.g. elem_embedding.
+        """
+        super().__init__(
+            path,
+            featurize=partial(
+                CompositionData,
+                task_dict=task_dict,
+                inputs=inputs,
+                identifiers=identifiers,
+                **kwargs,
+            ),
+            columns=list(dict.fromkeys([inputs, *identifiers, *task_dict])),
+            shuffle=shuffle,
+            shuffle_buffer=shuffle_buffer,
+            prefetch=prefetch,
+            seed=seed,
         )
 
 
+@cache
+def _element_symbol(symbol: str) -> str:
+    """Canonical element symbol as used by pymatgen, e.g. D -> H."""
+    return get_el_sp(symbol).symbol
+
+
+def _sum_formula_group(formula: str, factor: float) -> dict[str, float]:
+    """Sum the amounts of each element in a formula without parentheses."""
+    amounts: dict[str, float] = defaultdict(float)
+    for symbol, amount in RE_FORMULA_GROUP.findall(formula):
+        amounts[symbol] += (float(amount) if amount else 1.0) * factor
+    if RE_FORMULA_GROUP.sub("", formula).strip():
+        raise ValueError(f"{formula} is an invalid formula!")
+    return amounts
+
+
+@lru_cache(maxsize=2**16)
+def parse_formula(formula: str) -> tuple[tuple[str, float], ...]:
+    """Parse a chemical formula into element symbols and amounts.
+
+    Lightweight drop-in for Composition(formula).get_el_amt_dict().items() that
+    supports element symbols, counts, nested parentheses/brackets and fractional or
+    scientific amounts with the same output and element order as pymatgen (except
+    that amounts of isotopes like D and H are summed). Results are memoized in a
+    bounded LRU cache, see parse_formula.cache_info() for hit/miss counts.
+
+    Args:
+        formula (str): Chemical formula, e.g. Fe2O3, Li3Fe2(PO4)3 or Ba0.5Sr0.5TiO3.
+
+    Raises:
+        ValueError: If the formula cannot be parsed or contains negative amounts.
+
+    Returns:
+        tuple[tuple[str, float], ...]: (element symbol, amount) pairs in order of
+            first appearance. Immutable since it is shared by all callers.
+    """
+    if RE_FORMULA_INVALID.match(formula):
+        raise ValueError(f"Invalid {formula=}")
+
+    formula = formula.translate(FORMULA_TRANSLATION)
+
+    # expand innermost parentheses until none are left
+    while match := RE_FORMULA_PAREN.search(formula):
+        factor = float(match[2]) if match[2] else 1.0
+        group = _sum_formula_group(match[1], factor)
+        expanded = "".join(f"{symbol}{amount}" for symbol, amount in group.items())
+        formula = formula[: match.start()] + expanded + formula[match.end() :]
+
+    el_amts: dict[str, float] = defaultdict(float)
+    for symbol, amount in _sum_formula_group(formula, 1.0).items():
+        if amount < -AMOUNT_TOLERANCE:
+            raise ValueError(f"Amounts in {formula=} cannot be negative!")
+        if abs(amount) >= AMOUNT_TOLERANCE:
+            el_amts[_element_symbol(symbol)] += amount
+
+    return tuple(el_amts.items())
+
+
+def parse_formulas(
+    formulas: Iterable[str | Composition],
+) -> list[tuple[tuple[str, float], ...]]:
+    """Parse many formulas at once, parsing each unique formula only once.
+
+    Args:
+        formulas (Iterable[str | Composition]): Formulas, e.g. a DataFrame column.
+            pymatgen Compositions are also accepted.
+
+    Returns:
+        list[tuple[tuple[str, float], ...]]: parse_formula() output for each formula.
+    """
+    formulas = list(formulas)
+    parsed = {}
+    for formula in dict.fromkeys(formulas):
+        if isinstance(formula, str):
+            parsed[formula] = parse_formula(formula)
+        else:
+            parsed[formula] = tuple(Composition(formula).get_el_amt_dict().items())
+    return [parsed[formula] for formula in formulas]
+
+
 def collate_batch(
     samples: tuple[
         tuple[Tensor, Tensor, LongTensor, LongTensor],
@@ -153,60 +372,48 @@ def collate_batch(
             - nbr_fea (Tensor):
             - self_idx (LongTensor):
             - nbr_idx (LongTensor):
+              self_idx and nbr_idx may be left out to build the edges of the whole
+              batch at once, see CompositionData(collate_edges=True).
             - target (Tensor | LongTensor): target values containing floats for
                 regression or integers as class labels for classification
             - cif_id: str or int
 
     Returns:
         tuple[
-            tuple[Tensor, Tensor, LongTensor, LongTensor, LongTensor]: batched Roost
-                model inputs,
+            tuple[Tensor, Tensor, LongTensor * 4]: batched Roost model inputs. The
+                last entry holds the CSR offsets of the elements of each crystal,
+                which marks all indices as sorted and gives the number of crystals,
             tuple[Tensor | LongTensor]: Target values for different tasks,
             # TODO this last tuple is unpacked how to do type hint?
             *tuple[str | int]: Identifiers like material_id, composition
         ]
     """
-    # define the lists
-    batch_elem_weights = []
-    batch_elem_fea = []
-    batch_self_idx = []
-    batch_nbr_idx = []
-    crystal_elem_idx = []
-    batch_targets = []
-    batch_cry_ids = []
-
-    cry_base_idx = 0
-    for idx, (inputs, target, *cry_ids) in enumerate(samples):
-        elem_weights, elem_fea, self_idx, nbr_idx = inputs
-
-        n_sites = elem_fea.shape[0]  # number of atoms for this crystal
-
-        # batch the features together
-        batch_elem_weights.append(elem_weights)
-        batch_elem_fea.append(elem_fea)
-
-        # mappings from bonds to atoms
-        batch_self_idx.append(self_idx + cry_base_idx)
-        batch_nbr_idx.append(nbr_idx + cry_base_idx)
-
-        # mapping from atoms to crystals
-        crystal_elem_idx.append(torch.tensor([idx] * n_sites))
-
-        # batch the targets and ids
-        batch_targets.append(target)
-        batch_cry_ids.append(cry_ids)
-
-        # increment the id counter
-        cry_base_idx += n_sites
+    inputs, targets, *cry_ids = zip(*samples)
+    elem_weights, elem_fea, *edges = zip(*inputs)
+
+    # number of elements in each crystal and mapping from elements to crystals
+    n_sites = torch.tensor([len(fea) for fea in elem_fea])
+    crystal_elem_idx = torch.arange(len(samples)).repeat_interleave(n_sites)
+
+    # mappings from bonds to atoms
+    if edges:
+        self_idx, nbr_idx = torch.cat(edges[0]), torch.cat(edges[1])
+        n_edges = torch.tensor([len(idx) for idx in edges[0]])
+        edge_offsets = batch_edge_offsets(n_sites, n_edges)
+        self_idx += edge_offsets
+        nbr_idx += edge_offsets
+    else:  # samples without edges, build the whole batch at once
+        self_idx, nbr_idx = batch_fully_connected_edges(n_sites)
 
     return (
         (
-            torch.cat(batch_elem_weights, dim=0),
-            torch.cat(batch_elem_fea, dim=0),
-            torch.cat(batch_self_idx, dim=0),
-            torch.cat(batch_nbr_idx, dim=0),
-            torch.cat(crystal_elem_idx),
+            torch.cat(elem_weights),
+            torch.cat(elem_fea),
+            self_idx,
+            nbr_idx,
+            crystal_elem_idx,
+            batch_ptr(n_sites),
         ),
-        tuple(torch.stack(b_target, dim=0) for b_target in zip(*batch_targets)),
-        *zip(*batch_cry_ids),
+        tuple(torch.stack(b_target) for b_target in zip(*targets)),
+        *cry_ids,
     )
@@ -8,8 +8,13 @@ from pymatgen.util.due import Doi, due
 from torch import LongTensor, Tensor, nn
 
 from aviary.core import BaseModelClass
-from aviary.networks import ResidualNetwork, SimpleNetwork
-from aviary.segments import MessageLayer, WeightedAttentionPooling
+from aviary.networks import ResidualNetwork
+from aviary.scatter import segment_ptr
+from aviary.segments import (
+    FrozenElementEmbedding,
+    MessageLayer,
+    MultiHeadAttentionPooling,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Sequence
@@ -41,6 +46,7 @@ class Roost(BaseModelClass):
         cry_msg: Sequence[int] = (256,),
         trunk_hidden: Sequence[int] = (1024, 512),
         out_hidden: Sequence[int] = (256, 128, 64),
+        elem_embedding: str | None = "matscholar200",
         **kwargs,
     ) -> None:
         """Composition-only model.
@@ -65,10 +71,18 @@ class Roost(BaseModelClass):
             cry_msg (list[int], optional): _description_. Defaults to (256,).
             trunk_hidden (list[int], optional): _description_. Defaults to (1024, 512).
             out_hidden (list[int], optional): _description_. Defaults to (256, 128, 64).
+            elem_embedding (str, optional): Element embedding to look up features of
+                atomic number inputs in. One of "matscholar200", "cgcnn92", "megnet16",
+                "onehot112" or path to a custom embedding file. Must be the one of the
+                dataset since it emits atomic numbers. None means inputs are
+                precomputed element features. Defaults to "matscholar200" like the
+                dataset.
             **kwargs: Additional keyword arguments to pass to BaseModelClass.
         """
         super().__init__(robust=robust, **kwargs)
 
+        self.elem_lookup = FrozenElementEmbedding(elem_emb_len, elem_embedding)
+
         desc_dict = {
             "elem_emb_len": elem_emb_len,
             "elem_fea_len": elem_fea_len,
@@ -86,6 +100,7 @@ class Roost(BaseModelClass):
         model_params = {
             "robust": robust,
             "n_targets": n_targets,
+            "elem_embedding": self.elem_lookup.elem_embedding,
             "out_hidden": out_hidden,
             "trunk_hidden": trunk_hidden,
             **desc_dict,
@@ -109,21 +124,27 @@ class Roost(BaseModelClass):
         self_idx: LongTensor,
         nbr_idx: LongTensor,
         cry_elem_idx: LongTensor,
+        cry_elem_ptr: LongTensor | None = None,
     ) -> tuple[Tensor, ...]:
         """Forward pass through the material_nn and output_nn.
 
         Args:
             elem_weights (Tensor): _description_
-            elem_fea (Tensor): _description_
+            elem_fea (Tensor): Atomic numbers or element features of each element
             self_idx (LongTensor): _description_
             nbr_idx (LongTensor): _description_
             cry_elem_idx (LongTensor): _description_
+            cry_elem_ptr (LongTensor, optional): CSR offsets of the elements of each
+                crystal as emitted by collate_batch, which marks all indices of the
+                batch as sorted to reduce them segment-wise. Its length also gives
+                the number of crystals without reading cry_elem_idx back from the
+                device. Defaults to None.
 
         Returns:
             tuple[Tensor, ...]: _description_
         """
-        crys_fea = self.material_nn(
-            elem_weights, elem_fea, self_idx, nbr_idx, cry_elem_idx
+        crys_fea = self.material_features(
+            elem_weights, elem_fea, self_idx, nbr_idx, cry_elem_idx, cry_elem_ptr
         )
 
         crys_fea = F.relu(self.trunk_nn(crys_fea))
@@ -131,6 +152,21 @@ class Roost(BaseModelClass):
         # apply neural network to map from learned features to target
         return tuple(output_nn(crys_fea) for output_nn in self.output_nns)
 
+    def material_features(
+        self, elem_weights: Tensor, elem_fea: Tensor, *graph: LongTensor
+    ) -> Tensor:
+        """Look up element features and pool them with the material_nn.
+
+        Args:
+            elem_weights (Tensor): Fractional weight of each element
+            elem_fea (Tensor): Atomic numbers or element features of each element
+            *graph (LongTensor): Remaining inputs of forward()
+
+        Returns:
+            Tensor: Composition features of each material
+        """
+        return self.material_nn(elem_weights, self.elem_lookup(elem_fea), *graph)
+
 
 class DescriptorNetwork(nn.Module):
     """The Descriptor Network is the message passing section of the Roost Model."""
@@ -181,12 +217,12 @@ class DescriptorNetwork(nn.Module):
         )
 
         # define a global pooling function for materials
-        self.cry_pool = nn.ModuleList(
-            WeightedAttentionPooling(
-                gate_nn=SimpleNetwork(elem_fea_len, 1, cry_gate),
-                message_nn=SimpleNetwork(elem_fea_len, elem_fea_len, cry_msg),
-            )
-            for _ in range(cry_heads)
+        self.cry_pool = MultiHeadAttentionPooling(
+            elem_fea_len,
+            elem_fea_len,
+            num_heads=cry_heads,
+            gate_hidden=cry_gate,
+            msg_hidden=cry_msg,
         )
 
     def forward(
@@ -196,6 +232,7 @@ class DescriptorNetwork(nn.Module):
         self_idx: LongTensor,
         nbr_idx: LongTensor,
         cry_elem_idx: LongTensor,
+        cry_elem_ptr: LongTensor | None = None,
     ) -> Tensor:
         """Forward pass through the DescriptorNetwork.
 
@@ -206,6 +243,11 @@ class DescriptorNetwork(nn.Module):
             self_idx (LongTensor): Indices of the 1st element in each of the pairs
             nbr_idx (LongTensor): Indices of the 2nd element in each of the pairs
             cry_elem_idx (list[LongTensor]): Mapping from the elem idx to crystal idx
+            cry_elem_ptr (LongTensor, optional): CSR offsets of the elements of each
+                crystal as emitted by collate_batch, which marks all indices of the
+                batch as sorted to reduce them segment-wise. Its length also gives
+                the number of crystals without reading cry_elem_idx back from the
+                device. Defaults to None.
 
         Returns:
             Tensor: Composition representation/features after message passing
@@ -216,21 +258,23 @@ class DescriptorNetwork(nn.Module):
         # add weights as a node feature
         elem_fea = torch.cat([elem_fea, elem_weights], dim=1)
 
+        # offsets of the edges of each element, shared by all message passing layers
+        self_ptr = None
+        if cry_elem_ptr is not None:
+            self_ptr = segment_ptr(self_idx, len(elem_fea))
+
         # apply the message passing functions
         for graph_func in self.graphs:
-            elem_fea = graph_func(elem_weights, elem_fea, self_idx, nbr_idx)
+            elem_fea = graph_func(elem_weights, elem_fea, self_idx, nbr_idx, self_ptr)
 
         # generate crystal features by pooling the elemental features
-        head_fea = [
-            attn_head(elem_fea, index=cry_elem_idx, weights=elem_weights)
-            for attn_head in self.cry_pool
-        ]
-
-        return torch.mean(torch.stack(head_fea), dim=0)
+        return self.cry_pool(
+            elem_fea, index=cry_elem_idx, weights=elem_weights, ptr=cry_elem_ptr
+        )
 
     def __repr__(self) -> str:
         return (
             f"{type(self).__name__}(n_graph={len(self.graphs)}, cry_heads="
-            f"{len(self.cry_pool)}, elem_emb_len={self.embedding.in_features}, "
+            f"{self.cry_pool.num_heads}, elem_emb_len={self.embedding.in_features}, "
             f"elem_fea_len={self.embedding.out_features})"
         )
@@ -1,7 +1,7 @@
 import torch
 
 
-def scatter_reduce(src, index, dim=-1, dim_size=None, reduce="sum"):
+def scatter_reduce(src, index, dim=-1, dim_size=None, reduce="sum", ptr=None):
     """Performs a scatter-reduce operation on the input tensor.
 
     This function scatters the elements from the source tensor (src) into a new tensor
@@ -20,9 +20,15 @@ def scatter_reduce(src, index, dim=-1, dim_size=None, reduce="sum"):
         reduce (str, optional): The reduction operation to perform.
             Options: "sum", "mean", "amax", "max", "amin", "min", "prod".
             Defaults to "sum".
+        ptr (torch.Tensor, optional): CSR offsets of a sorted 1D index, i.e. the
+            elements scattered to position i are src[ptr[i]:ptr[i + 1]] along dim,
+            see segment_ptr(). Selects a segment reduction which needs no index
+            expanded to the shape of src. If given, dim_size defaults to
+            len(ptr) - 1. Defaults to None.
 
     Returns:
-        torch.Tensor: The output tensor after the scatter-reduce operation.
+        torch.Tensor: The output tensor after the scatter-reduce operation. Positions
+            no element is scattered to are 0 (1 for "prod").
 
     Raises:
         ValueError: If an unsupported reduction method is specified.
@@ -35,42 +41,92 @@ def scatter_reduce(src, index, dim=-1, dim_size=None, reduce="sum"):
         tensor([4., 6., 5.])
     """
     if dim_size is None:
-        dim_size = index.max().item() + 1
+        dim_size = index.max().item() + 1 if ptr is None else len(ptr) - 1
 
     # Prepare the output tensor shape
     shape = list(src.shape)
     shape[dim] = dim_size
 
+    if reduce in ("max", "min"):
+        reduce = f"a{reduce}"
+    if reduce not in ("sum", "mean", "amax", "amin", "prod"):
+        raise ValueError(f"Unsupported reduction method: {reduce}")
+
     # Ensure index has the same number of dimensions as src
-    if index.dim() != src.dim():
+    count = None
+    if index.dim() != src.dim() or ptr is not None:
         if index.dim() != 1:
             raise RuntimeError(
                 "Index tensor must be 1D or have the same number of dimensions "
                 f"as src tensor. {index.shape=} != {src.shape=}"
             )
+        view_shape = [1] * src.dim()
+        view_shape[dim] = -1
+        if ptr is not None:
+            return _segment_reduce(src, index, ptr, dim, shape, view_shape, reduce)
+        if reduce == "mean":  # number of elements per position without scattering
+            count = torch.zeros(dim_size, dtype=src.dtype, device=src.device)
+            count = count.index_add_(0, index, torch.ones_like(index, dtype=src.dtype))
+            count = count.view(view_shape)
         # Expand index to match src dimensions
-        repeat_shape = [1] * src.dim()
-        repeat_shape[dim] = src.size(dim)
-        index = index.view(-1, *[1] * (src.dim() - 1)).expand_as(src)
+        index = index.view(view_shape).expand_as(src)
 
-    # Perform scatter_reduce operation
-    if reduce in ["sum", "mean"]:
+    if reduce in ("sum", "mean"):
+        # scatter_add has a cheaper backward (a plain gather) than scatter_reduce
         out = torch.zeros(shape, dtype=src.dtype, device=src.device)
         out = out.scatter_add(dim, index, src)
         if reduce == "mean":
-            count = torch.zeros(shape, dtype=src.dtype, device=src.device)
-            count = count.scatter_add(dim, index, torch.ones_like(src))
-            out = out / (count + (count == 0).float())  # avoid division by zero
-    elif reduce in ["amax", "max"]:
-        out = torch.full(shape, float("-inf"), dtype=src.dtype, device=src.device)
-        out = torch.max(out, out.scatter(dim, index, src))
-    elif reduce in ["amin", "min"]:
-        out = torch.full(shape, float("inf"), dtype=src.dtype, device=src.device)
-        out = torch.min(out, out.scatter(dim, index, src))
-    elif reduce == "prod":
-        out = torch.ones(shape, dtype=src.dtype, device=src.device)
-        out = out.scatter(dim, index, src, reduce="multiply")
-    else:
-        raise ValueError(f"Unsupported reduction method: {reduce}")
+            if count is None:
+                count = torch.zeros(shape, dtype=src.dtype, device=src.device)
+                count = count.scatter_add(dim, index, torch.ones_like(src))
+            out = out / count.clamp(min=1)  # avoid division by zero
+        return out
+
+    # reduce natively, include_self=False ignores the initial value of out for every
+    # position that receives at least one element so that max/min are exact for
+    # duplicate indices and positions receiving no elements keep the fill value 0
+    # (1 for prod), matching torch_scatter
+    fill_value = 1 if reduce == "prod" else 0
+    out = torch.full(shape, fill_value, dtype=src.dtype, device=src.device)
+    return out.scatter_reduce(dim, index, src, reduce=reduce, include_self=False)
+
+
+def _segment_reduce(src, index, ptr, dim, shape, view_shape, reduce):
+    """scatter_reduce for a sorted 1D index with CSR offsets ptr."""
+    if reduce in ("sum", "mean"):
+        # index_add takes the 1D index as is and its backward is an index_select
+        out = torch.zeros(shape, dtype=src.dtype, device=src.device)
+        out = out.index_add(dim, index, src)
+        if reduce == "mean":
+            out = out / ptr.diff().clamp(min=1).view(view_shape)
+        return out
+
+    # reduce each contiguous segment in one pass, unsafe skips validating the
+    # offsets which would read them back from the device
+    offsets = ptr.expand(*src.shape[:dim], -1) if dim % src.dim() else ptr
+    out = torch.segment_reduce(
+        src, reduce.removeprefix("a"), offsets=offsets, axis=dim, unsafe=True
+    )
+    if reduce == "prod":  # empty segments are already 1
+        return out
+    # empty segments are -inf (max) or inf (min), set them to 0 like scatter_reduce
+    return out.masked_fill(ptr.diff().view(view_shape) == 0, 0)
 
-    return out
+
+def segment_ptr(index, dim_size):
+    """CSR offsets of a sorted index without reading it back from the device.
+
+    Args:
+        index (torch.Tensor): Sorted 1D index, e.g. the crystal of each node of a
+            batch built by collate_batch.
+        dim_size (int): Number of segments.
+
+    Returns:
+        torch.Tensor: Offsets ptr of length dim_size + 1 such that the entries of
+            segment i are index[ptr[i]:ptr[i + 1]].
+
+    Example:
+        >>> segment_ptr(torch.tensor([0, 0, 1, 3]), 4)
+        tensor([0, 2, 3, 3, 4])
+    """
+    return torch.searchsorted(index, torch.arange(dim_size + 1, device=index.device))
@@ -2,16 +2,124 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
+import numpy as np
 import torch
 from torch import LongTensor, Tensor, nn
 
-from aviary.networks import SimpleNetwork
-from aviary.scatter import scatter_reduce
+from aviary.data import element_feature_table, load_element_embedding
+from aviary.networks import MultiHeadNetwork
 
 if TYPE_CHECKING:
     from collections.abc import Sequence
 
 
+class SegmentSoftmaxPool(torch.autograd.Function):
+    """Softmax over the rows of each segment followed by the weighted sum of messages.
+
+    Computes out[n] = sum_i a_i * messages_i over the rows i with index[i] = n where
+    a_i = weights_i * exp(gate_i) / sum_j weights_j * exp(gate_j), independently for
+    every head if the rows have a head dimension. Only the normalized exp(gate) of
+    shape (E, [H,] 1) is kept for the backward next to the inputs, which needs a
+    single scatter of that shape for the gradient of the softmax normalization.
+    """
+
+    @staticmethod
+    def forward(
+        ctx: torch.autograd.function.FunctionCtx,
+        gate: Tensor,
+        messages: Tensor,
+        index: LongTensor,
+        weights: Tensor | None,
+        dim_size: int,
+        ptr: LongTensor | None,
+    ) -> Tensor:
+        """Pool messages into segments (see segment_softmax_pool)."""
+        if ptr is None:
+            gate_index = index.view(-1, *[1] * (gate.dim() - 1)).expand_as(gate)
+            seg_max = gate.new_zeros(dim_size, *gate.shape[1:]).scatter_reduce(
+                0, gate_index, gate, reduce="amax", include_self=False
+            )
+        else:  # empty segments are -inf but never gathered below
+            seg_max = torch.segment_reduce(gate, "max", offsets=ptr, unsafe=True)
+        # softmax numerator exp(gate - max) without the weights, needed for their grad
+        exp_gate = (gate - seg_max.index_select(0, index)).exp_()
+        attn = exp_gate if weights is None else weights * exp_gate
+        seg_sum = gate.new_zeros(dim_size, *gate.shape[1:]).index_add_(0, index, attn)
+        norm = (seg_sum + 1e-10).reciprocal_().index_select(0, index)
+        exp_gate = exp_gate.mul_(norm)
+        attn = exp_gate if weights is None else weights * exp_gate
+
+        out = messages.new_zeros(dim_size, *messages.shape[1:])
+        out.index_add_(0, index, attn * messages)
+
+        ctx.dim_size = dim_size
+        ctx.save_for_backward(exp_gate, messages, index, weights)
+        return out
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(
+        ctx: torch.autograd.function.FunctionCtx, grad_out: Tensor
+    ) -> tuple[Tensor | None, ...]:
+        """Gradients of gate, messages and weights."""
+        exp_gate, messages, index, weights = ctx.saved_tensors
+        attn = exp_gate if weights is None else weights * exp_gate
+        grad_rows = grad_out.index_select(0, index)
+
+        grad_messages = None
+        if ctx.needs_input_grad[1]:
+            grad_messages = attn * grad_rows
+        # d loss / d numerator_i = (messages_i - out_n) . grad_out_n / denominator_n
+        # where out_n . grad_out_n = sum_j a_j * messages_j . grad_out_n
+        grad_attn = torch.einsum("...f,...f->...", messages, grad_rows).unsqueeze(-1)
+        seg_grad = grad_attn.new_zeros(ctx.dim_size, *grad_attn.shape[1:])
+        seg_grad.index_add_(0, index, attn * grad_attn)
+        grad_attn -= seg_grad.index_select(0, index)
+        grad_gate = attn * grad_attn if ctx.needs_input_grad[0] else None
+        grad_weights = None
+        if weights is not None and ctx.needs_input_grad[3]:
+            # weights shared by all heads get the sum of the head gradients
+            grad_weights = (exp_gate * grad_attn).sum_to_size(weights.shape)
+        return grad_gate, grad_messages, None, grad_weights, None, None
+
+
+def segment_softmax_pool(
+    gate: Tensor,
+    messages: Tensor,
+    index: LongTensor,
+    weights: Tensor | None = None,
+    dim_size: int | None = None,
+    ptr: LongTensor | None = None,
+) -> Tensor:
+    """Attention pooling of messages into segments with a (weighted) softmax gate.
+
+    Fuses the segment max, the softmax normalization and the weighted sum of messages
+    of (Weighted)AttentionPooling into a single autograd node with a hand-written
+    backward, saving the allocation of the intermediate attention tensors that
+    autograd would otherwise keep alive.
+
+    Args:
+        gate (Tensor): Attention logits of shape (E, 1) or (E, H, 1) for H heads.
+        messages (Tensor): Messages of shape (E, F) or (E, H, F).
+        index (LongTensor): Segment of each of the E rows. Need not be sorted.
+        weights (Tensor, optional): Non-negative weights multiplying exp(gate) of
+            the same shape as gate or broadcastable to it, e.g. (E, 1, 1) to share
+            them between heads. Defaults to None meaning an unweighted softmax.
+        dim_size (int, optional): Number of segments. Defaults to None meaning
+            len(ptr) - 1 if given, else index.max() + 1.
+        ptr (LongTensor, optional): CSR offsets of index if it is sorted, see
+            aviary.scatter.segment_ptr(). Takes the segment max of the gate with
+            torch.segment_reduce instead of a scatter. Defaults to None.
+
+    Returns:
+        Tensor: Pooled messages of shape (dim_size, F) or (dim_size, H, F). Empty
+            segments are 0.
+    """
+    if dim_size is None:
+        dim_size = int(index.max()) + 1 if ptr is None else len(ptr) - 1
+    return SegmentSoftmaxPool.apply(gate, messages, index, weights, dim_size, ptr)
+
+
 class AttentionPooling(nn.Module):
     """Softmax attention layer. Currently unused."""
 
@@ -26,24 +134,29 @@ class AttentionPooling(nn.Module):
         self.gate_nn = gate_nn
         self.message_nn = message_nn
 
-    def forward(self, x: Tensor, index: Tensor) -> Tensor:
+    def forward(
+        self,
+        x: Tensor,
+        index: Tensor,
+        dim_size: int | None = None,
+        ptr: Tensor | None = None,
+    ) -> Tensor:
         """Forward pass.
 
         Args:
             x (Tensor): Input features for nodes
             index (Tensor): The indices for scatter operation over nodes
+            dim_size (int, optional): Number of output nodes. Defaults to None
+                meaning index.max() + 1.
+            ptr (Tensor, optional): CSR offsets of index if it is sorted. Defaults
+                to None.
 
         Returns:
             Tensor: Output features for nodes
         """
         gate = self.gate_nn(x)
-
-        gate -= scatter_reduce(gate, index, dim=0, reduce="amax")[index]
-        gate = gate.exp()
-        gate /= scatter_reduce(gate, index, dim=0, reduce="sum")[index] + 1e-10
-
         x = self.message_nn(x)
-        return scatter_reduce(gate * x, index, dim=0, reduce="sum")
+        return segment_softmax_pool(gate, x, index, dim_size=dim_size, ptr=ptr)
 
     def __repr__(self) -> str:
         gate_nn, message_nn = self.gate_nn, self.message_nn
@@ -65,31 +178,129 @@ class WeightedAttentionPooling(nn.Module):
         self.message_nn = message_nn
         self.pow = torch.nn.Parameter(torch.randn(1))
 
-    def forward(self, x: Tensor, index: Tensor, weights: Tensor) -> Tensor:
+    def forward(
+        self,
+        x: Tensor,
+        index: Tensor,
+        weights: Tensor,
+        dim_size: int | None = None,
+        ptr: Tensor | None = None,
+    ) -> Tensor:
         """Forward pass.
 
         Args:
             x (Tensor): Input features for nodes
             index (Tensor): The indices for scatter operation over nodes
             weights (Tensor): The weights to assign to nodes
+            dim_size (int, optional): Number of output nodes. Defaults to None
+                meaning index.max() + 1.
+            ptr (Tensor, optional): CSR offsets of index if it is sorted. Defaults
+                to None.
 
         Returns:
             Tensor: Output features for nodes
         """
         gate = self.gate_nn(x)
-
-        gate -= scatter_reduce(gate, index, dim=0, reduce="amax")[index]
-        gate = (weights**self.pow) * gate.exp()
-        gate /= scatter_reduce(gate, index, dim=0, reduce="sum")[index] + 1e-10
-
         x = self.message_nn(x)
-        return scatter_reduce(gate * x, index, dim=0, reduce="sum")
+        return segment_softmax_pool(gate, x, index, weights**self.pow, dim_size, ptr)
 
     def __repr__(self) -> str:
         pow, gate_nn, message_nn = float(self.pow), self.gate_nn, self.message_nn
         return f"{type(self).__name__}({pow=:.3}, {gate_nn=}, {message_nn=})"
 
 
+class MultiHeadAttentionPooling(nn.Module):
+    """Weighted softmax attention layer with num_heads heads averaged.
+
+    Equivalent to the mean over a list of WeightedAttentionPooling heads with
+    SimpleNetwork gate and message networks, but the networks of all heads are
+    MultiHeadNetworks and the softmax pooling runs once over a head dimension. State
+    dicts holding such a list under the name of this module are converted on load.
+    """
+
+    def __init__(
+        self,
+        input_dim: int,
+        output_dim: int,
+        num_heads: int,
+        gate_hidden: Sequence[int],
+        msg_hidden: Sequence[int],
+    ) -> None:
+        """Initialize multi-head softmax attention layer.
+
+        Args:
+            input_dim (int): Number of input features
+            output_dim (int): Number of output features
+            num_heads (int): Number of attention heads
+            gate_hidden (list[int]): Hidden layer sizes of the gate network of each
+                head
+            msg_hidden (list[int]): Hidden layer sizes of the message network of
+                each head
+        """
+        super().__init__()
+        self.num_heads = num_heads
+        self.gate_nn = MultiHeadNetwork(input_dim, 1, gate_hidden, num_heads)
+        self.message_nn = MultiHeadNetwork(input_dim, output_dim, msg_hidden, num_heads)
+        self.pow = torch.nn.Parameter(torch.randn(num_heads, 1))
+
+    def forward(
+        self,
+        x: Tensor,
+        index: Tensor,
+        weights: Tensor,
+        dim_size: int | None = None,
+        ptr: Tensor | None = None,
+    ) -> Tensor:
+        """Forward pass.
+
+        Args:
+            x (Tensor): Input features for nodes
+            index (Tensor): The indices for scatter operation over nodes
+            weights (Tensor): The weights to assign to nodes
+            dim_size (int, optional): Number of output nodes. Defaults to None
+                meaning index.max() + 1.
+            ptr (Tensor, optional): CSR offsets of index if it is sorted. Defaults
+                to None.
+
+        Returns:
+            Tensor: Output features for nodes averaged over the heads
+        """
+        gate = self.gate_nn(x)
+        x = self.message_nn(x)
+        # (E, 1, 1) ** (H, 1) gives every head its own power of the weights
+        weights = weights.unsqueeze(1) ** self.pow
+        out = segment_softmax_pool(gate, x, index, weights, dim_size, ptr)
+        return out.mean(dim=1)
+
+    def head_list_names(self) -> dict[str, list[str]]:
+        """Map the name of each parameter to the names of the parameters of a list
+        of WeightedAttentionPooling heads it stacks, e.g. pow to 0.pow, 1.pow, ...
+        """
+        return {
+            name: [f"{head}.{name}" for head in range(self.num_heads)]
+            for name, _ in self.named_parameters()
+        }
+
+    def _load_from_state_dict(
+        self, state_dict: dict[str, Tensor], prefix: str, *args, **kwargs
+    ) -> None:
+        """Stack the parameters of a list of WeightedAttentionPooling heads stored
+        as {prefix}{head}.{name} into the parameters {prefix}{name} of all heads.
+        """
+        for name, head_names in self.head_list_names().items():
+            head_keys = [prefix + head_name for head_name in head_names]
+            if prefix + name not in state_dict and all(
+                key in state_dict for key in head_keys
+            ):
+                head_params = [state_dict.pop(key) for key in head_keys]
+                state_dict[prefix + name] = torch.stack(head_params)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __repr__(self) -> str:
+        num_heads, gate_nn, message_nn = self.num_heads, self.gate_nn, self.message_nn
+        return f"{type(self).__name__}({num_heads=}, {gate_nn=}, {message_nn=})"
+
+
 class MessageLayer(nn.Module):
     """MessageLayer to propagate information between nodes in graph."""
 
@@ -116,12 +327,12 @@ class MessageLayer(nn.Module):
         )
 
         # Pooling and Output
-        self.pooling = nn.ModuleList(
-            WeightedAttentionPooling(
-                gate_nn=SimpleNetwork(2 * msg_fea_len, 1, msg_gate_layers),
-                message_nn=SimpleNetwork(2 * msg_fea_len, msg_fea_len, msg_net_layers),
-            )
-            for _ in range(num_msg_heads)
+        self.pooling = MultiHeadAttentionPooling(
+            2 * msg_fea_len,
+            msg_fea_len,
+            num_heads=num_msg_heads,
+            gate_hidden=msg_gate_layers,
+            msg_hidden=msg_net_layers,
         )
 
     def forward(
@@ -130,6 +341,7 @@ class MessageLayer(nn.Module):
         node_prev_features: Tensor,
         self_idx: LongTensor,
         neighbor_idx: LongTensor,
+        self_ptr: LongTensor | None = None,
     ) -> Tensor:
         """Forward pass.
 
@@ -139,6 +351,8 @@ class MessageLayer(nn.Module):
             self_idx (LongTensor): Indices of the 1st element in each of the node pairs
             neighbor_idx (LongTensor): Indices of the 2nd element in each of the node
                 pairs
+            self_ptr (LongTensor, optional): CSR offsets of self_idx if the pairs are
+                sorted by their 1st element. Defaults to None.
 
         Returns:
             Tensor: node hidden features after message passing
@@ -149,16 +363,73 @@ class MessageLayer(nn.Module):
         msg_self_fea = node_prev_features[self_idx, :]
         message = torch.cat([msg_self_fea, msg_nbr_fea], dim=1)
 
-        # sum selectivity over the neighbors to get node updates
-        head_features = []
-        for attn_head in self.pooling:
-            out_msg = attn_head(message, index=self_idx, weights=node_nbr_weights)
-            head_features.append(out_msg)
-
-        # average the attention heads
-        node_update = torch.stack(head_features).mean(dim=0)
+        # sum selectivity over the neighbors to get node updates averaged over heads
+        node_update = self.pooling(
+            message,
+            index=self_idx,
+            weights=node_nbr_weights,
+            dim_size=len(node_prev_features),
+            ptr=self_ptr,
+        )
 
         return node_update + node_prev_features
 
     def __repr__(self) -> str:
         return self._repr
+
+
+class FrozenElementEmbedding(nn.Module):
+    """Frozen lookup table from atomic numbers to pre-trained element features.
+
+    Datasets emit atomic numbers instead of copying element feature vectors into
+    every sample. The table is a non-persistent buffer so it follows the model
+    across devices but is neither saved in nor expected from checkpoints.
+    """
+
+    def __init__(self, elem_emb_len: int, elem_embedding: str | None = None) -> None:
+        """Load the element embedding table.
+
+        Args:
+            elem_emb_len (int): Number of features in the element embedding.
+            elem_embedding (str, optional): One of "matscholar200", "cgcnn92",
+                "megnet16", "onehot112" or path to a JSON file with custom element
+                embeddings. It is not inferred from elem_emb_len since custom
+                embeddings can have the width of a built-in one. Defaults to None
+                meaning only precomputed element features are accepted.
+        """
+        super().__init__()
+        self.elem_embedding = elem_embedding
+
+        weight = None
+        if elem_embedding is not None:
+            table = element_feature_table(load_element_embedding(elem_embedding))
+            if table.shape[1] != elem_emb_len:
+                raise ValueError(
+                    f"{elem_embedding=} has {table.shape[1]} features, expected "
+                    f"{elem_emb_len=}"
+                )
+            weight = torch.from_numpy(np.nan_to_num(table, nan=0.0))
+        self.register_buffer("weight", weight, persistent=False)
+
+    def forward(self, elem_fea: Tensor) -> Tensor:
+        """Look up element features.
+
+        Args:
+            elem_fea (Tensor): Atomic numbers of shape (N, ...) or precomputed element
+                features of shape (N, ..., elem_emb_len) which are passed through as
+                is.
+
+        Returns:
+            Tensor: Element features of shape (N, ..., elem_emb_len)
+        """
+        if elem_fea.is_floating_point():
+            return elem_fea
+        if self.weight is None:
+            raise ValueError(
+                "Got atomic numbers as input but no element embedding is known for "
+                "this model, pass the elem_embedding of the dataset when creating it"
+            )
+        return nn.functional.embedding(elem_fea, self.weight)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(elem_embedding={self.elem_embedding})"
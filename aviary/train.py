@@ -15,7 +15,7 @@ from aviary import ROOT
 from aviary.core import BaseModelClass, Normalizer, TaskType, np_softmax
 from aviary.losses import robust_l1_loss
 from aviary.utils import get_metrics, print_walltime
-from aviary.wrenformer.data import df_to_in_mem_dataloader
+from aviary.wrenformer.data import PackedSequences, df_to_in_mem_dataloader
 from aviary.wrenformer.model import Wrenformer
 
 try:
@@ -455,6 +455,7 @@ def train_wrenformer(
     input_col: str | None = None,
     model_params: dict[str, Any] | None = None,
     data_loader_device: str = "cpu",
+    bucket_by_length: bool = False,
     **kwargs,
 ) -> tuple[dict[str, float], dict[str, Any], pd.DataFrame]:
     """Train a Wrenformer model on a dataframe. This function handles the DataLoader
@@ -483,6 +484,8 @@ def train_wrenformer(
         model_params (dict): Passed to Wrenformer class. E.g. dict(n_attn_layers=6,
             embedding_aggregation=("mean", "std")).
         data_loader_device(str): device to store the InMemoryDataLoader's tensors on.
+        bucket_by_length (bool, optional): Whether to batch training samples of
+            similar sequence length to minimise padding. Defaults to False.
         **kwargs: Additional keyword arguments are passed to train_model().
 
     Returns:
@@ -512,8 +515,12 @@ def train_wrenformer(
         train_df,
         batch_size=batch_size,
         shuffle=True,
+        bucket_by_length=bucket_by_length,
         **data_loader_kwargs,  # type: ignore[arg-type]
     )
+    if train_loader.batch_sampler is not None:
+        padding_eff = train_loader.batch_sampler.padding_efficiency()
+        print(f"Padding efficiency of length-bucketed train batches: {padding_eff:.1%}")
 
     test_loader = df_to_in_mem_dataloader(
         test_df,
@@ -526,7 +533,11 @@ def train_wrenformer(
     # encoding the element type (usually 200-dim matscholar embeddings) and Wyckoff
     # position (see 'bra-alg-off.json') + 1 for the weight of that Wyckoff position (or
     # element) in the material
-    embedding_len = train_loader.tensors[0][0].shape[-1]
+    inputs = train_loader.tensors[0]
+    if isinstance(inputs, PackedSequences):
+        embedding_len = inputs.n_features
+    else:
+        embedding_len = inputs[0].shape[-1]
     # Roost and Wren embedding size resp.
     assert embedding_len in (200 + 1, 200 + 1 + 444), f"{embedding_len=}"
 
@@ -29,7 +29,9 @@ from torch.utils.tensorboard import SummaryWriter
 
 from aviary import ROOT
 from aviary.core import BaseModelClass, Normalizer, TaskType, sampled_softmax
+from aviary.data import InMemoryDataLoader
 from aviary.losses import robust_l1_loss, robust_l2_loss
+from aviary.segments import MultiHeadAttentionPooling
 
 if TYPE_CHECKING:
     from collections.abc import Generator, Iterable
@@ -99,8 +101,11 @@ def initialize_model(
         model.to(device)
 
         model_dict = model.state_dict()
+        # stack lists of attention heads first, their per-head keys are not in model
         pretrained_dict = {
-            k: v for k, v in checkpoint["state_dict"].items() if k in model_dict
+            k: v
+            for k, v in stack_attention_heads(model, checkpoint["state_dict"]).items()
+            if k in model_dict
         }
         model_dict.update(pretrained_dict)
         model.load_state_dict(model_dict)
@@ -187,12 +192,114 @@ def initialize_optim(
         # when resuming such that the state dictionaries do not clash.
         # TODO breaking the function apart means we load the checkpoint twice.
         checkpoint = torch.load(resume, map_location=device)
-        optimizer.load_state_dict(checkpoint["optimizer"])
+        optim_state = checkpoint["optimizer"]
+        n_saved = sum(len(group["params"]) for group in optim_state["param_groups"])
+        if n_saved != len(list(model.parameters())):
+            # checkpoints from before the attention heads were batched
+            optim_state = stack_attention_head_optim_state(
+                model, optim_state, checkpoint["state_dict"]
+            )
+        if optim_state is None:
+            print(
+                f"Optimizer state of {resume=} does not match the model parameters, "
+                "resuming with a freshly initialized optimizer"
+            )
+        else:
+            optimizer.load_state_dict(optim_state)
         scheduler.load_state_dict(checkpoint["scheduler"])
 
     return optimizer, scheduler
 
 
+def _attention_head_names(model: BaseModelClass) -> dict[str, list[str]]:
+    """Map parameters of the MultiHeadAttentionPooling layers of model to the
+    parameters of the lists of WeightedAttentionPooling heads they replace.
+    """
+    return {
+        f"{module_name}.{name}": [f"{module_name}.{head}" for head in head_names]
+        for module_name, module in model.named_modules()
+        if isinstance(module, MultiHeadAttentionPooling)
+        for name, head_names in module.head_list_names().items()
+    }
+
+
+def stack_attention_heads(
+    model: BaseModelClass, state_dict: dict[str, Tensor]
+) -> dict[str, Tensor]:
+    """Convert a state dict saved before the attention heads of model were batched
+    into MultiHeadAttentionPooling layers, stacking the parameters of each list of
+    WeightedAttentionPooling heads. Other keys are kept as is.
+
+    Args:
+        model (BaseModelClass): Model to load the state dict into.
+        state_dict (dict[str, Tensor]): State dict of the model's checkpoint.
+
+    Returns:
+        dict[str, Tensor]: State dict with the keys of model.
+    """
+    state_dict = dict(state_dict)
+    for name, head_keys in _attention_head_names(model).items():
+        if name not in state_dict and all(key in state_dict for key in head_keys):
+            state_dict[name] = torch.stack([state_dict.pop(key) for key in head_keys])
+    return state_dict
+
+
+def stack_attention_head_optim_state(
+    model: BaseModelClass, optim_state: dict[str, Any], state_dict: dict[str, Tensor]
+) -> dict[str, Any] | None:
+    """Convert the state of an optimizer over the parameters of a model saved before
+    its attention heads were batched into MultiHeadAttentionPooling layers, stacking
+    the per-parameter state (e.g. Adam moments) of each list of heads like
+    stack_attention_heads() does for the parameters.
+
+    Args:
+        model (BaseModelClass): Model the optimizer is created for.
+        optim_state (dict[str, Any]): Optimizer state dict of the checkpoint.
+        state_dict (dict[str, Tensor]): Model state dict of the checkpoint, whose
+            parameters are in the order of the optimizer's.
+
+    Returns:
+        dict[str, Any] | None: Optimizer state dict for the parameters of model or
+            None if the checkpoint's parameters cannot be matched to them.
+    """
+    if len(optim_state["param_groups"]) != 1:
+        return None
+    (param_group,) = optim_state["param_groups"]
+    buffers = {name for name, _ in model.named_buffers()}
+    saved_names = [key for key in state_dict if key not in buffers]
+    if len(saved_names) != len(param_group["params"]):
+        return None
+    saved_ids = dict(zip(saved_names, param_group["params"]))
+    head_names = _attention_head_names(model)
+
+    param_states: dict[int, dict[str, Any]] = {}
+    for idx, (name, _) in enumerate(model.named_parameters()):
+        sources = [name] if name in saved_ids else head_names.get(name, [name])
+        if any(src not in saved_ids for src in sources):
+            return None
+        states = [
+            optim_state["state"][saved_ids[src]]
+            for src in sources
+            if saved_ids[src] in optim_state["state"]
+        ]
+        if len(states) == 0:  # parameter without optimizer state, e.g. no grad yet
+            continue
+        if len(states) != len(sources):
+            return None
+        param_states[idx] = {
+            key: torch.stack([state[key] for state in states])
+            if len(sources) > 1 and isinstance(val, Tensor) and val.dim() > 0
+            else val  # e.g. step counts are shared by all heads
+            for key, val in states[0].items()
+        }
+
+    n_params = len(list(model.parameters()))
+    return {
+        "state": param_states,
+        "param_groups": [{**param_group, "params": list(range(n_params))}],
+    }
+
+
 def initialize_losses(
     task_dict: dict[str, TaskType],
     loss_name_dict: dict[str, Literal["L1", "L2", "CSE"]],
@@ -277,6 +384,30 @@ def init_normalizers(
     return normalizer_dict
 
 
+def get_data_loader(
+    dataset: Dataset | Subset, data_params: dict[str, Any], in_memory: bool = False
+) -> DataLoader | InMemoryDataLoader:
+    """Create a DataLoader or an InMemoryDataLoader for a graph dataset.
+
+    Args:
+        dataset (Dataset | Subset): Dataset to load.
+        data_params (dict[str, Any]): DataLoader parameters.
+        in_memory (bool, optional): Whether to create an InMemoryDataLoader which
+            gathers batches straight from the dataset's CSR arrays. Only batch_size
+            and shuffle of data_params are used then. Defaults to False.
+
+    Returns:
+        DataLoader | InMemoryDataLoader: Data loader for the dataset.
+    """
+    if in_memory:
+        return InMemoryDataLoader.from_dataset(
+            dataset,
+            batch_size=data_params.get("batch_size", 1),
+            shuffle=data_params.get("shuffle", False),
+        )
+    return DataLoader(dataset, **data_params)
+
+
 def train_ensemble(
     model_class: BaseModelClass,
     model_name: str,
@@ -293,6 +424,7 @@ def train_ensemble(
     loss_dict: dict[str, Literal["L1", "L2", "CSE"]],
     patience: int | None = None,
     verbose: bool = False,
+    in_memory: bool = False,
 ) -> None:
     """Train multiple models that form an ensemble in serial with this convenience
     function.
@@ -315,13 +447,17 @@ def train_ensemble(
         patience (int, optional): Maximum number of epochs without improvement
             when early stopping. Defaults to None.
         verbose (bool, optional): Whether to show progress bars for each epoch.
+        in_memory (bool, optional): Whether to gather batches straight from the
+            datasets' CSR arrays with InMemoryDataLoader.from_dataset() instead of
+            using a DataLoader. Only batch_size and shuffle of data_params are used
+            then. Defaults to False.
     """
-    train_loader = DataLoader(train_set, **data_params)
+    train_loader = get_data_loader(train_set, data_params, in_memory)
     print(f"Training on {len(train_set):,} samples")
 
     if val_set is not None:
         data_params.update({"batch_size": 16 * data_params["batch_size"]})
-        val_loader = DataLoader(val_set, **data_params)
+        val_loader = get_data_loader(val_set, data_params, in_memory)
         print(f"Validating on {len(val_set):,} samples")
     else:
         val_loader = None
@@ -421,6 +557,7 @@ def results_multitask(
     eval_type: str = "checkpoint",
     print_results: bool = True,
     save_results: bool = True,
+    in_memory: bool = False,
 ) -> dict[str, dict[str, list | np.ndarray]]:
     """Take an ensemble of models and evaluate their performance on the test set.
 
@@ -441,6 +578,9 @@ def results_multitask(
         print_results (bool, optional): Whether to print out summary metrics.
             Defaults to True.
         save_results (bool, optional): Whether to save results dict. Defaults to True.
+        in_memory (bool, optional): Whether to gather batches straight from the
+            dataset's CSR arrays with InMemoryDataLoader.from_dataset() instead of
+            using a DataLoader. Defaults to False.
 
     Returns:
         dict[str, dict[str, list | np.array]]: Dictionary of predicted results for each
@@ -457,7 +597,7 @@ def results_multitask(
         "------------Evaluate model on Test Set------------\n"
         "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n"
     )
-    test_loader = DataLoader(test_set, **data_params)
+    test_loader = get_data_loader(test_set, data_params, in_memory)
     print(f"Testing on {len(test_set):,} samples")
 
     results_dict: dict[str, dict[str, list | np.ndarray]] = {}
@@ -1,32 +1,50 @@
 from __future__ import annotations
 
 import json
-from functools import cache
+from functools import lru_cache, partial
 from itertools import groupby
 from typing import TYPE_CHECKING, Any
 
 import numpy as np
 import torch
+from pymatgen.core import Element
 from torch import LongTensor, Tensor
 from torch.utils.data import Dataset
 
 from aviary import PKG_DIR
+from aviary.data import (
+    FeatureCache,
+    ParquetShardDataset,
+    SlimPickleMixin,
+    batch_edge_offsets,
+    batch_fully_connected_edges,
+    batch_ptr,
+    csr_gather,
+    element_feature_table,
+    fully_connected_edges,
+    get_identifier_rows,
+    get_target_columns,
+    load_element_embedding,
+)
 from aviary.wren.utils import (
     RE_SUBST_ONE_PREFIX,
     RE_WYCKOFF_NO_PREFIX,
-    relab_dict,
+    relab_tables,
     wyckoff_multiplicity_dict,
 )
 
 if TYPE_CHECKING:
-    from collections.abc import Sequence
+    from collections.abc import Iterable, Sequence
 
     import pandas as pd
 
 
-class WyckoffData(Dataset):
+class WyckoffData(SlimPickleMixin, Dataset):
     """Wyckoff dataset class for the Wren model."""
 
+    # JSON embeddings are only needed to build elem_fea_table and sym_fea_table
+    _pickle_exclude = ("elem_features", "sym_features", "sym_fea_idx")
+
     def __init__(
         self,
         df: pd.DataFrame,
@@ -35,6 +53,8 @@ class WyckoffData(Dataset):
         sym_emb: str = "bra-alg-off",
         inputs: str = "wyckoff",
         identifiers: Sequence[str] = ("material_id", "composition", "wyckoff"),
+        feature_cache: FeatureCache | None = None,
+        collate_edges: bool = False,
     ):
         """Data class for Wren models.
 
@@ -52,20 +72,26 @@ class WyckoffData(Dataset):
             identifiers (list, optional): df columns for distinguishing data points.
                 Will be copied over into the model's output CSV. Defaults to
                 ["material_id", "composition", "wyckoff"].
+            feature_cache (FeatureCache, optional): Store for featurized samples.
+                Pass a FeatureCache with a memory budget to bound memory or a
+                SharedMemoryFeatureCache to share samples across DataLoader workers.
+                Defaults to None meaning an unbounded FeatureCache.
+            collate_edges (bool, optional): If True, samples hold no edge indices and
+                collate_batch builds them for the whole batch at once instead.
+                Defaults to False.
         """
         if len(identifiers) < 2:
             raise AssertionError("Two identifiers are required")
 
         self.inputs = inputs
         self.task_dict = task_dict
+        self.feature_cache = FeatureCache() if feature_cache is None else feature_cache
+        self.collate_edges = collate_edges
         self.identifiers = list(identifiers)
         self.df = df
 
-        if elem_embedding in ("matscholar200", "cgcnn92", "megnet16", "onehot112"):
-            elem_embedding = f"{PKG_DIR}/embeddings/element/{elem_embedding}.json"
-
-        with open(elem_embedding) as emb_file:
-            self.elem_features = json.load(emb_file)
+        self.elem_embedding = elem_embedding
+        self.elem_features = load_element_embedding(elem_embedding)
 
         self.elem_emb_len = len(next(iter(self.elem_features.values())))
 
@@ -79,6 +105,54 @@ class WyckoffData(Dataset):
             next(iter(next(iter(self.sym_features.values())).values()))
         )
 
+        self.elem_fea_table = element_feature_table(self.elem_features)
+        # flat symmetry feature table with row lookup by (spg_num, wyckoff_letter)
+        self.sym_fea_idx: dict[tuple[str, str], int] = {}
+        sym_fea_rows = []
+        for spg_num, wyk_features in self.sym_features.items():
+            for letter, features in wyk_features.items():
+                self.sym_fea_idx[(spg_num, letter)] = len(sym_fea_rows)
+                sym_fea_rows.append(features)
+        self.sym_fea_table = np.array(sym_fea_rows, dtype=np.float32)
+
+        # parse all protostructure labels once into flat arrays with per-sample
+        # offsets so samples are built by array slicing without the dataframe
+        self.ids = get_identifier_rows(self.df, self.identifiers)
+        self.targets = get_target_columns(self.df, self.task_dict)
+
+        n_wyks, n_augs, wyk_z, wyk_weights, sym_idx = [], [], [], [], []
+        parsed_labels = parse_protostructure_labels(self.df[self.inputs])
+        for parsed, material_ids in zip(parsed_labels, self.ids):
+            spg_num, multiplicities, elements, augmented_wyks = parsed
+            try:
+                wyk_z += [Element(el).Z for el in elements]
+                sym_idx += [
+                    self.sym_fea_idx[(spg_num, wyk_site)]
+                    for wyckoff_sites in augmented_wyks
+                    for wyk_site in wyckoff_sites
+                ]
+            except (ValueError, KeyError) as exc:
+                raise ValueError(
+                    f"Failed to process elements or Wyckoff positions for "
+                    f"{list(material_ids)}"
+                ) from exc
+            multiplicities = np.array(multiplicities)
+            wyk_weights.append(multiplicities / multiplicities.sum())
+            n_wyks.append(len(elements))
+            n_augs.append(len(augmented_wyks))
+
+        self.wyk_ptr = np.cumsum([0, *n_wyks], dtype=np.int64)
+        self.sym_ptr = np.cumsum([0, *np.multiply(n_wyks, n_augs)], dtype=np.int64)
+        self.wyk_z = np.array(wyk_z, dtype=np.int64)
+        self.wyk_weights = np.concatenate(wyk_weights or [np.zeros(0)])[:, None]
+        self.sym_idx = np.array(sym_idx, dtype=np.int64)
+
+        missing = np.isnan(self.elem_fea_table[self.wyk_z]).any(axis=1)
+        if missing.any():
+            bad_rows = np.searchsorted(self.wyk_ptr, missing.nonzero()[0], "right") - 1
+            bad_ids = [list(self.ids[row]) for row in np.unique(bad_rows)]
+            raise ValueError(f"{bad_ids} contain element types not in embedding")
+
         self.n_targets = []
         for target, task in self.task_dict.items():
             if task == "regression":
@@ -94,81 +168,98 @@ class WyckoffData(Dataset):
         df_repr = f"cols=[{', '.join(self.df.columns)}], len={len(self.df)}"
         return f"{type(self).__name__}({df_repr}, task_dict={self.task_dict})"
 
-    @cache  # noqa: B019
     def __getitem__(self, idx: int):
-        """Get an entry out of the Dataset.
+        """Get an entry out of the Dataset, featurizing it on first access.
 
         Args:
             idx (int): index of entry in Dataset
 
         Returns:
             tuple containing:
-            - tuple[Tensor, Tensor, Tensor, LongTensor, LongTensor]: Wren model inputs
+            - tuple[Tensor, LongTensor, Tensor, LongTensor, LongTensor]: Wren model inputs
+              (Wyckoff weights, atomic numbers, symmetry features, self and
+              neighbor indices). The indices are left out if collate_edges is True.
             - list[Tensor | LongTensor]: regression or classification targets
             - list[str | int]: identifiers like material_id, composition
         """
-        row = self.df.iloc[idx]
-        protostructure_label = row[self.inputs]
-        material_ids = row[self.identifiers].to_list()
+        return self.feature_cache.get(idx, self.featurize)
 
-        parsed_output = parse_protostructure_label(protostructure_label)
-        spg_num, wyk_site_multiplcities, elements, augmented_wyks = parsed_output
+    def featurize(self, idx: int):
+        """Featurize a single entry of the Dataset without caching.
 
-        wyk_site_multiplcities = np.atleast_2d(wyk_site_multiplcities).T / np.sum(
-            wyk_site_multiplcities
+        Args:
+            idx (int): index of entry in Dataset
+
+        Returns:
+            tuple: same as __getitem__
+        """
+        idx = range(len(self))[idx]  # resolve negative indices
+        wyk_start, wyk_end = self.wyk_ptr[idx], self.wyk_ptr[idx + 1]
+        sym_start, sym_end = self.sym_ptr[idx], self.sym_ptr[idx + 1]
+        n_wyks = int(wyk_end - wyk_start)
+        n_aug = int(sym_end - sym_start) // n_wyks
+
+        wyckoff_weights = torch.tensor(
+            self.wyk_weights[wyk_start:wyk_end], dtype=torch.float32
+        )
+        # atomic numbers, element features are looked up inside the model
+        element_features = torch.tensor(self.wyk_z[wyk_start:wyk_end])
+        symmetry_features = torch.from_numpy(
+            self.sym_fea_table[self.sym_idx[sym_start:sym_end]]
         )
 
-        try:
-            element_features = np.vstack([self.elem_features[el] for el in elements])
-        except AssertionError:
-            print(f"Failed to process elements for {material_ids}")
-            raise
+        inputs = (wyckoff_weights, element_features, symmetry_features)
+        if not self.collate_edges:
+            # fully connected graph within each augmentation of the Wyckoff positions
+            inputs += fully_connected_edges(n_wyks, n_aug)
 
-        try:
-            symmetry_features = np.vstack(
-                [
-                    self.sym_features[spg_num][wyk_site]
-                    for wyckoff_sites in augmented_wyks
-                    for wyk_site in wyckoff_sites
-                ]
-            )
-        except AssertionError:
-            print(f"Failed to process Wyckoff positions for {material_ids}")
-            raise
-
-        n_wyks = len(elements)
-        self_idx = []
-        nbr_idx = []
-        for wyk_idx in range(n_wyks):
-            self_idx += [wyk_idx] * n_wyks
-            nbr_idx += list(range(n_wyks))
-
-        self_aug_fea_idx = []
-        nbr_aug_fea_idx = []
-        n_aug = len(augmented_wyks)
-        for aug_idx in range(n_aug):
-            self_aug_fea_idx += [x + aug_idx * n_wyks for x in self_idx]
-            nbr_aug_fea_idx += [x + aug_idx * n_wyks for x in nbr_idx]
-
-        # convert all data to tensors
-        wyckoff_weights = Tensor(wyk_site_multiplcities)
-        element_features = Tensor(element_features)
-        symmetry_features = Tensor(symmetry_features)
-        self_idx = LongTensor(self_aug_fea_idx)
-        nbr_idx = LongTensor(nbr_aug_fea_idx)
-
-        targets = []
-        for name in self.task_dict:
-            if self.task_dict[name] == "regression":
-                targets.append(Tensor([float(self.df.iloc[idx][name])]))
-            elif self.task_dict[name] == "classification":
-                targets.append(LongTensor([int(self.df.iloc[idx][name])]))
-
-        return (
-            (wyckoff_weights, element_features, symmetry_features, self_idx, nbr_idx),
-            targets,
-            *material_ids,
+        targets = [col[idx].reshape(1) for col in self.targets]
+        material_ids = self.ids[idx]
+
+        return (inputs, targets, *material_ids)
+
+    def graph_sizes(self) -> tuple[np.ndarray, np.ndarray]:
+        """Number of nodes and edges of each entry summed over the fully connected
+        graphs of all its augmentations, see BudgetBatchSampler.
+        """
+        n_nodes = np.diff(self.sym_ptr)  # Wyckoff positions times augmentations
+        return n_nodes, n_nodes * np.diff(self.wyk_ptr)
+
+    def get_batch(self, rows: Sequence[int] | np.ndarray) -> tuple[Any, ...]:
+        """Gather a batch straight from the CSR arrays with vectorized ops.
+
+        Gives the same result as collate_batch([self[row] for row in rows]) without
+        per-sample tensors, see InMemoryDataLoader.from_dataset().
+
+        Args:
+            rows (list[int] | np.ndarray): Indices of the entries in the batch.
+
+        Returns:
+            tuple: same as collate_batch()
+        """
+        rows = np.arange(len(self))[rows]  # resolve negative indices
+        wyk_idx, n_wyks = csr_gather(self.wyk_ptr, rows)
+        sym_rows, n_sites = csr_gather(self.sym_ptr, rows)
+
+        n_elem = torch.from_numpy(n_wyks)
+        n_aug = torch.from_numpy(n_sites) // n_elem
+        aug_cry_idx, crystal_wyk_idx, aug_gather_idx = augmentation_indices(n_elem, n_aug)
+        self_idx, nbr_idx = batch_fully_connected_edges(n_elem[aug_cry_idx])
+
+        inputs = (
+            torch.from_numpy(self.wyk_weights[wyk_idx]).float(),
+            torch.from_numpy(self.wyk_z[wyk_idx]),
+            torch.from_numpy(self.sym_fea_table[self.sym_idx[sym_rows]]),
+            self_idx,
+            nbr_idx,
+            crystal_wyk_idx,
+            aug_cry_idx,
+            aug_gather_idx,
+            batch_ptr(n_aug),
         )
+        targets = tuple(col[torch.from_numpy(rows)][:, None] for col in self.targets)
+
+        return (inputs, targets, *zip(*(self.ids[row] for row in rows)))
 
 
 def collate_batch(
@@ -189,86 +280,164 @@ def collate_batch(
             nbr_fea (Tensor): _description_
             nbr_idx (LongTensor):
             target (Tensor):
+            The edge indices may be left out to build the edges of the whole batch
+            at once, see WyckoffData(collate_edges=True).
             cif_id: str or int
 
     Returns:
         tuple[
-            tuple[Tensor * 3, LongTensor * 4]: batched Wren model inputs,
+            tuple[Tensor * 3, LongTensor * 6]: batched Wren model inputs. Weights
+                and elements hold one row per unique Wyckoff position and are
+                expanded to the nodes of all augmentations by aug_gather_idx. The
+                last entry holds the CSR offsets of the augmentations of each crystal,
+                which marks all indices as sorted and gives the number of crystals,
             tuple[Tensor | LongTensor]: Target values for different tasks,
             *tuple[str | int]]: Identifiers like material_id, composition
         ]
     """
-    # define the lists
-    batch_mult_weights = []
-    batch_elem_fea = []
-    batch_sym_fea = []
-    batch_self_idx = []
-    batch_nbr_idx = []
-    crystal_wyk_idx = []
-    aug_cry_idx = []
-    batch_targets = []
-    batch_cry_ids = []
-
-    aug_count = 0
-    cry_base_idx = 0
-    for idx, (inputs, target, *cry_ids) in enumerate(samples):
-        mult_weights, elem_fea, sym_fea, self_idx, nbr_idx = inputs
-
-        n_elem = elem_fea.shape[0]
-        n_sites = sym_fea.shape[0]  # number of atoms for this crystal
-        n_aug = int(float(n_sites) / float(n_elem))
-
-        # batch the features together
-        batch_mult_weights.append(mult_weights.repeat((n_aug, 1)))
-        batch_elem_fea.append(elem_fea.repeat((n_aug, 1)))
-        batch_sym_fea.append(sym_fea)
-
-        # mappings from bonds to atoms
-        batch_self_idx.append(self_idx + cry_base_idx)
-        batch_nbr_idx.append(nbr_idx + cry_base_idx)
-
-        # mapping from atoms to crystals
-        crystal_wyk_idx.append(
-            torch.tensor(range(aug_count, aug_count + n_aug)).repeat_interleave(n_elem)
+    inputs, targets, *cry_ids = zip(*samples)
+    mult_weights, elem_fea, sym_fea, *edges = zip(*inputs)
+
+    n_elem = torch.tensor([len(fea) for fea in elem_fea])
+    n_sites = torch.tensor([len(fea) for fea in sym_fea])  # n_elem * n_aug
+    n_aug = n_sites // n_elem
+    aug_cry_idx, crystal_wyk_idx, aug_gather_idx = augmentation_indices(n_elem, n_aug)
+    aug_n_elem = n_elem[aug_cry_idx]
+
+    # mappings from bonds to atoms
+    if edges:
+        self_idx, nbr_idx = torch.cat(edges[0]), torch.cat(edges[1])
+        n_edges = torch.tensor([len(idx) for idx in edges[0]])
+        edge_offsets = batch_edge_offsets(n_sites, n_edges)
+        self_idx += edge_offsets
+        nbr_idx += edge_offsets
+    else:  # samples without edges, one fully connected graph per augmentation
+        self_idx, nbr_idx = batch_fully_connected_edges(aug_n_elem)
+
+    # weights and elements of the unique Wyckoff positions are only expanded to all
+    # augmentations with aug_gather_idx inside the model after embedding them
+    return (
+        (
+            torch.cat(mult_weights),
+            # elem_fea holds either atomic numbers (1d) or element features (2d)
+            torch.cat(elem_fea),
+            torch.cat(sym_fea),
+            self_idx,
+            nbr_idx,
+            crystal_wyk_idx,
+            aug_cry_idx,
+            aug_gather_idx,
+            batch_ptr(n_aug),
+        ),
+        tuple(torch.stack(b_target) for b_target in zip(*targets)),
+        *cry_ids,
+    )
+
+
+class WyckoffStreamData(ParquetShardDataset):
+    """Stream WyckoffData samples out of Parquet shards too large to fit in
+    memory, see ParquetShardDataset. Use with torch.utils.data.DataLoader and
+    collate_batch like WyckoffData.
+    """
+
+    def __init__(
+        self,
+        path: str | Sequence[str],
+        task_dict: dict[str, str],
+        inputs: str = "wyckoff",
+        identifiers: Sequence[str] = ("material_id", "composition", "wyckoff"),
+        shuffle: bool = False,
+        shuffle_buffer: int = 1024,
+        prefetch: int = 1,
+        seed: int = 0,
+        **kwargs: Any,
+    ) -> None:
+        """Index the row groups of all shards.
+
+        Args:
+            path (str | Sequence[str]): Directory holding *.parquet shards, a single
+                Parquet file or a list of them.
+            task_dict (dict[str, "regression" | "classification"]): Map from target
+                names to task type.
+            inputs (str, optional): Column holding the protostructure labels.
+                Defaults to "wyckoff".
+            identifiers (list, optional): Columns for distinguishing data points.
+                Defaults to ("material_id", "composition", "wyckoff").
+            shuffle (bool, optional): Whether to shuffle row groups and samples.
+                Defaults to False.
+            shuffle_buffer (int, optional): Number of samples to draw randomly from
+                if shuffle=True. Defaults to 1024.
+            prefetch (int, optional): Number of row groups to featurize ahead on a
+                background thread. Defaults to 1.
+            seed (int, optional): Seed for shuffling. Defaults to 0.
+            **kwargs: Passed to WyckoffData, e.g. elem_embedding or sym_emb.
+        """
+        super().__init__(
+            path,
+            featurize=partial(
+                WyckoffData,
+                task_dict=task_dict,
+                inputs=inputs,
+                identifiers=identifiers,
+                **kwargs,
+            ),
+            columns=list(dict.fromkeys([inputs, *identifiers, *task_dict])),
+            shuffle=shuffle,
+            shuffle_buffer=shuffle_buffer,
+            prefetch=prefetch,
+            seed=seed,
         )
-        aug_cry_idx.append(torch.tensor([idx] * n_aug))
 
-        # batch the targets and ids
-        batch_targets.append(target)
-        batch_cry_ids.append(cry_ids)
 
-        # increment the id counter
-        aug_count += n_aug
-        cry_base_idx += n_sites
+def augmentation_indices(
+    n_elem: LongTensor, n_aug: LongTensor
+) -> tuple[LongTensor, LongTensor, LongTensor]:
+    """Index tensors to batch Wren samples whose Wyckoff positions are repeated for
+    each equivalent Wyckoff set (augmentation).
 
-    return (
-        (
-            torch.cat(batch_mult_weights, dim=0),
-            torch.cat(batch_elem_fea, dim=0),
-            torch.cat(batch_sym_fea, dim=0),
-            torch.cat(batch_self_idx, dim=0),
-            torch.cat(batch_nbr_idx, dim=0),
-            torch.cat(crystal_wyk_idx),
-            torch.cat(aug_cry_idx),
-        ),
-        tuple(torch.stack(b_target, dim=0) for b_target in zip(*batch_targets)),
-        *zip(*batch_cry_ids),
+    Args:
+        n_elem (LongTensor): Number of Wyckoff positions of each crystal.
+        n_aug (LongTensor): Number of augmentations of each crystal.
+
+    Returns:
+        tuple[LongTensor, LongTensor, LongTensor]: crystal index of each augmentation,
+            augmentation index of each node and, for each node, the index of its
+            Wyckoff position among the concatenated Wyckoff positions of all crystals.
+    """
+    n_augs = int(n_aug.sum())
+    aug_cry_idx = torch.arange(len(n_elem)).repeat_interleave(n_aug, output_size=n_augs)
+    aug_n_elem = n_elem[aug_cry_idx]
+    n_nodes = int(aug_n_elem.sum())
+    crystal_wyk_idx = torch.arange(n_augs).repeat_interleave(
+        aug_n_elem, output_size=n_nodes
     )
 
+    # repeat the Wyckoff positions of each crystal for every augmentation
+    aug_offsets = (aug_n_elem.cumsum(0) - aug_n_elem)[crystal_wyk_idx]
+    elem_offsets = (n_elem.cumsum(0) - n_elem)[aug_cry_idx][crystal_wyk_idx]
+    aug_gather_idx = torch.arange(n_nodes) - aug_offsets + elem_offsets
+
+    return aug_cry_idx, crystal_wyk_idx, aug_gather_idx
 
+
+@lru_cache(maxsize=2**16)
 def parse_protostructure_label(
     protostructure_label: str,
-) -> tuple[str, list[float], list[str], list[tuple[str, ...]]]:
+) -> tuple[str, tuple[float, ...], tuple[str, ...], tuple[tuple[str, ...], ...]]:
     """Parse the Wren AFLOW-like Wyckoff encoding.
 
+    Results are memoized in a bounded LRU cache since datasets usually contain far
+    fewer unique protostructures than rows, see parse_protostructure_label.cache_info()
+    for hit/miss counts. Hence the returned sequences are immutable tuples.
+
     Args:
         protostructure_label (str): label constructed as `aflow_label:chemsys` where
             aflow_label is an AFLOW-style prototype label chemsys is the alphabetically
             sorted chemical system.
 
     Returns:
-        tuple[str, list[float], list[str], list[str]]: spacegroup number, Wyckoff site
-            multiplicities, elements symbols and equivalent wyckoff sets
+        tuple[str, tuple[float], tuple[str], tuple[tuple[str]]]: spacegroup number,
+            Wyckoff site multiplicities, elements symbols and equivalent wyckoff sets
     """
     aflow_label, chemsys = protostructure_label.split(":")
     elems = chemsys.split("-")
@@ -276,8 +445,7 @@ def parse_protostructure_label(
 
     if len(elems) != len(wyckoff_letters):
         raise ValueError(
-            f"Chemical system {chemsys} does not match Wyckoff letters "
-            f"{wyckoff_letters}"
+            f"Chemical system {chemsys} does not match Wyckoff letters {wyckoff_letters}"
         )
 
     wyckoff_site_multiplicities = []
@@ -304,10 +472,34 @@ def parse_protostructure_label(
                 [float(wyckoff_multiplicity_dict[spg_num][letter])] * mult
             )
 
-    # Create augmented Wyckoff set
-    augmented_wyckoff_set = {
-        tuple(",".join(wyckoff_set).translate(str.maketrans(trans)).split(","))
-        for trans in relab_dict[spg_num]
-    }
+    # Create augmented Wyckoff set, deduplicated in order of the relabelings
+    wyckoff_str = ",".join(wyckoff_set)
+    augmented_wyckoff_set = dict.fromkeys(
+        tuple(wyckoff_str.translate(table).split(",")) for table in relab_tables[spg_num]
+    )
 
-    return spg_num, wyckoff_site_multiplicities, elements, list(augmented_wyckoff_set)
+    return (
+        spg_num,
+        tuple(wyckoff_site_multiplicities),
+        tuple(elements),
+        tuple(augmented_wyckoff_set),
+    )
+
+
+def parse_protostructure_labels(
+    protostructure_labels: Iterable[str],
+) -> list[tuple[str, tuple[float, ...], tuple[str, ...], tuple[tuple[str, ...], ...]]]:
+    """Parse many protostructure labels at once, parsing each unique label only once.
+
+    Args:
+        protostructure_labels (Iterable[str]): Labels, e.g. a DataFrame column.
+
+    Returns:
+        list[tuple]: parse_protostructure_label() output for each label.
+    """
+    protostructure_labels = list(protostructure_labels)
+    parsed = {
+        label: parse_protostructure_label(label)
+        for label in dict.fromkeys(protostructure_labels)
+    }
+    return [parsed[label] for label in protostructure_labels]
@@ -8,9 +8,13 @@ from pymatgen.util.due import Doi, due
 from torch import LongTensor, Tensor, nn
 
 from aviary.core import BaseModelClass
-from aviary.networks import ResidualNetwork, SimpleNetwork
-from aviary.scatter import scatter_reduce
-from aviary.segments import MessageLayer, WeightedAttentionPooling
+from aviary.networks import ResidualNetwork
+from aviary.scatter import scatter_reduce, segment_ptr
+from aviary.segments import (
+    FrozenElementEmbedding,
+    MessageLayer,
+    MultiHeadAttentionPooling,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Sequence
@@ -44,6 +48,7 @@ class Wren(BaseModelClass):
         cry_msg: Sequence[int] = (256,),
         trunk_hidden: Sequence[int] = (1024, 512),
         out_hidden: Sequence[int] = (256, 128, 64),
+        elem_embedding: str | None = "matscholar200",
         **kwargs,
     ) -> None:
         """Composition plus symmetry model.
@@ -72,10 +77,18 @@ class Wren(BaseModelClass):
             cry_msg (list[int], optional): _description_. Defaults to [256].
             trunk_hidden (list[int], optional): _description_. Defaults to [1024, 512].
             out_hidden (list[int], optional): _description_. Defaults to [256, 128, 64].
+            elem_embedding (str, optional): Element embedding to look up features of
+                atomic number inputs in. One of "matscholar200", "cgcnn92", "megnet16",
+                "onehot112" or path to a custom embedding file. Must be the one of the
+                dataset since it emits atomic numbers. None means inputs are
+                precomputed element features. Defaults to "matscholar200" like the
+                dataset.
             **kwargs: Additional keyword arguments to pass to BaseModelClass.
         """
         super().__init__(robust=robust, **kwargs)
 
+        self.elem_lookup = FrozenElementEmbedding(elem_emb_len, elem_embedding)
+
         desc_dict = {
             "elem_emb_len": elem_emb_len,
             "elem_fea_len": elem_fea_len,
@@ -95,6 +108,7 @@ class Wren(BaseModelClass):
         model_params = {
             "robust": robust,
             "n_targets": n_targets,
+            "elem_embedding": self.elem_lookup.elem_embedding,
             "out_hidden": out_hidden,
             "trunk_hidden": trunk_hidden,
             **desc_dict,
@@ -122,22 +136,32 @@ class Wren(BaseModelClass):
         nbr_idx: LongTensor,
         cry_elem_idx: LongTensor,
         aug_cry_idx: LongTensor,
+        aug_gather_idx: LongTensor | None = None,
+        aug_cry_ptr: LongTensor | None = None,
     ) -> tuple[Tensor, ...]:
         """Forward pass through the material_nn and output_nn.
 
         Args:
             elem_weights (Tensor): _description_
-            elem_fea (Tensor): _description_
+            elem_fea (Tensor): Atomic numbers or element features of each element
             sym_fea (Tensor): _description_
             self_idx (LongTensor): _description_
             nbr_idx (LongTensor): _description_
             cry_elem_idx (LongTensor): _description_
             aug_cry_idx (LongTensor): _description_
+            aug_gather_idx (LongTensor, optional): Index of the unique Wyckoff position
+                in elem_weights and elem_fea of each node of all augmentations.
+                Defaults to None meaning they already hold one row per node.
+            aug_cry_ptr (LongTensor, optional): CSR offsets of the augmentations of
+                each crystal as emitted by collate_batch, which marks all indices of
+                the batch as sorted to reduce them segment-wise. Its length also gives
+                the number of crystals without reading aug_cry_idx back from the
+                device. Defaults to None.
 
         Returns:
             tuple[Tensor, ...]: Predicted values for each target
         """
-        crys_fea = self.material_nn(
+        crys_fea = self.material_features(
             elem_weights,
             elem_fea,
             sym_fea,
@@ -145,6 +169,8 @@ class Wren(BaseModelClass):
             nbr_idx,
             cry_elem_idx,
             aug_cry_idx,
+            aug_gather_idx,
+            aug_cry_ptr,
         )
 
         crys_fea = F.relu(self.trunk_nn(crys_fea))
@@ -152,6 +178,21 @@ class Wren(BaseModelClass):
         # apply neural network to map from learned features to target
         return tuple(output_nn(crys_fea) for output_nn in self.output_nns)
 
+    def material_features(
+        self, elem_weights: Tensor, elem_fea: Tensor, *graph: Tensor
+    ) -> Tensor:
+        """Look up element features and pool them with the material_nn.
+
+        Args:
+            elem_weights (Tensor): Fractional weight of each Wyckoff position
+            elem_fea (Tensor): Atomic numbers or element features of each position
+            *graph (Tensor): Remaining inputs of forward()
+
+        Returns:
+            Tensor: Crystal features of each material
+        """
+        return self.material_nn(elem_weights, self.elem_lookup(elem_fea), *graph)
+
 
 class DescriptorNetwork(nn.Module):
     """The Descriptor Network is the message passing section of the Roost model."""
@@ -211,12 +252,12 @@ class DescriptorNetwork(nn.Module):
         )
 
         # define a global pooling function for materials
-        self.cry_pool = nn.ModuleList(
-            WeightedAttentionPooling(
-                gate_nn=SimpleNetwork(fea_len, 1, cry_gate),
-                message_nn=SimpleNetwork(fea_len, fea_len, cry_msg),
-            )
-            for _ in range(cry_heads)
+        self.cry_pool = MultiHeadAttentionPooling(
+            fea_len,
+            fea_len,
+            num_heads=cry_heads,
+            gate_hidden=cry_gate,
+            msg_hidden=cry_msg,
         )
 
     def forward(
@@ -228,6 +269,8 @@ class DescriptorNetwork(nn.Module):
         nbr_idx: LongTensor,
         cry_elem_idx: LongTensor,
         aug_cry_idx: LongTensor,
+        aug_gather_idx: LongTensor | None = None,
+        aug_cry_ptr: LongTensor | None = None,
     ) -> Tensor:
         """Forward pass.
 
@@ -241,33 +284,58 @@ class DescriptorNetwork(nn.Module):
             nbr_idx (Tensor): Indices of the second element in each of the M pairs
             cry_elem_idx (Tensor): Mapping from the elem idx to crystal idx
             aug_cry_idx (Tensor): Mapping from the crystal idx to augmentation idx
+            aug_gather_idx (Tensor, optional): Mapping from the N elements of all
+                augmentations to the unique elements in elem_weights and elem_fea.
+                Defaults to None meaning they already hold N rows.
+            aug_cry_ptr (LongTensor, optional): CSR offsets of the augmentations of
+                each crystal as emitted by collate_batch, which marks all indices of
+                the batch as sorted to reduce them segment-wise. Its length also gives
+                the number of crystals without reading aug_cry_idx back from the
+                device. Defaults to None.
 
         Returns:
             Tensor: crystal features of the materials in the batch
         """
         # embed the original features into the graph layer description
         elem_fea = self.elem_embed(elem_fea)
+        if aug_gather_idx is not None:
+            # embed each unique element once, then repeat it for every augmentation
+            elem_fea = elem_fea[aug_gather_idx]
+            elem_weights = elem_weights[aug_gather_idx]
         sym_fea = self.sym_embed(torch.cat([sym_fea, elem_weights], dim=1))
 
         elem_fea = torch.cat([elem_fea, sym_fea], dim=1)
 
+        # offsets of the edges of each node and of the nodes of each augmentation
+        self_ptr = aug_elem_ptr = None
+        if aug_cry_ptr is not None:
+            self_ptr = segment_ptr(self_idx, len(elem_fea))
+            aug_elem_ptr = segment_ptr(cry_elem_idx, len(aug_cry_idx))
+
         # apply the message passing functions
         for graph_func in self.graphs:
-            elem_fea = graph_func(elem_weights, elem_fea, self_idx, nbr_idx)
+            elem_fea = graph_func(elem_weights, elem_fea, self_idx, nbr_idx, self_ptr)
 
-        # generate crystal features by pooling the elemental features
-        head_fea = [
-            attnhead(elem_fea, index=cry_elem_idx, weights=elem_weights)
-            for attnhead in self.cry_pool
-        ]
+        # generate features of every augmentation by pooling the elemental features
+        aug_fea = self.cry_pool(
+            elem_fea,
+            index=cry_elem_idx,
+            weights=elem_weights,
+            dim_size=len(aug_cry_idx),
+            ptr=aug_elem_ptr,
+        )
 
         return scatter_reduce(
-            torch.mean(torch.stack(head_fea), dim=0), aug_cry_idx, dim=0, reduce="mean"
+            aug_fea,
+            aug_cry_idx,
+            dim=0,
+            reduce="mean",
+            ptr=aug_cry_ptr,
         )
 
     def __repr__(self) -> str:
         return (
             f"{type(self).__name__}(n_graph={len(self.graphs)}, cry_heads="
-            f"{len(self.cry_pool)}, elem_emb_len={self.elem_emb_len}, "
+            f"{self.cry_pool.num_heads}, elem_emb_len={self.elem_emb_len}, "
             f"sym_emb_len={self.sym_emb_len})"
         )
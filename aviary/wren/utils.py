@@ -35,6 +35,11 @@ relab_dict = {
     spg_num: [{int(key): line for key, line in val.items()} for val in vals]
     for spg_num, vals in relab_dict.items()
 }
+# str.translate tables of the relabelings, built once instead of on every use
+relab_tables = {
+    spg_num: [str.maketrans(trans) for trans in vals]
+    for spg_num, vals in relab_dict.items()
+}
 
 cry_sys_dict = {
     "triclinic": "a",
@@ -329,10 +334,7 @@ def canonicalize_element_wyckoffs(element_wyckoffs: str, spg_num: int | str) ->
         str: element_wyckoff string with canonical ordering of the wyckoff letters.
     """
     isopointal_element_wyckoffs = list(
-        {
-            element_wyckoffs.translate(str.maketrans(trans))
-            for trans in relab_dict[str(spg_num)]
-        }
+        {element_wyckoffs.translate(table) for table in relab_tables[str(spg_num)]}
     )
 
     scored_element_wyckoffs = [
@@ -576,9 +578,9 @@ def get_prototype_from_protostructure(protostructure_label: str) -> str:
 
     isopointal_all_wyckoffs = list(
         {
-            all_wyckoffs.translate(str.maketrans(trans))
+            all_wyckoffs.translate(table)
             for all_wyckoffs in all_wyckoffs_permutations
-            for trans in relab_dict[spg_num]
+            for table in relab_tables[spg_num]
         }
     )
 
@@ -1,37 +1,389 @@
 from __future__ import annotations
 
+import copy
 import json
-from functools import cache
+from dataclasses import dataclass
+from functools import cache, partial
 from typing import TYPE_CHECKING, Any, Literal
 
 import numpy as np
 import torch
-from pymatgen.core import Composition
 from torch import LongTensor, Tensor, nn
+from torch.utils.data import Sampler
 
 from aviary import PKG_DIR
-from aviary.data import InMemoryDataLoader
+from aviary.data import InMemoryDataLoader, ParquetShardDataset
+from aviary.roost.data import parse_formula
 from aviary.wren.data import parse_protostructure_label
 
 if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator, Sequence
+
     import pandas as pd
+    from torch import BoolTensor
+
+
+@dataclass
+class PackedSequences:
+    """Ragged Wrenformer/Roostformer input embeddings packed into one contiguous
+    feature buffer. Each row consists of n_equiv equivalent sequences (Wyckoff sets)
+    of seq_len tokens stored back-to-back starting at token row_start. Rows with
+    identical inputs can share their tokens.
+
+    Indexing selects rows without copying the feature buffer, to_padded() or
+    to_jagged() then gather the batch in a few vectorized ops.
+
+    Args:
+        features (Tensor): Token features of shape (n_tokens, n_features).
+        row_start (LongTensor): Index of the first token of each row.
+        seq_len (LongTensor): Number of tokens per sequence of each row.
+        n_equiv (LongTensor): Number of equivalent sequences of each row.
+        has_equivalents (bool): True for 3d Wrenformer embeddings, False for 2d
+            Roostformer embeddings which have a single sequence per row.
+    """
+
+    features: Tensor
+    row_start: LongTensor
+    seq_len: LongTensor
+    n_equiv: LongTensor
+    has_equivalents: bool = True
+
+    @classmethod
+    def from_tensors(
+        cls, tensors: Sequence[Tensor], device: str | torch.device | None = None
+    ) -> PackedSequences:
+        """Pack a sequence of per-row embeddings. Rows holding the same tensor object
+        share their tokens in the packed buffer.
+
+        Args:
+            tensors (list[Tensor]): 3d Wrenformer embeddings of shape (n_equiv,
+                seq_len, n_features) or 2d Roostformer embeddings of shape (seq_len,
+                n_features).
+            device (str | torch.device, optional): Device to store the packed
+                tensors on. Defaults to None meaning the device of the inputs.
+
+        Returns:
+            PackedSequences: Packed embeddings with one row per input tensor.
+        """
+        token_offsets: dict[int, int] = {}  # id of packed tensor -> first token
+        chunks, row_start, seq_len, n_equiv = [], [], [], []
+        n_tokens = 0
+        for tensor in tensors:
+            if id(tensor) not in token_offsets:
+                token_offsets[id(tensor)] = n_tokens
+                chunks.append(tensor.reshape(-1, tensor.shape[-1]))
+                n_tokens += len(chunks[-1])
+            row_start.append(token_offsets[id(tensor)])
+            seq_len.append(tensor.shape[-2])
+            n_equiv.append(tensor.shape[0] if tensor.ndim == 3 else 1)
+
+        def to_long(values: list[int]) -> LongTensor:
+            return torch.tensor(values, dtype=torch.long, device=device)
+
+        return cls(
+            features=torch.cat(chunks).to(device),
+            row_start=to_long(row_start),
+            seq_len=to_long(seq_len),
+            n_equiv=to_long(n_equiv),
+            has_equivalents=len(tensors) > 0 and tensors[0].ndim == 3,
+        )
+
+    def __len__(self) -> int:
+        return len(self.row_start)
+
+    @property
+    def n_features(self) -> int:
+        """Number of features per token."""
+        return self.features.shape[-1]
+
+    def __getitem__(self, idx: int | slice | np.ndarray | Tensor) -> PackedSequences:
+        """Select rows. Returns a PackedSequences sharing the feature buffer."""
+        if isinstance(idx, (int, np.integer)):
+            idx = slice(idx, int(idx) + 1 or None)
+        elif not isinstance(idx, slice):
+            idx = torch.as_tensor(idx, device=self.row_start.device)
+        return type(self)(
+            features=self.features,
+            row_start=self.row_start[idx],
+            seq_len=self.seq_len[idx],
+            n_equiv=self.n_equiv[idx],
+            has_equivalents=self.has_equivalents,
+        )
+
+    def _sequences(self) -> tuple[LongTensor, LongTensor]:
+        """Index of the first token and number of tokens of each sequence."""
+        device = self.row_start.device
+        n_seqs = int(self.n_equiv.sum())
+        # row index of each sequence and its position among the row's sequences
+        seq_row = torch.arange(len(self), device=device).repeat_interleave(
+            self.n_equiv, output_size=n_seqs
+        )
+        first_seq = (self.n_equiv.cumsum(0) - self.n_equiv)[seq_row]
+        seq_pos = torch.arange(n_seqs, device=device) - first_seq
+        seq_lens = self.seq_len[seq_row]
+        return self.row_start[seq_row] + seq_pos * seq_lens, seq_lens
+
+    def to_padded(self) -> tuple[Tensor, BoolTensor, list[int]]:
+        """Gather all sequences into a zero-padded batch.
+
+        Returns:
+            tuple[Tensor, BoolTensor, list[int]]: padded features of shape (n_seqs,
+                max_seq_len, n_features), padding mask of shape (n_seqs,
+                max_seq_len) which is True for padded entries, and the number of
+                equivalent sequences of each row.
+        """
+        seq_start, seq_lens = self._sequences()
+        max_len = int(self.seq_len.max()) if len(self) else 0
+        positions = torch.arange(max_len, device=seq_lens.device)
+        mask = positions >= seq_lens[:, None]
+        token_idx = (seq_start[:, None] + positions).masked_fill(mask, 0)
+        padded = self.features[token_idx].masked_fill(mask[..., None], 0)
+
+        return padded, mask, self.n_equiv.tolist()
+
+    def to_jagged(self) -> tuple[Tensor, LongTensor, list[int]]:
+        """Gather all sequences into a jagged nested tensor without padding.
+
+        Returns:
+            tuple[Tensor, LongTensor, list[int]]: nested features of shape (n_seqs,
+                j, n_features) with layout torch.jagged, number of tokens of each
+                sequence, and the number of equivalent sequences of each row.
+        """
+        seq_start, seq_lens = self._sequences()
+        offsets = torch.cat([seq_lens.new_zeros(1), seq_lens.cumsum(0)])
+        n_tokens = int(offsets[-1])
+        # shift positions in the jagged values to positions in the packed buffer
+        token_idx = torch.arange(n_tokens, device=seq_lens.device) + (
+            seq_start - offsets[:-1]
+        ).repeat_interleave(seq_lens, output_size=n_tokens)
+        nested = torch.nested.nested_tensor_from_jagged(self.features[token_idx], offsets)
+        return nested, seq_lens, self.n_equiv.tolist()
+
+
+def sequence_lengths(
+    features: Sequence[Tensor] | PackedSequences,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Number of tokens per sequence and number of equivalent sequences of each row.
+
+    Args:
+        features (list[Tensor] | PackedSequences): Wyckoff or composition embeddings,
+            either one tensor per row or packed into one buffer.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: seq_len and n_equiv of each row.
+    """
+    if isinstance(features, PackedSequences):
+        return features.seq_len.cpu().numpy(), features.n_equiv.cpu().numpy()
+    seq_len = np.array([tensor.shape[-2] for tensor in features], dtype=np.int64)
+    n_equiv = np.array(
+        [tensor.shape[0] if tensor.ndim == 3 else 1 for tensor in features],
+        dtype=np.int64,
+    )
+    return seq_len, n_equiv
+
+
+def padding_efficiency(
+    seq_len: np.ndarray, n_equiv: np.ndarray, batches: Iterable[Sequence[int]]
+) -> float:
+    """Fraction of real (i.e. non-padding) tokens in the padded batches that
+    collate_batch() produces from the given row indices.
+
+    Args:
+        seq_len (np.ndarray): Number of tokens per sequence of each row.
+        n_equiv (np.ndarray): Number of equivalent sequences of each row.
+        batches (Iterable[Sequence[int]]): Row indices of each batch.
+
+    Returns:
+        float: Real tokens divided by padded tokens, 1 means no padding.
+    """
+    n_real = n_padded = 0
+    for batch in batches:
+        batch_len, batch_equiv = seq_len[batch], n_equiv[batch]
+        n_real += int(batch_len @ batch_equiv)
+        n_padded += int(batch_len.max(initial=0)) * int(batch_equiv.sum())
+    return n_real / n_padded if n_padded else 1.0
+
+
+class LengthBucketSampler(Sampler[list[int]]):
+    """Batch sampler grouping rows of similar sequence length and number of
+    equivalent sequences to minimise padding in collate_batch().
+
+    Each epoch, rows are shuffled and split into pools of pool_size batches. Rows in
+    a pool are sorted by sequence length, then number of equivalent sequences, before
+    being cut into batches. The order of all batches is then shuffled. So batches and
+    their order change every epoch while each batch holds rows of similar length.
+    With shuffle=False, all rows are sorted into the most compact batches once. Rows
+    are then no longer in dataset order, so match predictions to targets by ID.
+
+    Can be passed as batch_sampler to InMemoryDataLoader or torch DataLoader.
+    """
+
+    def __init__(
+        self,
+        seq_len: Sequence[int],
+        n_equiv: Sequence[int] | None = None,
+        batch_size: int = 64,
+        shuffle: bool = True,
+        pool_size: int = 50,
+        drop_last: bool = False,
+        seed: int | None = None,
+    ) -> None:
+        """Initialize the sampler.
+
+        Args:
+            seq_len (Sequence[int]): Number of tokens per sequence of each row.
+            n_equiv (Sequence[int], optional): Number of equivalent sequences (Wyckoff
+                sets) of each row. Defaults to None meaning 1 for all rows.
+            batch_size (int, optional): Number of rows per batch. Defaults to 64.
+            shuffle (bool, optional): Whether to draw new random batches every epoch.
+                Defaults to True.
+            pool_size (int, optional): Number of batches whose rows are sorted jointly.
+                Larger pools pad less but give less random batches. Defaults to 50.
+            drop_last (bool, optional): Whether to drop the last batch if it is smaller
+                than batch_size. Defaults to False.
+            seed (int, optional): Seed which together with the epoch seeds the
+                shuffle of every epoch, required when sharding batches across
+                data-parallel ranks. Defaults to None meaning the global NumPy RNG
+                like InMemoryDataLoader.
+        """
+        self.seq_len = np.asarray(seq_len, dtype=np.int64)
+        self.n_equiv = (
+            np.ones_like(self.seq_len)
+            if n_equiv is None
+            else np.asarray(n_equiv, dtype=np.int64)
+        )
+        if self.seq_len.shape != self.n_equiv.shape:
+            raise ValueError(
+                f"seq_len and n_equiv must have the same length, got "
+                f"{len(self.seq_len)} and {len(self.n_equiv)}"
+            )
+        if batch_size < 1 or pool_size < 1:
+            raise ValueError(f"{batch_size=} and {pool_size=} must be positive")
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.batches: list[list[int]] | None = None  # batches of the latest epoch
+
+    @classmethod
+    def from_features(
+        cls, features: Sequence[Tensor] | PackedSequences, **kwargs: Any
+    ) -> LengthBucketSampler:
+        """Create a sampler from the inputs of a Wrenformer/Roostformer loader.
+
+        Args:
+            features (list[Tensor] | PackedSequences): Embeddings of each row.
+            **kwargs: Passed to LengthBucketSampler, e.g. batch_size and shuffle.
+
+        Returns:
+            LengthBucketSampler: Sampler over the rows of features.
+        """
+        seq_len, n_equiv = sequence_lengths(features)
+        return cls(seq_len, n_equiv, **kwargs)
+
+    def _sorted(self, rows: np.ndarray) -> np.ndarray:
+        """Sort rows by sequence length, then number of equivalent sequences."""
+        return rows[np.lexsort((self.n_equiv[rows], self.seq_len[rows]))]
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch which seeds the shuffle of the next iterator, like
+        InMemoryDataLoader.set_epoch().
+        """
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[list[int]]:
+        epoch = self.epoch
+        self.epoch += 1
+        rng = (
+            np.random if self.seed is None else np.random.default_rng([self.seed, epoch])
+        )
+        n_rows, batch_size = len(self.seq_len), self.batch_size
+        if self.shuffle:
+            rows = rng.permutation(n_rows)
+            pool_len = batch_size * self.pool_size
+            pools = [
+                rows[start : start + pool_len] for start in range(0, n_rows, pool_len)
+            ]
+            rows = np.concatenate([self._sorted(pool) for pool in pools] or [rows])
+        else:
+            rows = self._sorted(np.arange(n_rows))
+
+        # pools hold whole batches so only the very last batch can be smaller
+        batches = [
+            rows[start : start + batch_size].tolist()
+            for start in range(0, n_rows, batch_size)
+        ]
+        if self.drop_last and batches and len(batches[-1]) < batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[idx] for idx in rng.permutation(len(batches))]
+
+        self.batches = batches
+        return iter(batches)
+
+    def __len__(self) -> int:
+        """Get the number of batches per epoch."""
+        n_batches, remainder = divmod(len(self.seq_len), self.batch_size)
+        return n_batches + bool(remainder and not self.drop_last)
+
+    def padding_efficiency(self, batches: Iterable[Sequence[int]] | None = None) -> float:
+        """Fraction of real tokens in the padded batches.
+
+        Args:
+            batches (Iterable[Sequence[int]], optional): Row indices of each batch.
+                Defaults to None meaning the batches of the latest epoch. If no epoch
+                was drawn yet, those of the next epoch (of seed 0 if unseeded) are
+                drawn from a copy of the sampler so its RNG and epoch are untouched.
+
+        Returns:
+            float: Real tokens divided by padded tokens, 1 means no padding.
+        """
+        if batches is None and self.batches is None:
+            sampler = copy.copy(self)
+            sampler.seed = 0 if self.seed is None else self.seed
+            batches = list(sampler)
+        elif batches is None:
+            batches = self.batches
+        return padding_efficiency(self.seq_len, self.n_equiv, batches)
 
 
 def collate_batch(
-    features: tuple[Tensor], targets: Tensor | LongTensor, ids: list[str | int]
+    features: tuple[Tensor] | PackedSequences,
+    targets: Tensor | LongTensor,
+    ids: list[str | int],
+    nested: bool = False,
 ):
     """Zero-pad sequences of Wyckoff embeddings to the longest one in the batch and
     generate a mask to ignore padded values during self-attention.
 
     Args:
-        features (tuple[Tensor]): Wyckoff embeddings
+        features (tuple[Tensor] | PackedSequences): Wyckoff embeddings, either one
+            tensor per material or packed into one buffer
         targets (list[Tensor | LongTensor]): For each multi-task objective, a float
             tensor for regression or integer class labels for classification.
         ids (list[str | int]): Material identifiers. Can be anything
+        nested (bool): If True, return a jagged nested tensor holding only the real
+            tokens and the number of tokens of each sequence instead of padded
+            features and mask, for downstream code that skips padded work.
+            Wrenformer itself only takes padded batches. Defaults to False.
 
     Returns:
-        tuple: Tuple of padded features and mask, targets and ids.
+        tuple: Tuple of padded features and mask (or nested features and sequence
+            lengths), targets and ids.
     """
+    # insert outer dimension corresponding to different multi-tasking objectives
+    targets = targets[None, ...]
+
+    if isinstance(features, PackedSequences):
+        has_equivalents = features.has_equivalents
+        to_batch = features.to_jagged if nested else features.to_padded
+        batch_features, mask_or_lens, equivalence_counts = to_batch()
+        if has_equivalents:
+            return (batch_features, mask_or_lens, equivalence_counts), targets, ids
+        return (batch_features, mask_or_lens), targets, ids
+
     if features[0].ndim == 3:
         # wrenformer features are 3d with shape (n_equiv_wyksets [ragged],
         # n_wyckoff_sites_per_set [ragged], n_features [uniform])
@@ -44,19 +396,25 @@ def collate_batch(
     else:
         restacked = features  # for roostformer we do nothing
 
-    padded_features = nn.utils.rnn.pad_sequence(restacked, batch_first=True)
-
-    # padded_features.shape = (batch_size * mean_n_equiv_wyksets, max_seq_len,
-    # n_features), so we mask sequence items that are all zero across feature dimension
-    mask = (padded_features == 0).all(dim=2)
-
-    # insert outer dimension corresponding to different multi-tasking objectives
-    targets = targets[None, ...]
+    seq_lens = torch.tensor([len(seq) for seq in restacked], device=restacked[0].device)
+    if nested:
+        offsets = torch.cat([seq_lens.new_zeros(1), seq_lens.cumsum(0)])
+        batch_features = torch.nested.nested_tensor_from_jagged(
+            torch.cat(list(restacked)), offsets
+        )
+        mask_or_lens = seq_lens
+    else:
+        batch_features = nn.utils.rnn.pad_sequence(restacked, batch_first=True)
+        # padded_features.shape = (batch_size * mean_n_equiv_wyksets, max_seq_len,
+        # n_features), mask the padding beyond each sequence's length (rather than
+        # all-zero tokens which would also hide real tokens without features)
+        positions = torch.arange(batch_features.shape[1], device=seq_lens.device)
+        mask_or_lens = positions >= seq_lens[:, None]
 
     if features[0].ndim == 3:
-        return (padded_features, mask, equivalence_counts), targets, ids
+        return (batch_features, mask_or_lens, equivalence_counts), targets, ids
 
-    return (padded_features, mask), targets, ids
+    return (batch_features, mask_or_lens), targets, ids
 
 
 with open(f"{PKG_DIR}/embeddings/wyckoff/bra-alg-off.json") as file:
@@ -130,8 +488,7 @@ def get_composition_embedding(formula: str) -> Tensor:
     Returns:
         Tensor: Shape (n_elements, n_features). Usually (2-6, 200).
     """
-    composition_dict = Composition(formula).get_el_amt_dict()
-    elements, elem_weights = zip(*composition_dict.items())
+    elements, elem_weights = zip(*parse_formula(formula))
 
     elem_weights = np.atleast_2d(elem_weights).T / sum(elem_weights)
 
@@ -145,6 +502,18 @@ def get_composition_embedding(formula: str) -> Tensor:
     return torch.cat([element_ratios, element_features], dim=1).float()
 
 
+def get_embedding_fn(
+    embedding_type: Literal["wyckoff", "composition"],
+) -> Callable[[str], Tensor]:
+    """Get the function embedding input strings of the given type."""
+    if embedding_type not in ("wyckoff", "composition"):
+        raise ValueError(f"{embedding_type = } must be 'wyckoff' or 'composition'")
+
+    if embedding_type == "wyckoff":
+        return wyckoff_embedding_from_protostructure_label
+    return get_composition_embedding
+
+
 def df_to_in_mem_dataloader(
     df: pd.DataFrame,
     input_col: str = "wyckoff",
@@ -152,6 +521,9 @@ def df_to_in_mem_dataloader(
     id_col: str | None = None,
     embedding_type: Literal["wyckoff", "composition"] = "wyckoff",
     device: str | None = None,
+    packed: bool = True,
+    bucket_by_length: bool = False,
+    nested: bool = False,
     **kwargs: Any,
 ) -> InMemoryDataLoader:
     """Construct an InMemoryDataLoader with Wrenformer batch collation from a dataframe.
@@ -171,6 +543,15 @@ def df_to_in_mem_dataloader(
         embedding_type ('wyckoff' | 'composition'): Defaults to "wyckoff".
         device (str): torch.device to load tensors onto. Defaults to
             "cuda" if torch.cuda.is_available() else "cpu".
+        packed (bool): If True (default), store all input embeddings in one
+            contiguous PackedSequences buffer on device from which batches are
+            gathered in a few vectorized ops. If False, keep one tensor per row.
+        bucket_by_length (bool): If True, batch rows of similar sequence length
+            with a LengthBucketSampler to minimise padding. Batches then come out of
+            dataset order, also for shuffle=False. Defaults to False.
+        nested (bool): If True, batches hold jagged nested tensors of only the real
+            tokens and sequence lengths instead of padded features and masks, see
+            collate_batch(). Defaults to False.
         kwargs (dict): Keyword arguments like batch_size: int and shuffle: bool
             to pass to InMemoryDataLoader. Defaults to None.
 
@@ -181,14 +562,9 @@ def df_to_in_mem_dataloader(
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    if embedding_type not in ("wyckoff", "composition"):
-        raise ValueError(f"{embedding_type = } must be 'wyckoff' or 'composition'")
-
-    initial_embeddings = df[input_col].map(
-        wyckoff_embedding_from_protostructure_label
-        if embedding_type == "wyckoff"
-        else get_composition_embedding
-    )
+    embed_fn = get_embedding_fn(embedding_type)
+    # embed each unique input once, rows with the same input share a tensor
+    unique_embeddings = {key: embed_fn(key) for key in dict.fromkeys(df[input_col])}
     targets = (
         torch.tensor(df[target_col].to_numpy(), device=device)
         if target_col in df
@@ -197,9 +573,133 @@ def df_to_in_mem_dataloader(
     if targets.dtype == torch.bool:
         targets = targets.long()  # convert binary classification targets to 0 and 1
 
-    inputs = np.empty(len(initial_embeddings), dtype=object)
-    for idx, tensor in enumerate(initial_embeddings):
-        inputs[idx] = tensor.to(device)
+    if packed:
+        inputs = PackedSequences.from_tensors(
+            [unique_embeddings[key] for key in df[input_col]], device=device
+        )
+    else:
+        unique_embeddings = {
+            key: tensor.to(device) for key, tensor in unique_embeddings.items()
+        }
+        inputs = np.empty(len(df), dtype=object)
+        for idx, key in enumerate(df[input_col]):
+            inputs[idx] = unique_embeddings[key]
+
+    batch_sampler = None
+    if bucket_by_length:
+        batch_sampler = LengthBucketSampler.from_features(
+            inputs,
+            batch_size=kwargs.get("batch_size", 64),
+            shuffle=kwargs.get("shuffle", False),
+        )
 
     ids = df.get(id_col, df.index).to_numpy()
-    return InMemoryDataLoader([inputs, targets, ids], collate_fn=collate_batch, **kwargs)
+    return InMemoryDataLoader(
+        [inputs, targets, ids],
+        collate_fn=partial(collate_batch, nested=True) if nested else collate_batch,
+        batch_sampler=batch_sampler,
+        **kwargs,
+    )
+
+
+class WrenformerStreamData(ParquetShardDataset):
+    """Stream Wrenformer (or Roostformer) samples out of Parquet shards too large to
+    fit in memory, see ParquetShardDataset. Each sample is a tuple of input
+    embedding, target and ID. Use with torch.utils.data.DataLoader and
+    collate_fn=collate_samples.
+    """
+
+    def __init__(
+        self,
+        path: str | Sequence[str],
+        input_col: str = "wyckoff",
+        target_col: str | None = None,
+        id_col: str | None = None,
+        embedding_type: Literal["wyckoff", "composition"] = "wyckoff",
+        shuffle: bool = False,
+        shuffle_buffer: int = 1024,
+        prefetch: int = 1,
+        seed: int = 0,
+    ) -> None:
+        """Index the row groups of all shards.
+
+        Args:
+            path (str | Sequence[str]): Directory holding *.parquet shards, a single
+                Parquet file or a list of them.
+            input_col (str): Column holding the input values (Aflow Wyckoff labels or
+                composition strings). Defaults to "wyckoff".
+            target_col (str): Column holding the target values. Defaults to None
+                meaning targets are NaN, only for making predictions.
+            id_col (str): Column holding sample IDs. Defaults to None meaning the
+                stored dataframe index.
+            embedding_type ('wyckoff' | 'composition'): Defaults to "wyckoff".
+            shuffle (bool, optional): Whether to shuffle row groups and samples.
+                Defaults to False.
+            shuffle_buffer (int, optional): Number of samples to draw randomly from
+                if shuffle=True. Defaults to 1024.
+            prefetch (int, optional): Number of row groups to featurize ahead on a
+                background thread. Defaults to 1.
+            seed (int, optional): Seed for shuffling. Defaults to 0.
+        """
+        get_embedding_fn(embedding_type)  # fail early on invalid embedding_type
+        columns = [col for col in (input_col, target_col, id_col) if col is not None]
+        super().__init__(
+            path,
+            featurize=partial(
+                embed_rows,
+                input_col=input_col,
+                target_col=target_col,
+                id_col=id_col,
+                embedding_type=embedding_type,
+            ),
+            columns=list(dict.fromkeys(columns)),
+            shuffle=shuffle,
+            shuffle_buffer=shuffle_buffer,
+            prefetch=prefetch,
+            seed=seed,
+        )
+
+
+def embed_rows(
+    df: pd.DataFrame,
+    input_col: str = "wyckoff",
+    target_col: str | None = None,
+    id_col: str | None = None,
+    embedding_type: Literal["wyckoff", "composition"] = "wyckoff",
+) -> list[tuple[Tensor, Any, Any]]:
+    """Embed the inputs of a dataframe into (embedding, target, id) samples for
+    collate_samples(). See df_to_in_mem_dataloader() for the arguments.
+
+    Returns:
+        list[tuple[Tensor, Any, Any]]: Input embedding, target and ID of each row.
+    """
+    embed_fn = get_embedding_fn(embedding_type)
+    # embed each unique input once, rows with the same input share a tensor
+    unique_embeddings = {key: embed_fn(key) for key in dict.fromkeys(df[input_col])}
+    targets = df[target_col] if target_col in df else np.full(len(df), np.nan)
+    ids = df.get(id_col, df.index)
+    return [
+        (unique_embeddings[key], target, idx)
+        for key, target, idx in zip(df[input_col], targets, ids)
+    ]
+
+
+def collate_samples(
+    samples: Sequence[tuple[Tensor, Any, Any]], nested: bool = False
+) -> tuple[Any, ...]:
+    """Collate a list of (embedding, target, id) samples, e.g. from
+    WrenformerStreamData, into a batch like collate_batch().
+
+    Args:
+        samples (list[tuple[Tensor, Any, Any]]): Input embedding, target and ID of
+            each sample.
+        nested (bool): Passed to collate_batch(). Defaults to False.
+
+    Returns:
+        tuple: Same as collate_batch().
+    """
+    features, targets, ids = zip(*samples)
+    targets = torch.tensor(np.array(targets))
+    if targets.dtype == torch.bool:
+        targets = targets.long()  # convert binary classification targets to 0 and 1
+    return collate_batch(features, targets, list(ids), nested=nested)
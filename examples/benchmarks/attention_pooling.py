@@ -0,0 +1,91 @@
+# %%
+"""Benchmark the fused segment softmax pooling used by (Weighted)AttentionPooling
+against the previous composition of scatter_reduce calls (segment max, sum of exp,
+weighted sum of messages) with autograd recording every intermediate. Sizes are
+those of a Roost message layer (fully connected element pairs) and of the crystal
+readout head. Reports the forward and forward+backward times as well as the number
+and size of the tensors autograd keeps alive for the backward pass.
+"""
+
+import time
+
+import torch
+
+from aviary.scatter import scatter_reduce
+from aviary.segments import segment_softmax_pool
+
+
+def unfused_pool(gate, messages, index, weights, dim_size):
+    """Previous WeightedAttentionPooling.forward after gate_nn and message_nn."""
+    seg_max = scatter_reduce(gate.detach(), index, 0, dim_size, reduce="amax")
+    gate = gate - seg_max[index]
+    gate = weights * gate.exp()
+    seg_sum = scatter_reduce(gate, index, 0, dim_size, reduce="sum")
+    gate = gate / (seg_sum[index] + 1e-10)
+    return scatter_reduce(gate * messages, index, dim=0, dim_size=dim_size, reduce="sum")
+
+
+def fused_pool(gate, messages, index, weights, dim_size):
+    """Fused segment softmax pooling."""
+    return segment_softmax_pool(gate, messages, index, weights, dim_size=dim_size)
+
+
+def saved_tensors(func, *args) -> tuple[int, float]:
+    """Number and total MB of distinct tensors saved for the backward of func."""
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        func(*args)
+    return len(saved), sum(saved.values()) / 2**20
+
+
+def time_func(func, *args, n_repeats: int = 10) -> float:
+    """Median wall time of func(*args) in ms."""
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1e3
+
+
+def forward_backward(func, gate, messages, index, weights, dim_size):
+    """Forward and backward pass through a pooling function."""
+    out = func(gate, messages, index, weights, dim_size)
+    out.square().sum().backward()
+
+
+# %%
+sizes = {  # (n_segments, rows per segment, n_features)
+    "message layer": (8192, 4, 128),
+    "crystal readout": (1024, 8, 128),
+}
+print(f"{'case':>16} {'pooling':>8} {'forward':>9} {'fwd+bwd':>9} {'saved':>13}")
+torch.manual_seed(0)
+for name, (n_segments, seg_len, n_features) in sizes.items():
+    index = torch.arange(n_segments).repeat_interleave(seg_len)
+    gate = torch.randn(len(index), 1, requires_grad=True)
+    messages = torch.randn(len(index), n_features, requires_grad=True)
+    weights = torch.rand(len(index), 1, requires_grad=True)
+    args = (gate, messages, index, weights, n_segments)
+
+    out, ref = fused_pool(*args), unfused_pool(*args)
+    assert torch.allclose(out, ref, atol=1e-5), f"{name} forward mismatch"
+    grads = torch.autograd.grad(out.square().sum(), (gate, messages, weights))
+    ref_grads = torch.autograd.grad(ref.square().sum(), (gate, messages, weights))
+    for grad, ref_grad in zip(grads, ref_grads, strict=True):
+        assert torch.allclose(grad, ref_grad, atol=1e-4), f"{name} grad mismatch"
+
+    for label, func in (("unfused", unfused_pool), ("fused", fused_pool)):
+        with torch.no_grad():
+            forward = time_func(func, *args)
+        fwd_bwd = time_func(forward_backward, func, *args)
+        n_saved, saved_mb = saved_tensors(func, *args)
+        print(
+            f"{name:>16} {label:>8} {forward:>7.2f}ms {fwd_bwd:>7.2f}ms "
+            f"{n_saved:>3} {saved_mb:>6.1f}MB"
+        )
@@ -0,0 +1,104 @@
+# %%
+"""Benchmark the NumPy top-k neighbor truncation used by get_structure_neighbor_info() and
+its batched CSR variant get_structures_neighbor_info() against the previous
+itertools.groupby + sorted() implementation. Truncation cost grows with the number of
+bonds per cell so we time supercells of increasing size.
+"""
+
+import itertools
+import time
+
+import numpy as np
+from pymatgen.core import Lattice, Structure
+
+from aviary.cgcnn.data import (
+    get_structure_neighbor_info,
+    get_structures_neighbor_info,
+    nearest_neighbor_mask,
+)
+
+
+def truncate_groupby(site_indices, neighbor_indices, neighbor_dists, max_num_nbr):
+    """Previous pure Python truncation kept as reference."""
+    _center_indices, _neighbor_indices, _neighbor_dists = [], [], []
+    for _, idx_group in itertools.groupby(
+        zip(site_indices, neighbor_indices, neighbor_dists), key=lambda x: x[0]
+    ):
+        site_indices, neighbor_idx, neighbor_dist = zip(
+            *sorted(idx_group, key=lambda x: x[2])
+        )
+        _center_indices.extend(site_indices[:max_num_nbr])
+        _neighbor_indices.extend(neighbor_idx[:max_num_nbr])
+        _neighbor_dists.extend(neighbor_dist[:max_num_nbr])
+
+    return (
+        np.array(_center_indices),
+        np.array(_neighbor_indices),
+        np.array(_neighbor_dists),
+    )
+
+
+def truncate_numpy(site_indices, neighbor_indices, neighbor_dists, max_num_nbr):
+    """Truncation as done in get_structure_neighbor_info()."""
+    keep = nearest_neighbor_mask(site_indices, neighbor_dists, max_num_nbr)
+    return site_indices[keep], neighbor_indices[keep], neighbor_dists[keep]
+
+
+def time_func(func, *args, repeats=5):
+    """Return best wall time in seconds over several repeats."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+rng = np.random.default_rng(0)
+rocksalt = Structure.from_spacegroup(
+    "Fm-3m", Lattice.cubic(5.6), ["Na", "Cl"], [(0, 0, 0), (0.5, 0.5, 0.5)]
+)
+
+
+# %% single structures of increasing size, radius 8 A to get many bonds per site
+print(f"{'n_sites':>8} {'n_bonds':>8} {'search':>9} {'groupby':>9} {'numpy':>9}")
+for scale in (1, 2, 3, 4):
+    struct = rocksalt * (scale, scale, scale)
+    struct.perturb(0.05, seed=0)
+    site_idx, nbr_idx, _, nbr_dist = struct.get_neighbor_list(8, numerical_tol=1e-8)
+    bonds = (site_idx, nbr_idx, nbr_dist, 12)
+
+    search = time_func(struct.get_neighbor_list, 8)
+    groupby = time_func(truncate_groupby, *bonds)
+    vectorized = time_func(truncate_numpy, *bonds)
+    print(
+        f"{len(struct):>8} {len(site_idx):>8} {search:>8.4f}s {groupby:>8.4f}s "
+        f"{vectorized:>8.4f}s"
+    )
+
+    for old, new in zip(truncate_groupby(*bonds), get_structure_neighbor_info(struct, 8)):
+        assert np.array_equal(old, new)
+
+
+# %% many small structures: per-structure loop vs batched CSR variant
+structures = []
+for _ in range(500):
+    struct = rocksalt.copy()
+    struct.scale_lattice(struct.volume * rng.uniform(0.8, 1.2))
+    struct.perturb(0.05, seed=int(rng.integers(1e6)))
+    structures.append(struct)
+
+
+def loop_groupby(structures):
+    """Neighbor search + groupby truncation one structure at a time."""
+    out = []
+    for struct in structures:
+        site_idx, nbr_idx, _, nbr_dist = struct.get_neighbor_list(5, numerical_tol=1e-8)
+        out.append(truncate_groupby(site_idx, nbr_idx, nbr_dist, 12))
+    return out
+
+
+loop_time = time_func(loop_groupby, structures, repeats=3)
+batched_time = time_func(get_structures_neighbor_info, structures, repeats=3)
+print(f"\n{len(structures)} structures: groupby loop {loop_time:.3f}s")
+print(f"{len(structures)} structures: batched      {batched_time:.3f}s")
@@ -0,0 +1,140 @@
+# %%
+"""Benchmark the vectorized collate_batch() functions of Roost, Wren and CGCNN against
+the previous per-sample Python loops. The vectorized versions compute offsets with
+cumsum, build membership indices with a single repeat_interleave and do one torch.cat
+per field. Timings are per batch on CPU.
+"""
+
+import time
+
+import torch
+from synthetic_structures import synthetic_materials
+
+from aviary.cgcnn.data import CrystalGraphData
+from aviary.cgcnn.data import collate_batch as cgcnn_collate
+from aviary.roost.data import CompositionData
+from aviary.roost.data import collate_batch as roost_collate
+from aviary.wren.data import WyckoffData
+from aviary.wren.data import collate_batch as wren_collate
+
+
+def roost_collate_loop(samples):
+    """Previous per-sample Roost collation kept as reference."""
+    weights, fea, self_idx, nbr_idx, cry_idx, targets, ids = [], [], [], [], [], [], []
+    base_idx = 0
+    for idx, (inputs, target, *cry_ids) in enumerate(samples):
+        elem_weights, elem_fea, sample_self_idx, sample_nbr_idx = inputs
+        n_sites = elem_fea.shape[0]
+        weights.append(elem_weights)
+        fea.append(elem_fea)
+        self_idx.append(sample_self_idx + base_idx)
+        nbr_idx.append(sample_nbr_idx + base_idx)
+        cry_idx.append(torch.tensor([idx] * n_sites))
+        targets.append(target)
+        ids.append(cry_ids)
+        base_idx += n_sites
+    return (
+        tuple(map(torch.cat, (weights, fea, self_idx, nbr_idx, cry_idx))),
+        tuple(torch.stack(b_target, dim=0) for b_target in zip(*targets)),
+        *zip(*ids),
+    )
+
+
+def wren_collate_loop(samples):
+    """Previous per-sample Wren collation kept as reference."""
+    weights, fea, sym, self_idx, nbr_idx, wyk_idx, aug_idx = [], [], [], [], [], [], []
+    targets, ids = [], []
+    aug_count = base_idx = 0
+    for idx, (inputs, target, *cry_ids) in enumerate(samples):
+        mult_weights, elem_fea, sym_fea, sample_self_idx, sample_nbr_idx = inputs
+        n_elem, n_sites = elem_fea.shape[0], sym_fea.shape[0]
+        n_aug = n_sites // n_elem
+        weights.append(mult_weights.repeat((n_aug, 1)))
+        fea.append(torch.cat([elem_fea] * n_aug))
+        sym.append(sym_fea)
+        self_idx.append(sample_self_idx + base_idx)
+        nbr_idx.append(sample_nbr_idx + base_idx)
+        wyk_idx.append(
+            torch.tensor(range(aug_count, aug_count + n_aug)).repeat_interleave(n_elem)
+        )
+        aug_idx.append(torch.tensor([idx] * n_aug))
+        targets.append(target)
+        ids.append(cry_ids)
+        aug_count += n_aug
+        base_idx += n_sites
+    return (
+        tuple(map(torch.cat, (weights, fea, sym, self_idx, nbr_idx, wyk_idx, aug_idx))),
+        tuple(torch.stack(b_target, dim=0) for b_target in zip(*targets)),
+        *zip(*ids),
+    )
+
+
+def cgcnn_collate_loop(samples):
+    """Previous per-sample CGCNN collation (without the move to CUDA) as reference.
+    All sites of the synthetic structures hold a single species, so the species
+    columns need no padding.
+    """
+    atom_z, atom_occu, nbr_dist, self_idx, nbr_idx, cry_idx = [], [], [], [], [], []
+    targets, ids = [], []
+    base_idx = 0
+    for idx, (inputs, target, *identifiers) in enumerate(samples):
+        sample_z, sample_occu, sample_nbr_dist, sample_self_idx, sample_nbr_idx = inputs
+        n_sites = sample_z.shape[0]
+        atom_z.append(sample_z)
+        atom_occu.append(sample_occu)
+        nbr_dist.append(sample_nbr_dist)
+        self_idx.append(sample_self_idx + base_idx)
+        nbr_idx.append(sample_nbr_idx + base_idx)
+        cry_idx.extend([idx] * n_sites)
+        targets.append(target)
+        ids.append(identifiers)
+        base_idx += n_sites
+    return (
+        (
+            *map(torch.cat, (atom_z, atom_occu, nbr_dist, self_idx, nbr_idx)),
+            torch.tensor(cry_idx),
+        ),
+        tuple(torch.stack(b_target, dim=0) for b_target in zip(*targets)),
+        *zip(*ids),
+    )
+
+
+def time_func(func, *args, repeats=20):
+    """Return best wall time in seconds over several repeats."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# %% synthetic rocksalt, perovskite and fluorite materials
+df = synthetic_materials(1024)
+task_dict = {"target": "regression"}
+
+datasets = {
+    "Roost": (CompositionData(df, task_dict), roost_collate, roost_collate_loop),
+    "Wren": (WyckoffData(df, task_dict), wren_collate, wren_collate_loop),
+    "CGCNN": (CrystalGraphData(df, task_dict), cgcnn_collate, cgcnn_collate_loop),
+}
+
+
+# %% time collation of a single batch for several batch sizes
+print(f"{'model':>6} {'batch':>6} {'loop':>9} {'vectorized':>11} {'speedup':>8}")
+for name, (dataset, collate, collate_loop) in datasets.items():
+    for batch_size in (32, 128, 512):
+        samples = [dataset[idx] for idx in range(batch_size)]
+        new_inputs = collate(samples)[0][:-1]  # drop the crystal offsets
+        if name == "Wren":  # expand the unique Wyckoff positions to all augmentations
+            *new_inputs, aug_gather_idx = new_inputs
+            new_inputs[:2] = (tensor[aug_gather_idx] for tensor in new_inputs[:2])
+        for old, new in zip(collate_loop(samples)[0], new_inputs):
+            assert torch.equal(old, new)
+
+        loop_time = time_func(collate_loop, samples)
+        vectorized_time = time_func(collate, samples)
+        print(
+            f"{name:>6} {batch_size:>6} {loop_time * 1e3:>7.2f}ms "
+            f"{vectorized_time * 1e3:>9.2f}ms {loop_time / vectorized_time:>7.1f}x"
+        )
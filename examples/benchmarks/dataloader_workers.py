@@ -0,0 +1,80 @@
+# %%
+"""Benchmark sending a CGCNN dataset to DataLoader worker processes started with
+spawn, once with the full pickled dataset (dataframe of pymatgen Structures, JSON
+element embedding, arrays by value) and once with SlimPickleMixin which only sends
+the dataframe index and shared-memory handles of the arrays. Reports the pickled
+size, the time until the first batch arrives (worker startup), the epoch time and
+the proportional set size (PSS, shared pages split between processes) summed over
+all workers. Run as a script since spawn re-imports this module in every worker.
+Worker counts to test can be passed as arguments, e.g. `dataloader_workers.py 0 4`.
+"""
+
+import pickle
+import sys
+import time
+from multiprocessing.reduction import ForkingPickler
+
+import torch
+from synthetic_structures import synthetic_materials
+
+from aviary.cgcnn.data import CrystalGraphData, collate_batch
+from aviary.data import SlimPickleMixin
+
+
+def make_dataset(n_samples: int = 4096) -> CrystalGraphData:
+    """Synthetic rocksalt, perovskite and fluorite cells and supercells."""
+    df = synthetic_materials(n_samples, supercells=True)
+    return CrystalGraphData(df, {"target": "regression"})
+
+
+def workers_pss(loader_iter) -> float:
+    """Summed proportional set size of all worker processes in MB."""
+    total = 0
+    for worker in getattr(loader_iter, "_workers", []):
+        with open(f"/proc/{worker.pid}/smaps_rollup") as file:
+            for line in file:
+                if line.startswith("Pss:"):
+                    total += int(line.split()[1])
+    return total / 1024
+
+
+def run_epoch(dataset: CrystalGraphData, num_workers: int) -> tuple[float, ...]:
+    """Time to first batch, epoch time and worker PSS of one epoch."""
+    dataset.feature_cache.clear()  # start cold, don't send samples of earlier runs
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=128,
+        num_workers=num_workers,
+        collate_fn=collate_batch,
+        multiprocessing_context="spawn" if num_workers > 0 else None,
+    )
+    start = time.perf_counter()
+    loader_iter = iter(loader)
+    next(loader_iter)
+    first_batch = time.perf_counter() - start
+    pss = workers_pss(loader_iter)
+    for _ in loader_iter:
+        pass
+    return first_batch, time.perf_counter() - start, pss
+
+
+if __name__ == "__main__":
+    worker_counts = [int(arg) for arg in sys.argv[1:]] or [0, 1, 2, 4, 8, 16]
+    dataset = make_dataset()
+    slim_getstate = SlimPickleMixin.__getstate__
+
+    print(f"{'pickling':>8} {'workers':>8} {'size':>9} {'1st batch':>10} ", end="")
+    print(f"{'epoch':>7} {'worker PSS':>11}")
+    for name in ("full", "slim"):
+        if name == "full":  # pickle the whole __dict__ like a plain Dataset
+            SlimPickleMixin.__getstate__ = lambda self: self.__dict__
+        else:
+            SlimPickleMixin.__getstate__ = slim_getstate
+        size = len(ForkingPickler.dumps(dataset)) / 2**20
+        for num_workers in worker_counts:
+            first_batch, epoch, pss = run_epoch(dataset, num_workers)
+            print(
+                f"{name:>8} {num_workers:>8} {size:>7.2f}MB {first_batch:>9.2f}s "
+                f"{epoch:>6.2f}s {pss:>9.0f}MB"
+            )
+    print(f"plain pickle of the slim dataset: {len(pickle.dumps(dataset)) / 2**20:.2f}MB")
@@ -0,0 +1,89 @@
+# %%
+"""Benchmark aviary.scatter.scatter_reduce for all reduce modes at sizes typical of
+pooling atoms into crystals (CGCNN, Roost) and messages into atoms (CGCNN edges).
+Results are checked against torch_scatter if installed, else against
+torch.segment_reduce on the rows sorted by segment. The previous implementation of
+amax/amin scattered with overwrite semantics, so with duplicate indices the result
+depended on write order. It is timed alongside for reference.
+"""
+
+import time
+
+import torch
+
+from aviary.scatter import scatter_reduce
+
+try:
+    import torch_scatter
+except ImportError:
+    torch_scatter = None
+
+
+def old_scatter_extremum(src, index, dim_size, reduce):
+    """Previous amax/amin branch of scatter_reduce (incorrect for duplicates)."""
+    index = index.view(-1, *[1] * (src.dim() - 1)).expand_as(src)
+    shape = (dim_size, *src.shape[1:])
+    if reduce == "amax":
+        out = torch.full(shape, float("-inf"), dtype=src.dtype)
+        return torch.max(out, out.scatter(0, index, src))
+    out = torch.full(shape, float("inf"), dtype=src.dtype)
+    return torch.min(out, out.scatter(0, index, src))
+
+
+def reference(src, index, dim_size, reduce):
+    """torch_scatter result, else segment_reduce on sorted rows."""
+    if torch_scatter is not None:
+        name = {"amax": "max", "amin": "min", "prod": "mul"}.get(reduce, reduce)
+        return torch_scatter.scatter(src, index, dim=0, dim_size=dim_size, reduce=name)
+    order = index.argsort(stable=True)
+    lengths = torch.bincount(index, minlength=dim_size)
+    name = {"amax": "max", "amin": "min"}.get(reduce, reduce)
+    if name == "prod":  # segment_reduce has no prod, use exp(sum(log)) for src > 0
+        return torch.segment_reduce(src[order].log(), "sum", lengths=lengths).exp()
+    return torch.segment_reduce(src[order], name, lengths=lengths)
+
+
+def time_func(func, *args, n_repeats: int = 10) -> float:
+    """Median wall time of func(*args) in ms."""
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1e3
+
+
+def forward_backward(src, index, dim_size, reduce):
+    """Forward and backward pass through scatter_reduce."""
+    out = scatter_reduce(src, index, dim=0, dim_size=dim_size, reduce=reduce)
+    out.sum().backward()
+
+
+# %%
+sizes = {  # (n_rows, n_features, n_segments)
+    "atoms->crystals": (32_768, 64, 1024),
+    "edges->atoms": (393_216, 64, 32_768),
+}
+print(f"{'case':>16} {'reduce':>6} {'forward':>9} {'fwd+bwd':>9} {'old':>9} {'ok':>4}")
+torch.manual_seed(0)
+for name, (n_rows, n_features, n_segments) in sizes.items():
+    index = torch.randint(0, n_segments, (n_rows,))
+    index[:n_segments] = torch.arange(n_segments)  # no empty segments
+    src = torch.rand(n_rows, n_features) + 0.5
+    for reduce in ("sum", "mean", "amax", "amin", "prod"):
+        out = scatter_reduce(src, index, dim=0, dim_size=n_segments, reduce=reduce)
+        ok = torch.allclose(out, reference(src, index, n_segments, reduce), rtol=1e-4)
+
+        forward = time_func(
+            scatter_reduce, src, index, 0, n_segments, reduce, n_repeats=10
+        )
+        src_grad = src.clone().requires_grad_()
+        fwd_bwd = time_func(forward_backward, src_grad, index, n_segments, reduce)
+        old = "-"
+        if reduce in ("amax", "amin"):
+            old_time = time_func(old_scatter_extremum, src, index, n_segments, reduce)
+            old = f"{old_time:.2f}ms"
+        print(
+            f"{name:>16} {reduce:>6} {forward:>7.2f}ms {fwd_bwd:>7.2f}ms {old:>9} "
+            f"{ok!s:>4}"
+        )
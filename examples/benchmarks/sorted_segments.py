@@ -0,0 +1,92 @@
+# %%
+"""Benchmark Roost, Wren and CGCNN forward+backward passes on batches from
+collate_batch, once with the CSR offsets it emits (indices are sorted, segment
+maxima use torch.segment_reduce, sums and means use index_add with a 1D index) and
+once without them (generic scatter with the index expanded to the feature width,
+number of crystals read back from the index). Timings are the median over all
+batches of one epoch on CPU.
+"""
+
+import time
+
+import numpy as np
+import torch
+from synthetic_structures import synthetic_materials
+
+from aviary.cgcnn.data import CrystalGraphData
+from aviary.cgcnn.model import CrystalGraphConvNet
+from aviary.data import InMemoryDataLoader
+from aviary.roost.data import CompositionData
+from aviary.roost.model import Roost
+from aviary.wren.data import WyckoffData
+from aviary.wren.model import Wren
+
+
+def time_epoch(model, loader, use_ptr: bool) -> float:
+    """Median forward+backward time per batch in ms."""
+    times = []
+    for inputs, targets, *_ in loader:
+        inputs = inputs if use_ptr else inputs[:-1]  # noqa: PLW2901
+        start = time.perf_counter()
+        (out,) = model(*inputs)
+        loss = (out.squeeze(1) - targets[0].squeeze(1)).square().mean()
+        model.zero_grad()
+        loss.backward()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1e3
+
+
+# %% synthetic rocksalt, perovskite and fluorite materials incl. supercells
+df = synthetic_materials(1024, supercells=True)
+task_dict = {"target": "regression"}
+
+roost_data = CompositionData(df, task_dict)
+wren_data = WyckoffData(df, task_dict)
+cgcnn_data = CrystalGraphData(df, task_dict)
+model_kwargs = {"robust": False, "n_targets": [1], "task_dict": task_dict}
+models = {
+    "Roost": (
+        Roost(
+            elem_emb_len=roost_data.elem_emb_len,
+            elem_embedding=roost_data.elem_embedding,
+            **model_kwargs,
+        ),
+        roost_data,
+    ),
+    "Wren": (
+        Wren(
+            elem_emb_len=wren_data.elem_emb_len,
+            elem_embedding=wren_data.elem_embedding,
+            sym_emb_len=wren_data.sym_emb_len,
+            **model_kwargs,
+        ),
+        wren_data,
+    ),
+    "CGCNN": (
+        CrystalGraphConvNet(
+            elem_emb_len=cgcnn_data.elem_emb_len,
+            elem_embedding=cgcnn_data.elem_embedding,
+            nbr_fea_len=cgcnn_data.nbr_fea_dim,
+            **model_kwargs,
+        ),
+        cgcnn_data,
+    ),
+}
+
+
+# %%
+print(f"{'model':>6} {'batch':>6} {'scatter':>9} {'segment':>9} {'speedup':>8}")
+for name, (model, dataset) in models.items():
+    for batch_size in (128, 512):
+        loader = InMemoryDataLoader.from_dataset(dataset, batch_size=batch_size)
+        inputs, *_ = next(iter(loader))
+        with torch.no_grad():  # both paths give the same predictions
+            (out,), (ref_out,) = model(*inputs), model(*inputs[:-1])
+        assert torch.allclose(out, ref_out, atol=1e-5), f"{name} outputs differ"
+
+        scatter_time = time_epoch(model, loader, use_ptr=False)
+        segment_time = time_epoch(model, loader, use_ptr=True)
+        print(
+            f"{name:>6} {batch_size:>6} {scatter_time:>7.1f}ms {segment_time:>7.1f}ms "
+            f"{scatter_time / segment_time:>7.2f}x"
+        )
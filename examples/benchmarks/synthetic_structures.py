@@ -0,0 +1,67 @@
+"""Synthetic rocksalt, perovskite and fluorite materials shared by the benchmarks.
+Import from scripts run in this directory, e.g. `from synthetic_structures import
+synthetic_materials`.
+"""
+
+import numpy as np
+import pandas as pd
+from pymatgen.core import Lattice, Structure
+
+PLACEHOLDERS = ["H", "He", "Li"]
+ELEMENTS = ["Li", "Na", "K", "Mg", "Ca", "Sr", "Ba", "Ti", "Zr", "O", "S", "F", "Cl"]
+PROTOTYPES = [  # (conventional cell with placeholder species, AFLOW label)
+    (
+        Structure.from_spacegroup(
+            spg, Lattice.cubic(1), PLACEHOLDERS[: len(coords)], coords
+        ),
+        label,
+    )
+    for spg, coords, label in [
+        ("Fm-3m", [(0, 0, 0), (0.5, 0.5, 0.5)], "AB_cF8_225_a_b"),
+        ("Pm-3m", [(0, 0, 0), (0.5, 0.5, 0.5), (0.5, 0.5, 0)], "ABC3_cP5_221_a_b_c"),
+        ("Fm-3m", [(0, 0, 0), (0.25, 0.25, 0.25)], "AB2_cF12_225_a_c"),
+    ]
+]
+
+
+def synthetic_materials(
+    n_samples: int, supercells: bool = False, seed: int = 0
+) -> pd.DataFrame:
+    """Cycle through the prototypes, decorating each with random elements.
+
+    Args:
+        n_samples (int): Number of materials.
+        supercells (bool): If True, turn a third of the cells into 2x2x2 supercells
+            to vary graph sizes. Defaults to False.
+        seed (int): Seed of the random elements, lattice constants and targets.
+            Defaults to 0.
+
+    Returns:
+        pd.DataFrame: material_id, composition, wyckoff (protostructure label),
+            structure and a normally distributed target column.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for idx in range(n_samples):
+        template, aflow_label = PROTOTYPES[idx % len(PROTOTYPES)]
+        n_species = len(template.composition)
+        species = dict(zip(PLACEHOLDERS, rng.choice(ELEMENTS, n_species, replace=False)))
+        struct = Structure(
+            Lattice.cubic(rng.uniform(4, 6)),
+            [species[site.specie.symbol] for site in template],
+            template.frac_coords,
+        )
+        if supercells:
+            struct.make_supercell([int(rng.choice([1, 1, 2]))] * 3)
+        # labels only need a consistent element order here
+        chemsys = "-".join(species[el] for el in PLACEHOLDERS[:n_species])
+        rows.append(
+            {
+                "material_id": f"mat-{idx}",
+                "composition": struct.composition.formula,
+                "wyckoff": f"{aflow_label}:{chemsys}",
+                "structure": struct,
+                "target": rng.normal(),
+            }
+        )
+    return pd.DataFrame(rows)
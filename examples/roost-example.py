@@ -172,6 +172,7 @@ def main(
         "robust": robust,
         "n_targets": n_targets,
         "elem_emb_len": elem_emb_len,
+        "elem_embedding": elem_embedding,
         "elem_fea_len": elem_fea_len,
         "n_graph": n_graph,
         "elem_heads": 3,
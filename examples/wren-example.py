@@ -184,6 +184,7 @@ def main(
         "robust": robust,
         "n_targets": n_targets,
         "elem_emb_len": elem_emb_len,
+        "elem_embedding": elem_embedding,
         "sym_emb_len": sym_emb_len,
         "elem_fea_len": elem_fea_len,
         "sym_fea_len": sym_fea_len,
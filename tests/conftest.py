@@ -3,6 +3,7 @@ import os
 import pytest
 import torch
 from matminer.datasets import load_dataset
+from pymatgen.core import Lattice, Structure
 
 from aviary.wren.utils import get_protostructure_label_from_spglib
 
@@ -13,6 +14,27 @@ torch.manual_seed(0)  # ensure reproducible results (applies to all tests)
 
 TEST_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# (space group, lattice constant, species, coords) of small cubic test structures
+CUBIC_STRUCTURES = {
+    "NaCl": ("Fm-3m", 4.2, ["Na", "Cl"], [(0, 0, 0), (0.5, 0.5, 0.5)]),
+    "CsBr": ("Pm-3m", 3.9, ["Cs", "Br"], [(0, 0, 0), (0.5, 0.5, 0.5)]),
+    "ZnS": ("F-43m", 5.4, ["Zn", "S"], [(0, 0, 0), (0.25, 0.25, 0.25)]),
+    "(Sr,Ba)TiO3": (
+        "Pm-3m",
+        4.0,
+        [{"Sr": 0.5, "Ba": 0.5}, "Ti", "O"],
+        [(0, 0, 0), (0.5, 0.5, 0.5), (0.5, 0.5, 0)],
+    ),
+}
+
+
+def cubic_structures(*names: str) -> list[Structure]:
+    """Build the named structures of CUBIC_STRUCTURES from their space groups."""
+    return [
+        Structure.from_spacegroup(spg, Lattice.cubic(a), species, coords)
+        for spg, a, species, coords in map(CUBIC_STRUCTURES.get, names)
+    ]
+
 
 @pytest.fixture(scope="session")
 def df_matbench_phonons():
@@ -0,0 +1,302 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from pymatgen.core import Lattice, Structure
+
+from aviary.cgcnn.data import (
+    CrystalGraphCache,
+    CrystalGraphData,
+    CrystalGraphStreamData,
+    collate_batch,
+    featurize_crystal_graphs,
+    get_structure_neighbor_info,
+    get_structures_neighbor_info,
+    structure_hash,
+)
+from aviary.cgcnn.model import CrystalGraphConvNet
+from aviary.data import InMemoryDataLoader
+
+from .conftest import cubic_structures
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+@pytest.fixture
+def df_structures():
+    structs = cubic_structures("NaCl", "CsBr", "ZnS", "(Sr,Ba)TiO3")
+    # duplicate structure to check content addressing
+    structs.append(structs[0].copy())
+    ids = [f"mat-{idx}" for idx in range(len(structs))]
+    return pd.DataFrame(
+        {"material_id": ids, "structure": structs, "target": np.arange(len(structs))}
+    ).set_index("material_id", drop=False)
+
+
+@pytest.mark.parametrize("max_num_nbr", [1, 6, 12, None])
+def test_get_structure_neighbor_info(df_structures, max_num_nbr):
+    struct = df_structures.structure.iloc[2] * 2
+    struct.perturb(0.05, seed=0)
+
+    site_idx, nbr_idx, _, nbr_dist = struct.get_neighbor_list(6, numerical_tol=1e-8)
+    self_idx, out_nbr_idx, out_nbr_dist = get_structure_neighbor_info(
+        struct, 6, max_num_nbr
+    )
+
+    # reference: per site, stable sort by distance and keep max_num_nbr nearest
+    expected = list(zip(site_idx, nbr_idx, nbr_dist)) if max_num_nbr is None else []
+    for site in range(len(struct) if max_num_nbr else 0):
+        bonds = sorted(
+            [(s, n, d) for s, n, d in zip(site_idx, nbr_idx, nbr_dist) if s == site],
+            key=lambda x: x[2],
+        )
+        expected += bonds[:max_num_nbr]
+
+    assert np.array_equal(self_idx, [s for s, _, _ in expected])
+    assert np.array_equal(out_nbr_idx, [n for _, n, _ in expected])
+    assert np.array_equal(out_nbr_dist, [d for _, _, d in expected])
+
+    # batched variant returns the same bonds in CSR format
+    structs = [struct, *df_structures.structure]
+    ptr, *batched = get_structures_neighbor_info(structs, 6, max_num_nbr)
+    assert len(ptr) == len(structs) + 1
+    for idx, struct in enumerate(structs):
+        single = get_structure_neighbor_info(struct, 6, max_num_nbr)
+        for batched_arr, single_arr in zip(batched, single):
+            assert np.array_equal(batched_arr[ptr[idx] : ptr[idx + 1]], single_arr)
+
+
+def test_structure_hash(df_structures):
+    struct = df_structures.structure.iloc[0]
+    assert structure_hash(struct) == structure_hash(struct.copy())
+    assert structure_hash(struct) != structure_hash(df_structures.structure.iloc[1])
+
+    perturbed = struct.copy()
+    perturbed.translate_sites([0], [0.01, 0, 0])
+    assert structure_hash(struct) != structure_hash(perturbed)
+
+
+def test_crystal_graph_cache(df_structures, tmp_path):
+    cache = CrystalGraphCache(radius=5, max_num_nbr=12, cache_dir=str(tmp_path))
+    rows = cache.add(df_structures.structure)
+
+    assert len(cache) == len(df_structures) - 1  # duplicate only stored once
+    assert rows[0] == rows[-1]
+
+    for row, struct in zip(rows, df_structures.structure):
+        graph = cache[row]
+        self_idx, nbr_idx, nbr_dist = get_structure_neighbor_info(struct, 5, 12)
+        assert graph.n_sites == len(struct)
+        assert np.array_equal(graph.self_idx, self_idx)
+        assert np.array_equal(graph.nbr_idx, nbr_idx)
+        assert np.allclose(graph.nbr_dist, nbr_dist)
+
+    # reopening the cache memory-maps the stored chunks instead of recomputing
+    reloaded = CrystalGraphCache(radius=5, max_num_nbr=12, cache_dir=str(tmp_path))
+    assert len(reloaded) == len(cache)
+    assert isinstance(reloaded.chunks[0]["self_idx"], np.memmap)
+    assert np.array_equal(reloaded.add(df_structures.structure), rows)
+    assert len(reloaded.chunks) == 1
+
+    # different neighbor settings get their own store
+    assert len(CrystalGraphCache(radius=4, max_num_nbr=12, cache_dir=str(tmp_path))) == 0
+
+    # chunks of an older format (here without n_connected) are not loaded
+    old_chunk = tmp_path / "radius=5-max_num_nbr=12" / "chunk-old"
+    old_chunk.mkdir(parents=True)
+    for key in set(CrystalGraphCache.arrays) - {"n_connected"}:
+        np.save(old_chunk / f"{key}.npy", reloaded.chunks[0][key])
+    fresh = CrystalGraphCache(radius=5, max_num_nbr=12, cache_dir=str(tmp_path))
+    assert len(fresh) == len(cache)
+    version = CrystalGraphCache.format_version
+    assert fresh.cache_dir == f"{tmp_path}/v{version}-radius=5-max_num_nbr=12"
+
+
+@pytest.mark.parametrize("n_jobs", [2, 3])
+def test_featurize_crystal_graphs_parallel(df_structures, n_jobs):
+    structs = list(df_structures.structure) * 3
+    serial = featurize_crystal_graphs(structs, radius=5, max_num_nbr=12)
+    parallel = featurize_crystal_graphs(structs, radius=5, max_num_nbr=12, n_jobs=n_jobs)
+
+    assert serial.keys() == parallel.keys()
+    for key, arr in serial.items():
+        assert arr.dtype == parallel[key].dtype, key
+        assert np.array_equal(arr, parallel[key]), key
+
+    # isolated sites are counted in the workers
+    isolated = Structure(Lattice.cubic(10), ["Na", "Cl"], [(0, 0, 0), (0.5, 0.5, 0.5)])
+    graphs = featurize_crystal_graphs([*structs[:3], isolated], radius=5, n_jobs=n_jobs)
+    assert list(graphs["n_connected"]) == [*map(len, structs[:3]), 0]
+
+
+def test_crystal_graph_data_cache_dir(df_structures, tmp_path):
+    task_dict = {"target": "regression"}
+    dataset = CrystalGraphData(df_structures, task_dict, identifiers=["material_id"])
+    cached = CrystalGraphData(
+        df_structures, task_dict, identifiers=["material_id"], cache_dir=str(tmp_path)
+    )
+    assert len(dataset) == len(cached) == len(df_structures)
+
+    for idx in range(len(dataset)):
+        inputs, targets, *ids = dataset[idx]
+        cached_inputs, cached_targets, *cached_ids = cached[idx]
+        for tensor, cached_tensor in zip(inputs, cached_inputs):
+            assert torch.allclose(tensor, cached_tensor)
+        assert targets == cached_targets
+        assert ids == cached_ids
+
+
+def test_crystal_graph_data_atom_species(df_structures):
+    dataset = CrystalGraphData(df_structures, {"target": "regression"})
+    # ordered sites hold one species with occupancy 1
+    atom_z, atom_occu, *_ = dataset[0][0]
+    assert atom_z.dtype == torch.long
+    assert atom_z.tolist() == [[11]] * 4 + [[17]] * 4  # NaCl
+    assert atom_occu.tolist() == [[1.0]] * 8
+
+    # the mixed Sr/Ba site of the perovskite holds both species, all other sites
+    # of it are padded
+    atom_z, atom_occu, *_ = dataset[3][0]
+    assert atom_z.tolist() == [[38, 56], [22, 0], [8, 0], [8, 0], [8, 0]]
+    assert atom_occu.tolist() == [[0.5, 0.5], [1, 0], [1, 0], [1, 0], [1, 0]]
+
+
+@pytest.mark.parametrize("rows", [[0, 2], [2, 0, 3]])
+def test_crystal_graph_conv_net_atom_species(df_structures, rows):
+    dataset = CrystalGraphData(df_structures, {"target": "regression"})
+    inputs, *_ = collate_batch([dataset[idx] for idx in rows])
+    with torch.random.fork_rng():
+        model = CrystalGraphConvNet(
+            robust=False,
+            n_targets=[1],
+            elem_emb_len=dataset.elem_emb_len,
+            nbr_fea_len=dataset.nbr_fea_dim,
+            task_dict=dataset.task_dict,
+        )
+    model.eval()
+
+    # site features are the occupancy-weighted sums of the element features
+    atom_z, atom_occu, *graph = inputs
+    table = torch.from_numpy(dataset.elem_fea_table).float().nan_to_num()
+    atom_fea = (table[atom_z] * atom_occu[..., None]).sum(dim=1)
+    if 3 in rows:  # Sr0.5Ba0.5TiO3
+        expected = 0.5 * (dataset.elem_features["Sr"] + dataset.elem_features["Ba"])
+        site = sum(len(dataset[idx][0][0]) for idx in rows[: rows.index(3)])
+        assert torch.allclose(atom_fea[site], torch.tensor(expected).float())
+    precomputed = CrystalGraphConvNet(**{**model.model_params, "elem_embedding": None})
+    precomputed.load_state_dict(model.state_dict())
+    precomputed.eval()
+    with torch.no_grad():
+        (out,) = model(*inputs)
+        (ref_out,) = precomputed(table[atom_z], atom_occu, *graph)
+    assert out.shape == (len(rows), 1)
+    torch.testing.assert_close(out, ref_out)
+
+
+def test_collate_batch(df_structures):
+    dataset = CrystalGraphData(df_structures, {"target": "regression"})
+    samples = [dataset[idx] for idx in (2, 0, 3)]
+    inputs, targets, material_ids = collate_batch(samples)
+    atom_z, atom_occu, nbr_dist, self_idx, nbr_idx, cry_idx, cry_ptr = inputs
+
+    # batches stay on CPU so DataLoader workers can pin memory
+    assert all(tensor.device.type == "cpu" for tensor in (*inputs, *targets))
+    assert material_ids == ("mat-2", "mat-0", "mat-3")
+    assert targets[0].tolist() == [[2], [0], [3]]
+
+    n_sites = [len(sample[0][0]) for sample in samples]
+    assert cry_idx.tolist() == [0] * n_sites[0] + [1] * n_sites[1] + [2] * n_sites[2]
+    assert atom_z.shape == atom_occu.shape == (sum(n_sites), 2)  # Sr/Ba site
+    assert len(nbr_dist) == len(self_idx) == len(nbr_idx)
+    assert cry_ptr.tolist() == [0, *np.cumsum(n_sites)]
+    # models reduce bonds segment-wise, so they must be sorted by atom
+    assert torch.equal(self_idx, self_idx.sort().values)
+
+    # edges of each crystal point to its own atoms
+    assert torch.equal(cry_idx[self_idx], cry_idx[nbr_idx])
+    offset = n_sites[0] + n_sites[1]
+    last_self_idx = samples[2][0][3]
+    assert torch.equal(self_idx[-len(last_self_idx) :], last_self_idx + offset)
+
+
+def test_crystal_graph_data_get_batch(df_structures):
+    dataset = CrystalGraphData(df_structures, {"target": "regression"})
+    subset = torch.utils.data.Subset(dataset, [2, 0, 3])
+    loader = InMemoryDataLoader.from_dataset(subset, batch_size=3)
+    inputs, targets, material_ids = next(iter(loader))
+    ref_inputs, ref_targets, ref_ids = collate_batch([dataset[idx] for idx in (2, 0, 3)])
+    for tensor, ref_tensor in zip((*inputs, *targets), (*ref_inputs, *ref_targets)):
+        assert tensor.dtype == ref_tensor.dtype
+        assert torch.equal(tensor, ref_tensor)
+    assert material_ids == ref_ids == ("mat-2", "mat-0", "mat-3")
+
+    # only raw distances are kept for the whole dataset, batches are expanded
+    n_edges = dataset.graph_sizes()[1].sum()
+    assert dataset.graph_arrays["nbr_dist"].shape == (n_edges,)
+    assert inputs[2].shape == (len(inputs[3]), dataset.nbr_fea_dim)
+
+    # batches of ordered structures only need one species column
+    ordered_inputs, *_ = dataset.get_batch([0, 2])
+    assert ordered_inputs[0].shape == (len(ordered_inputs[0]), 1)
+    ref_inputs, *_ = collate_batch([dataset[0], dataset[2]])
+    for tensor, ref_tensor in zip(ordered_inputs, ref_inputs):
+        assert torch.equal(tensor, ref_tensor)
+
+
+def test_crystal_graph_data_graph_sizes(df_structures):
+    dataset = CrystalGraphData(df_structures, {"target": "regression"})
+    n_sites, n_edges = dataset.graph_sizes()
+    for idx in range(len(dataset)):
+        atom_z, _, _, self_idx, _ = dataset[idx][0]
+        assert n_sites[idx] == len(atom_z)
+        assert n_edges[idx] == len(self_idx)
+
+
+@pytest.mark.skipif(pa is None, reason="pyarrow not installed")
+def test_crystal_graph_stream_data(df_structures, tmp_path):
+    # Parquet holds structures serialized as JSON strings
+    df_json = df_structures.drop(columns="material_id")
+    df_json["structure"] = [struct.to_json() for struct in df_structures.structure]
+    df_json.to_parquet(tmp_path / "shard-0.parquet", row_group_size=2)
+
+    task_dict = {"target": "regression"}
+    dataset = CrystalGraphStreamData(tmp_path, task_dict)
+    in_memory = CrystalGraphData(df_structures, task_dict)
+    samples = list(dataset)
+    assert len(samples) == len(in_memory)
+    for idx, (inputs, targets, *ids) in enumerate(samples):
+        ref_inputs, ref_targets, *ref_ids = in_memory[idx]
+        assert ids == ref_ids
+        for tensor, ref_tensor in zip((*inputs, *targets), (*ref_inputs, *ref_targets)):
+            assert torch.allclose(tensor, ref_tensor)
+
+
+def test_crystal_graph_data_pickle(df_structures, tmp_path):
+    task_dict = {"target": "regression"}
+    for cache_dir in (None, str(tmp_path)):
+        dataset = CrystalGraphData(df_structures, task_dict, cache_dir=cache_dir)
+        dataset.graph_arrays  # noqa: B018 cached arrays are pickled as well
+        copy = pickle.loads(pickle.dumps(dataset))
+        assert "structure" not in copy.df
+        assert copy.graph_cache.hash_to_row == dataset.graph_cache.hash_to_row
+        if cache_dir is not None:  # memory-mapped chunks are mapped again
+            assert isinstance(copy.graph_cache.chunks[0]["nbr_dist"], np.memmap)
+        for idx in range(len(dataset)):
+            (inputs, targets, *ids), (ref_inputs, ref_targets, *ref_ids) = (
+                copy[idx],
+                dataset[idx],
+            )
+            assert ids == ref_ids
+            for tensor, ref_tensor in zip(
+                (*inputs, *targets), (*ref_inputs, *ref_targets)
+            ):
+                assert torch.equal(tensor, ref_tensor)
+        inputs, *_ = copy.get_batch([2, 0])
+        ref_inputs, *_ = dataset.get_batch([2, 0])
+        for tensor, ref_tensor in zip(inputs, ref_inputs):
+            assert torch.equal(tensor, ref_tensor)
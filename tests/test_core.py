@@ -1,8 +1,20 @@
 import numpy as np
+import pandas as pd
 import pytest
 import torch
 
+from aviary.cgcnn.data import CrystalGraphData
+from aviary.cgcnn.data import collate_batch as collate_cgcnn
+from aviary.cgcnn.model import CrystalGraphConvNet
 from aviary.core import masked_mean, masked_std, np_one_hot, np_softmax
+from aviary.roost.data import CompositionData
+from aviary.roost.data import collate_batch as collate_roost
+from aviary.roost.model import Roost
+from aviary.wren.data import WyckoffData
+from aviary.wren.data import collate_batch as collate_wren
+from aviary.wren.model import Wren
+
+from .conftest import cubic_structures
 
 
 def test_np_one_hot():
@@ -65,3 +77,90 @@ def test_masked_std():
             std = (xi_nan - mean.unsqueeze(dim=dim)).pow(2).nanmean(dim=dim).sqrt()
 
             assert out == pytest.approx(std, abs=1e-4, nan_ok=True)
+
+
+def make_batch_and_model(model_name):
+    """Collated batch of a few materials and a freshly initialized model for it."""
+    task_dict = {"y": "regression"}
+    if model_name == "cgcnn":
+        structs = cubic_structures("NaCl", "ZnS")
+        dataset = CrystalGraphData(
+            pd.DataFrame({"structure": structs, "y": [1, 2]}), task_dict
+        )
+        model = CrystalGraphConvNet(
+            robust=False,
+            n_targets=[1],
+            elem_emb_len=dataset.elem_emb_len,
+            nbr_fea_len=dataset.nbr_fea_dim,
+            elem_embedding=dataset.elem_embedding,
+            task_dict=task_dict,
+        )
+        return collate_cgcnn([dataset[0], dataset[1]]), model
+
+    df = pd.DataFrame({"material_id": ["a", "b"], "composition": ["NaCl", "BaTiO3"]})
+    df["wyckoff"] = ["AB_cF8_225_a_b:Cl-Na", "ABC3_cP5_221_a_b_c:Ba-O-Ti"]
+    df["y"] = [1.0, 2.0]
+    if model_name == "roost":
+        dataset = CompositionData(df, task_dict)
+        model = Roost(
+            robust=False,
+            n_targets=[1],
+            elem_emb_len=dataset.elem_emb_len,
+            elem_embedding=dataset.elem_embedding,
+            task_dict=task_dict,
+        )
+        return collate_roost([dataset[0], dataset[1]]), model
+    dataset = WyckoffData(df, task_dict)
+    model = Wren(
+        robust=False,
+        n_targets=[1],
+        elem_emb_len=dataset.elem_emb_len,
+        sym_emb_len=dataset.sym_emb_len,
+        elem_embedding=dataset.elem_embedding,
+        task_dict=task_dict,
+    )
+    return collate_wren([dataset[0], dataset[1]]), model
+
+
+@pytest.mark.parametrize("model_name", ["roost", "wren", "cgcnn"])
+def test_forward_without_host_sync(model_name, monkeypatch):
+    (inputs, *_), model = make_batch_and_model(model_name)
+    model.eval()
+
+    # reading a tensor value back on the host would sync with the device
+    def host_sync(*_args, **_kwargs):
+        raise AssertionError("forward pass read a tensor value back to the host")
+
+    for name in ("item", "tolist", "__int__", "__float__", "__bool__", "__index__"):
+        monkeypatch.setattr(torch.Tensor, name, host_sync)
+    with torch.no_grad():
+        (out,) = model(*inputs)
+    monkeypatch.undo()
+
+    assert out.shape == (2, 1)
+    # without the crystal offsets, models scatter over unsorted indices and infer
+    # the number of crystals from the index
+    with torch.no_grad():
+        (ref_out,) = model(*inputs[:-1])
+    assert torch.allclose(out, ref_out)
+
+
+@pytest.mark.parametrize("model_name", ["roost", "wren", "cgcnn"])
+def test_featurize(model_name):
+    batch, model = make_batch_and_model(model_name)
+    inputs = batch[0]
+    with pytest.raises(AssertionError, match="needs to be fitted"):
+        model.featurize([batch])
+
+    model.epoch = 1
+    features = model.featurize([batch])
+    assert features.shape == (2, model.trunk_nn.fc_out.out_features)
+
+    # featurize sees the same trunk features as forward, incl. the element lookup
+    with torch.no_grad():
+        (out,) = model(*inputs)
+        (expected,) = (
+            output_nn(torch.relu(torch.from_numpy(features)))
+            for output_nn in model.output_nns
+        )
+    assert torch.allclose(out, expected, atol=1e-6)
@@ -0,0 +1,595 @@
+import gc
+import pickle
+import threading
+import weakref
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from aviary.core import Normalizer
+from aviary.data import (
+    BatchPrefetcher,
+    BudgetBatchSampler,
+    FeatureCache,
+    InMemoryDataLoader,
+    ParquetShardDataset,
+    SharedMemoryFeatureCache,
+    batch_fully_connected_edges,
+    csr_gather,
+    element_feature_table,
+    fully_connected_edges,
+    get_identifier_rows,
+    get_target_columns,
+    nbytes,
+)
+from aviary.roost.data import CompositionData, CompositionStreamData, collate_batch
+from aviary.roost.model import Roost
+from aviary.wren.data import WyckoffData
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+@pytest.fixture
+def df_compositions():
+    return pd.DataFrame(
+        {
+            "material_id": ["mat-0", "mat-1", "mat-2"],
+            "composition": ["NaCl", "Fe2O3", "SrTiO3"],
+            "target": [0.1, 0.2, 0.3],
+            "label": [0, 2, 1],
+        }
+    )
+
+
+def test_nbytes():
+    sample = ((torch.zeros(2, 3), torch.zeros(4, dtype=torch.long)), [1.0], "id")
+    assert nbytes(sample) == 2 * 3 * 4 + 4 * 8
+
+
+def test_feature_cache_lru_eviction():
+    cache = FeatureCache(max_bytes=3 * 4 * 10)  # room for 3 samples of 10 floats
+
+    def compute(idx):
+        return torch.full((10,), float(idx))
+
+    for idx in range(4):
+        cache.get(idx, compute)
+    assert len(cache) == 3
+    assert 0 not in cache
+    assert cache.stats["evictions"] == 1
+    assert cache.nbytes == 3 * 40
+
+    # hit moves 1 to the end so 2 is the next one to go
+    assert cache.get(1, compute)[0] == 1
+    cache.get(4, compute)
+    assert 1 in cache
+    assert 2 not in cache
+    assert cache.hits == 1
+    assert cache.misses == 5
+
+    # samples larger than the whole budget are returned but not stored
+    big = cache.get("big", lambda _: torch.zeros(100))
+    assert big.shape == (100,)
+    assert "big" not in cache
+
+    cache = FeatureCache(max_items=2)
+    for idx in range(5):
+        cache.get(idx, compute)
+    assert list(cache.store) == [3, 4]
+
+    cache.clear()
+    assert len(cache) == cache.nbytes == cache.hits == cache.misses == 0
+
+
+def test_shared_memory_feature_cache(df_compositions):
+    dataset = CompositionData(
+        df_compositions,
+        {"target": "regression"},
+        feature_cache=SharedMemoryFeatureCache(),
+    )
+    dataset.feature_cache.warm(range(len(dataset)), dataset.featurize)
+    inputs, targets, *_ = dataset[0]
+    assert all(tensor.is_shared() for tensor in (*inputs, *targets))
+    assert dataset.feature_cache.stats["hits"] == 1
+
+
+def test_dataset_feature_cache(df_compositions):
+    dataset = CompositionData(df_compositions, {"target": "regression"})
+    assert dataset[1] is dataset[1]
+    assert dataset.feature_cache.hits == 1
+    assert dataset.feature_cache.misses == 1
+
+    # samples must be identical to uncached featurization
+    inputs, targets, *ids = dataset[2]
+    fresh_inputs, fresh_targets, *fresh_ids = dataset.featurize(2)
+    for tensor, fresh in zip((*inputs, *targets), (*fresh_inputs, *fresh_targets)):
+        assert torch.equal(tensor, fresh)
+    assert ids == fresh_ids
+
+    # unlike functools.cache, the per-instance cache does not keep the dataset alive
+    ref = weakref.ref(dataset)
+    del dataset, inputs, targets, fresh_inputs, fresh_targets
+    gc.collect()
+    assert ref() is None
+
+
+def test_element_feature_table():
+    table = element_feature_table({"H": [1, 2], "Fe": [3, 4], "Null": [0, 0]})
+    assert table.shape[1] == 2
+    assert table.dtype == np.float32
+    assert table[1].tolist() == [1, 2]
+    assert table[26].tolist() == [3, 4]
+    assert np.isnan(table[[0, 2, 8]]).all()
+
+
+def test_get_target_columns(df_compositions):
+    task_dict = {"target": "regression", "label": "classification"}
+    regr, clf = get_target_columns(df_compositions, task_dict)
+    assert regr.dtype == torch.float32
+    assert torch.allclose(regr, torch.tensor([0.1, 0.2, 0.3]))
+    assert clf.dtype == torch.long
+    assert clf.tolist() == [0, 2, 1]
+
+    ids = get_identifier_rows(df_compositions, ["material_id", "composition"])
+    assert ids == [("mat-0", "NaCl"), ("mat-1", "Fe2O3"), ("mat-2", "SrTiO3")]
+    assert get_identifier_rows(df_compositions, []) == [(), (), ()]
+
+
+def test_composition_data_columnar(df_compositions):
+    task_dict = {"target": "regression", "label": "classification"}
+    dataset = CompositionData(df_compositions, task_dict)
+    assert dataset.elem_ptr.tolist() == [0, 2, 4, 7]
+
+    (elem_weights, elem_fea, self_idx, nbr_idx), targets, *ids = dataset[1]
+    assert ids == ["mat-1", "Fe2O3"]
+    assert torch.allclose(elem_weights, torch.tensor([[0.4], [0.6]]))
+    assert elem_fea.tolist() == [26, 8]  # atomic numbers of Fe and O
+    assert self_idx.tolist() == [0, 0, 1, 1]
+    assert nbr_idx.tolist() == [0, 1, 0, 1]
+    assert targets[0].shape == (1,)
+    assert targets[1].tolist() == [2]
+
+    # negative indices resolve like a list
+    assert dataset.featurize(-1)[2:] == ("mat-2", "SrTiO3")
+
+    # unknown elements are reported at construction time
+    df_bad = df_compositions.assign(composition=["NaCl", "Fe2O3", "Og2"])
+    with pytest.raises(ValueError, match=r"mat-2.*not in embedding"):
+        CompositionData(df_bad, task_dict, elem_embedding="megnet16")
+
+
+def test_fully_connected_edges():
+    self_idx, nbr_idx = fully_connected_edges(2, n_graphs=2)
+    assert self_idx.tolist() == [0, 0, 1, 1, 2, 2, 3, 3]
+    assert nbr_idx.tolist() == [0, 1, 0, 1, 2, 3, 2, 3]
+    # templates are cached
+    assert fully_connected_edges(2, n_graphs=2)[0] is self_idx
+
+    n_nodes = [1, 3, 2, 5, 1]
+    batch_self_idx, batch_nbr_idx = batch_fully_connected_edges(torch.tensor(n_nodes))
+    offsets = np.cumsum([0, *n_nodes[:-1]])
+    edges = [fully_connected_edges(n) for n in n_nodes]
+    assert torch.equal(
+        batch_self_idx, torch.cat([s + off for (s, _), off in zip(edges, offsets)])
+    )
+    assert torch.equal(
+        batch_nbr_idx, torch.cat([n + off for (_, n), off in zip(edges, offsets)])
+    )
+
+
+def test_csr_gather():
+    ptr = np.array([0, 2, 2, 5, 6])
+    flat_idx, counts = csr_gather(ptr, np.array([2, 0, 1, 3, 2]))
+    assert flat_idx.tolist() == [2, 3, 4, 0, 1, 5, 2, 3, 4]
+    assert counts.tolist() == [3, 2, 0, 1, 3]
+
+
+def test_in_memory_data_loader_from_dataset(df_compositions):
+    dataset = CompositionData(df_compositions, {"target": "regression"})
+    subset = torch.utils.data.Subset(dataset, [2, 0])
+    loader = InMemoryDataLoader.from_dataset(subset, batch_size=2)
+    assert len(loader) == 1
+
+    inputs, targets, material_ids, compositions = next(iter(loader))
+    assert material_ids == ("mat-2", "mat-0")
+    assert compositions == ("SrTiO3", "NaCl")
+    assert torch.allclose(targets[0], torch.tensor([[0.3], [0.1]]))
+    assert len(inputs[0]) == 3 + 2
+
+    with pytest.raises(ValueError, match="does not implement get_batch"):
+        InMemoryDataLoader.from_dataset(list(range(3)))
+
+
+@pytest.mark.parametrize(
+    "budgets",
+    [
+        dict(max_nodes=20),
+        dict(max_edges=100),
+        dict(max_nodes=30, max_edges=150, max_samples=4),
+    ],
+)
+def test_budget_batch_sampler(budgets):
+    rng = np.random.default_rng(0)
+    n_nodes = rng.integers(1, 12, 500)
+    n_edges = n_nodes**2
+    sampler = BudgetBatchSampler(n_nodes, n_edges, **budgets, seed=0)
+    batches = list(sampler)
+    assert len(sampler) == len(batches)
+    rows = [row for batch in batches for row in batch]
+    assert sorted(rows) == list(range(500))
+
+    limits = (
+        (n_nodes, budgets.get("max_nodes")),
+        (n_edges, budgets.get("max_edges")),
+        (np.ones_like(n_nodes), budgets.get("max_samples")),
+    )
+    fill = np.zeros(len(batches))  # fraction of the tightest budget used per batch
+    for sizes, budget in limits:
+        if budget is None:
+            continue
+        batch_totals = np.array([sizes[batch].sum() for batch in batches])
+        # oversized rows get a batch of their own, all other batches fit the budget
+        assert all(
+            total <= budget or len(batch) == 1
+            for total, batch in zip(batch_totals, batches)
+        )
+        fill = np.maximum(fill, batch_totals / budget)
+    # batches are packed close to their budget
+    assert fill.mean() > 0.8
+
+    # shuffled epochs give new batches, unshuffled packing keeps dataset order
+    assert list(sampler) != batches
+    sampler.set_epoch(0)  # epochs are reproducible from the seed
+    assert list(sampler) == batches
+    unshuffled = BudgetBatchSampler(n_nodes, n_edges, **budgets, shuffle=False)
+    assert [row for batch in unshuffled for row in batch] == list(range(500))
+
+
+def test_budget_batch_sampler_errors():
+    with pytest.raises(ValueError, match="Set at least one of"):
+        BudgetBatchSampler([1, 2])
+    with pytest.raises(ValueError, match="max_nodes=0 must be positive"):
+        BudgetBatchSampler([1, 2], max_nodes=0)
+    with pytest.raises(ValueError, match="n_edges is required"):
+        BudgetBatchSampler([1, 2], max_edges=4)
+    with pytest.raises(ValueError, match="must have the same length"):
+        BudgetBatchSampler([1, 2], [1], max_nodes=4)
+    with pytest.raises(ValueError, match="does not implement graph_sizes"):
+        BudgetBatchSampler.from_dataset(list(range(3)), max_nodes=4)
+
+
+def test_budget_batch_sampler_from_dataset(df_compositions):
+    dataset = CompositionData(df_compositions, {"target": "regression"})
+    n_nodes, n_edges = dataset.graph_sizes()
+    assert n_nodes.tolist() == [2, 2, 3]
+    assert n_edges.tolist() == [4, 4, 9]
+
+    subset = torch.utils.data.Subset(dataset, [2, 0, 1])
+    sampler = BudgetBatchSampler.from_dataset(subset, max_nodes=4, shuffle=False)
+    assert sampler.n_nodes.tolist() == [3, 2, 2]
+    assert list(sampler) == [[0], [1, 2]]
+
+    # budget batches work with both the in-memory loader and torch DataLoader
+    loader = InMemoryDataLoader.from_dataset(subset, batch_sampler=sampler)
+    torch_loader = torch.utils.data.DataLoader(
+        subset, batch_sampler=sampler, collate_fn=collate_batch
+    )
+    assert len(loader) == len(torch_loader) == 2
+    for (_, _, ids, _), (_, _, torch_ids, _) in zip(loader, torch_loader):
+        assert ids == torch_ids
+    assert ids == ("mat-0", "mat-1")
+
+
+@pytest.mark.parametrize("use_batch_sampler", [False, True])
+def test_in_memory_data_loader_prefetch(use_batch_sampler):
+    tensors = [torch.arange(100), np.arange(100) * 2]
+    kwargs = dict(collate_fn=lambda *batch: batch, batch_size=8, shuffle=True)
+    if use_batch_sampler:
+        kwargs["batch_sampler"] = BudgetBatchSampler(np.arange(100) % 7, max_nodes=20)
+
+    epochs = {}
+    for prefetch in (0, 3):
+        np.random.seed(0)
+        loader = InMemoryDataLoader(tensors, prefetch=prefetch, **kwargs)
+        epochs[prefetch] = [list(loader), list(loader)]
+
+    # same batches in the same order with and without prefetching
+    for epoch, prefetched_epoch in zip(epochs[0], epochs[3]):
+        assert len(epoch) == len(prefetched_epoch)
+        for batch, prefetched_batch in zip(epoch, prefetched_epoch):
+            assert torch.equal(batch[0], prefetched_batch[0])
+            assert np.array_equal(batch[1], prefetched_batch[1])
+    assert not torch.equal(epochs[3][0][0][0], epochs[3][1][0][0])
+
+    with pytest.raises(ValueError, match="must be non-negative"):
+        InMemoryDataLoader(tensors, prefetch=-1, **kwargs)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize("drop_last", [False, True])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_in_memory_data_loader_sharding(shuffle, drop_last, prefetch):
+    n_rows, world_size = 23, 4
+    tensors = [torch.arange(n_rows)]
+    kwargs = dict(
+        collate_fn=lambda rows: rows,
+        batch_size=4,
+        shuffle=shuffle,
+        drop_last=drop_last,
+        prefetch=prefetch,
+        world_size=world_size,
+    )
+    loaders = [InMemoryDataLoader(tensors, rank=rank, **kwargs) for rank in range(4)]
+
+    def epoch_rows(epoch: int) -> list[list[int]]:
+        rows = []
+        for loader in loaders:
+            loader.set_epoch(epoch)
+            batches = list(loader)
+            assert len(batches) == len(loader)
+            rows.append(torch.cat(batches).tolist())
+        return rows
+
+    shards = epoch_rows(0)
+    # equal shard lengths, padded with repeated rows or dropping the surplus
+    shard_len = n_rows // world_size if drop_last else -(-n_rows // world_size)
+    assert all(len(shard) == shard_len for shard in shards)
+    all_rows = [row for shard in shards for row in shard]
+    if drop_last:  # disjoint shards
+        assert len(set(all_rows)) == len(all_rows) == n_rows - n_rows % world_size
+    else:  # every row is seen at least once
+        assert set(all_rows) == set(range(n_rows))
+
+    # all ranks agree on the seeded permutation of each epoch
+    assert epoch_rows(0) == shards
+    assert (epoch_rows(1) != shards) == shuffle
+
+
+def test_in_memory_data_loader_sharding_batch_sampler():
+    tensors = [torch.arange(50)]
+    sampler = [list(range(start, start + 5)) for start in range(0, 50, 5)]
+    kwargs = dict(collate_fn=lambda rows: rows.tolist(), batch_sampler=sampler)
+    for drop_last, n_batches in ((False, 4), (True, 3)):
+        shards = [
+            list(
+                InMemoryDataLoader(
+                    tensors, rank=rank, world_size=3, drop_last=drop_last, **kwargs
+                )
+            )
+            for rank in range(3)
+        ]
+        assert [len(shard) for shard in shards] == [n_batches] * 3
+        assert shards[1][0] == sampler[1]
+
+    with pytest.raises(
+        ValueError, match=r"self.rank=3 must be in \[0, self.world_size=3\)"
+    ):
+        InMemoryDataLoader(tensors, rank=3, world_size=3, **kwargs)
+
+    # samplers drawing random batches must be seeded so all ranks agree on them
+    n_nodes = np.arange(50) % 7
+    with pytest.raises(ValueError, match="batch_sampler must be seeded"):
+        InMemoryDataLoader(
+            tensors,
+            collate_fn=kwargs["collate_fn"],
+            batch_sampler=BudgetBatchSampler(n_nodes, max_nodes=20),
+            world_size=2,
+        )
+    seeded_kwargs = dict(collate_fn=kwargs["collate_fn"], world_size=2)
+    loaders = [
+        InMemoryDataLoader(
+            tensors,
+            batch_sampler=BudgetBatchSampler(n_nodes, max_nodes=20, seed=2),
+            rank=rank,
+            **seeded_kwargs,
+        )
+        for rank in range(2)
+    ]
+    for _ in range(2):  # same batches on all ranks every epoch
+        rows = [row for loader in loaders for batch in loader for row in batch]
+        assert sorted(set(rows)) == list(range(50))
+
+    # seeded shuffling without sharding is reproducible across loaders
+    collate_fn = kwargs["collate_fn"]
+    loaders = [
+        InMemoryDataLoader(tensors, collate_fn=collate_fn, shuffle=True, seed=1)
+        for _ in range(2)
+    ]
+    assert list(loaders[0]) == list(loaders[1])
+
+
+def test_batch_prefetcher_errors_and_shutdown():
+    def batches():
+        yield 1
+        yield 2
+        raise RuntimeError("bad batch")
+
+    prefetcher = BatchPrefetcher(batches(), depth=1)
+    assert next(prefetcher) == 1
+    assert next(prefetcher) == 2
+    # errors in the background thread are re-raised in the consuming thread
+    with pytest.raises(RuntimeError, match="bad batch"):
+        next(prefetcher)
+    assert not prefetcher.thread.is_alive()
+    with pytest.raises(StopIteration):
+        next(prefetcher)
+
+    # breaking out of a loop stops the thread once the iterator is collected
+    prefetcher = BatchPrefetcher(iter(range(1000)), depth=2)
+    thread = prefetcher.thread
+    for batch in prefetcher:
+        if batch == 3:
+            break
+    del prefetcher
+    gc.collect()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    assert "BatchPrefetcher" not in [t.name for t in threading.enumerate()]
+
+    with pytest.raises(ValueError, match="depth=0 must be positive"):
+        BatchPrefetcher([], depth=0)
+
+
+@pytest.fixture
+def parquet_shards(tmp_path):
+    """12 compositions in 3 Parquet shards with 2 row groups each."""
+    formulas = ["NaCl", "Fe2O3", "SrTiO3", "LiF", "MgO", "CaTiO3"] * 2
+    df = pd.DataFrame(
+        {
+            "material_id": [f"mat-{idx}" for idx in range(len(formulas))],
+            "composition": formulas,
+            "target": np.linspace(0, 1, len(formulas)),
+        }
+    )
+    for shard in range(3):
+        df_shard = df.iloc[4 * shard : 4 * (shard + 1)]
+        df_shard.to_parquet(tmp_path / f"shard-{shard}.parquet", row_group_size=2)
+    return tmp_path, df
+
+
+@pytest.mark.skipif(pa is None, reason="pyarrow not installed")
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_parquet_shard_dataset(parquet_shards, prefetch):
+    path, df = parquet_shards
+    task_dict = {"target": "regression"}
+    dataset = CompositionStreamData(path, task_dict, prefetch=prefetch)
+    assert len(dataset.row_groups) == 6
+    assert dataset.n_rows == len(df)
+
+    # unshuffled streaming matches the in-memory dataset sample by sample
+    in_memory = CompositionData(df, task_dict)
+    samples = list(dataset)
+    assert len(samples) == len(df)
+    for idx, (inputs, targets, *ids) in enumerate(samples):
+        ref_inputs, ref_targets, *ref_ids = in_memory[idx]
+        assert ids == ref_ids
+        assert torch.allclose(targets[0], ref_targets[0])
+        for tensor, ref_tensor in zip(inputs, ref_inputs):
+            assert torch.equal(tensor, ref_tensor)
+
+    def material_ids(dataset: ParquetShardDataset) -> list[str]:
+        return [material_id for _, _, material_id, _ in dataset]
+
+    # shuffling permutes all samples, reproducibly per epoch but differently per epoch
+    shuffled = CompositionStreamData(path, task_dict, shuffle=True, shuffle_buffer=3)
+    epoch_0 = material_ids(shuffled)
+    assert sorted(epoch_0) == sorted(df.material_id)
+    assert epoch_0 != list(df.material_id)
+    assert material_ids(shuffled) == epoch_0
+    shuffled.set_epoch(1)
+    assert material_ids(shuffled) != epoch_0
+
+
+@pytest.mark.skipif(pa is None, reason="pyarrow not installed")
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_parquet_shard_dataset_workers(parquet_shards, shuffle):
+    path, df = parquet_shards
+    dataset = CompositionStreamData(path, {"target": "regression"}, shuffle=shuffle)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=4, num_workers=2, collate_fn=collate_batch
+    )
+    # every sample is streamed by exactly one worker
+    material_ids = [mat_id for _, _, ids, _ in loader for mat_id in ids]
+    assert sorted(material_ids) == sorted(df.material_id)
+
+
+@pytest.mark.skipif(pa is None, reason="pyarrow not installed")
+def test_parquet_shard_dataset_fit_epochs(parquet_shards):
+    path, df = parquet_shards
+    task_dict = {"target": "regression"}
+    dataset = CompositionStreamData(path, task_dict, shuffle=True, shuffle_buffer=3)
+    epoch_ids: list[list[str]] = []
+
+    def record_collate(samples):
+        if len(epoch_ids) == 0 or len(epoch_ids[-1]) == len(df):
+            epoch_ids.append([])
+        epoch_ids[-1] += [material_id for _, _, material_id, _ in samples]
+        return collate_batch(samples)
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4, collate_fn=record_collate)
+    model = Roost(
+        robust=False,
+        n_targets=[1],
+        elem_emb_len=200,
+        elem_embedding="matscholar200",
+        task_dict=task_dict,
+    )
+    optimizer = torch.optim.SGD(model.parameters(), lr=0)
+    model.fit(
+        loader,
+        None,
+        optimizer=optimizer,
+        scheduler=torch.optim.lr_scheduler.ConstantLR(optimizer, factor=1),
+        epochs=2,
+        loss_dict={"target": ("regression", torch.nn.L1Loss())},
+        normalizer_dict={"target": Normalizer()},
+        model_name="parquet-epochs-test",
+        run_id=0,
+        checkpoint=False,
+        verbose=False,
+    )
+    # fit() passes the epoch to the streamed dataset so its order changes per epoch
+    assert len(epoch_ids) == 2
+    assert sorted(epoch_ids[0]) == sorted(epoch_ids[1]) == sorted(df.material_id)
+    assert epoch_ids[0] != epoch_ids[1]
+    assert dataset.epoch == 1
+
+
+@pytest.mark.skipif(pa is None, reason="pyarrow not installed")
+def test_parquet_shard_dataset_errors(tmp_path):
+    with pytest.raises(ValueError, match="No Parquet shards found"):
+        ParquetShardDataset(tmp_path, featurize=list)
+    with pytest.raises(ValueError, match="shuffle_buffer=0 must be positive"):
+        ParquetShardDataset(tmp_path, featurize=list, shuffle_buffer=0)
+
+
+def test_slim_pickle_mixin(df_compositions):
+    dataset = CompositionData(df_compositions, {"target": "regression"})
+    state = dataset.__getstate__()
+    assert "elem_features" not in state
+    assert list(state["df"]) == []
+    assert state["df"].index.equals(df_compositions.index)
+
+    for copy in (
+        pickle.loads(pickle.dumps(dataset)),
+        ForkingPickler.loads(ForkingPickler.dumps(dataset)),
+    ):
+        assert len(copy) == len(dataset)
+        for idx in range(len(dataset)):
+            (inputs, targets, *ids), (ref_inputs, ref_targets, *ref_ids) = (
+                copy[idx],
+                dataset[idx],
+            )
+            assert ids == ref_ids
+            for tensor, ref_tensor in zip(
+                (*inputs, *targets), (*ref_inputs, *ref_targets)
+            ):
+                assert torch.equal(tensor, ref_tensor)
+
+    # arrays are moved into shared memory only once and the dataset keeps no copy
+    shared_weights = dataset.__getstate__()["elem_weights"].tensor
+    assert shared_weights.is_shared()
+    assert shared_weights.data_ptr() == state["elem_weights"].tensor.data_ptr()
+    assert dataset.elem_weights.ctypes.data == shared_weights.data_ptr()
+    assert "_shared_arrays" not in vars(dataset)
+
+
+def test_slim_pickle_mixin_wyckoff_data():
+    labels = ["AB_cF8_225_a_b:Cl-Na", "ABC3_cP5_221_a_b_c:Ba-O-Ti"]
+    df = pd.DataFrame({"material_id": labels, "composition": labels, "wyckoff": labels})
+    df["y"] = [0.0, 1.0]
+    dataset = WyckoffData(df, {"y": "regression"})
+    # the symmetry embedding tables are sent as handles instead of by value
+    assert (
+        len(ForkingPickler.dumps(dataset)) < len(pickle.dumps(dataset.sym_features)) / 10
+    )
+    copy = ForkingPickler.loads(ForkingPickler.dumps(dataset))
+    assert "sym_features" not in vars(copy)
+    for tensor, ref_tensor in zip(copy[1][0], dataset[1][0]):
+        assert torch.equal(tensor, ref_tensor)
@@ -0,0 +1,120 @@
+import pandas as pd
+import pytest
+import torch
+from pymatgen.core import Composition
+
+from aviary.roost.data import (
+    CompositionData,
+    collate_batch,
+    parse_formula,
+    parse_formulas,
+)
+
+FORMULAS = [
+    "Fe2O3",
+    "Li3Fe2(PO4)3",
+    "Y3N@C80",
+    "Ca[Fe(CN)6]0.5",
+    "Fe0.5O0.5",
+    "O2Fe3O",
+    "NaCl1e-9",
+    "Ba1.5e-1Ti",
+    "H2O ",
+    " NaCl",
+    "D2O",
+    "Fe2 O3",
+    "Mg(OH)2(H2O)2",
+    "Ba0.5Sr0.5TiO3",
+    "K4{Fe(CN)6}",
+    "Na0Cl",
+]
+
+
+@pytest.mark.parametrize("formula", FORMULAS)
+def test_parse_formula_matches_pymatgen(formula):
+    expected = Composition(formula).get_el_amt_dict()
+    parsed = parse_formula(formula)
+    assert [el for el, _ in parsed] == list(expected)
+    assert [amt for _, amt in parsed] == pytest.approx(list(expected.values()))
+
+
+@pytest.mark.parametrize("formula", ["", "12", "Fe2O3$", "Fe-2O3", "xyz"])
+def test_parse_formula_invalid(formula):
+    with pytest.raises(ValueError, match=r"(?i)invalid|negative"):
+        Composition(formula)
+    with pytest.raises(ValueError, match=r"(?i)invalid|negative"):
+        parse_formula(formula)
+
+
+def test_parse_formulas():
+    parse_formula.cache_clear()
+    formulas = ["NaCl", "Fe2O3", "NaCl", Composition("SiO2"), "Fe2O3", "NaCl"]
+
+    parsed = parse_formulas(formulas)
+    assert parsed == [
+        (("Na", 1), ("Cl", 1)),
+        (("Fe", 2), ("O", 3)),
+        (("Na", 1), ("Cl", 1)),
+        (("Si", 1), ("O", 2)),
+        (("Fe", 2), ("O", 3)),
+        (("Na", 1), ("Cl", 1)),
+    ]
+    # each unique string is parsed once, repeated calls hit the cache
+    assert parse_formula.cache_info().misses == 2
+    parse_formulas(pd.Series(["NaCl", "Fe2O3"]))
+    assert parse_formula.cache_info().hits == 2
+
+
+def test_composition_data_formula_errors():
+    df = pd.DataFrame({"material_id": ["a"], "composition": ["Na(Cl"], "y": [1.0]})
+    with pytest.raises(ValueError, match="invalid formula"):
+        CompositionData(df, {"y": "regression"})
+
+    df["composition"] = ["Xx2O"]
+    with pytest.raises(ValueError, match="cannot be parsed into elements"):
+        CompositionData(df, {"y": "regression"})
+
+
+def test_composition_data_collate_edges():
+    df = pd.DataFrame(
+        {
+            "material_id": ["a", "b", "c"],
+            "composition": ["NaCl", "Fe2O3", "Ba0.5Sr0.5TiO3"],
+            "y": [1.0, 2.0, 3.0],
+        }
+    )
+    dataset = CompositionData(df, {"y": "regression"})
+    lean_dataset = CompositionData(df, {"y": "regression"}, collate_edges=True)
+    assert len(dataset[0][0]) == 4
+    assert len(lean_dataset[0][0]) == 2
+
+    inputs, targets, *ids = collate_batch([dataset[idx] for idx in range(3)])
+    lean_inputs, lean_targets, *lean_ids = collate_batch(
+        [lean_dataset[idx] for idx in range(3)]
+    )
+    for tensor, lean_tensor in zip(inputs, lean_inputs):
+        assert torch.equal(tensor, lean_tensor)
+    # CSR offsets of the elements of each crystal
+    assert inputs[-1].tolist() == [0, 2, 4, 8]
+    assert torch.equal(targets[0], lean_targets[0])
+    assert ids == lean_ids
+
+
+@pytest.mark.parametrize("collate_edges", [False, True])
+def test_composition_data_get_batch(collate_edges):
+    df = pd.DataFrame(
+        {
+            "material_id": ["a", "b", "c", "d"],
+            "composition": ["NaCl", "Fe2O3", "Ba0.5Sr0.5TiO3", "Fe"],
+            "y": [1.0, 2.0, 3.0, 4.0],
+        }
+    )
+    dataset = CompositionData(df, {"y": "regression"}, collate_edges=collate_edges)
+    rows = [2, 0, -1, 1]
+    inputs, targets, *ids = dataset.get_batch(rows)
+    ref_inputs, ref_targets, *ref_ids = collate_batch([dataset[row] for row in rows])
+    for tensor, ref_tensor in zip((*inputs, *targets), (*ref_inputs, *ref_targets)):
+        assert tensor.dtype == ref_tensor.dtype
+        assert torch.equal(tensor, ref_tensor)
+    assert ids == ref_ids
+    assert ids[0] == ("c", "a", "d", "b")
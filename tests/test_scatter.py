@@ -0,0 +1,106 @@
+import pytest
+import torch
+
+from aviary.scatter import scatter_reduce, segment_ptr
+
+REDUCE_MODES = ["sum", "mean", "amax", "amin", "prod"]
+
+
+def reference_scatter(src, index, dim_size, reduce):
+    """Loop-based reference with torch_scatter semantics: empty segments are 0 (1 for
+    prod).
+    """
+    reducers = {
+        "sum": lambda rows: rows.sum(0),
+        "mean": lambda rows: rows.mean(0),
+        "amax": lambda rows: rows.max(0).values,
+        "amin": lambda rows: rows.min(0).values,
+        "prod": lambda rows: rows.prod(0),
+    }
+    fill_value = 1 if reduce == "prod" else 0
+    out = torch.full((dim_size, *src.shape[1:]), fill_value, dtype=src.dtype)
+    for seg in range(dim_size):
+        rows = src[index == seg]
+        if len(rows) > 0:
+            out[seg] = reducers[reduce](rows)
+    return out
+
+
+@pytest.mark.parametrize("reduce", REDUCE_MODES)
+def test_scatter_reduce_matches_reference(reduce):
+    torch.manual_seed(0)
+    src = torch.randn(200, 8, dtype=torch.float64)
+    # unsorted duplicate indices and an empty segment 3
+    index = torch.randint(0, 10, (200,))
+    index[index == 3] = 4
+    out = scatter_reduce(src, index, dim=0, dim_size=12, reduce=reduce)
+    assert torch.allclose(out, reference_scatter(src, index, 12, reduce))
+
+
+def test_scatter_reduce_max_duplicate_indices():
+    # all elements go to the same position, max must not depend on write order
+    src = torch.tensor([3.0, 7.0, -1.0, 5.0])
+    index = torch.zeros(4, dtype=torch.long)
+    assert scatter_reduce(src, index, dim=0, reduce="max").tolist() == [7.0]
+    assert scatter_reduce(src, index, dim=0, reduce="min").tolist() == [-1.0]
+    # all-negative segments are not clamped by a fill value
+    out = scatter_reduce(-src.abs() - 1, torch.tensor([0, 0, 1, 1]), reduce="amax")
+    assert out.tolist() == [-4.0, -2.0]
+
+
+@pytest.mark.parametrize("reduce", REDUCE_MODES)
+def test_scatter_reduce_gradcheck(reduce):
+    torch.manual_seed(0)
+    # distinct values avoid ties where amax/amin gradients are not differentiable
+    src = (torch.randperm(30, dtype=torch.float64) / 10 + 0.5).view(10, 3)
+    src.requires_grad_()
+    index = torch.tensor([0, 2, 0, 1, 2, 2, 0, 4, 1, 4])
+    assert torch.autograd.gradcheck(
+        lambda src: scatter_reduce(src, index, dim=0, dim_size=5, reduce=reduce), src
+    )
+
+
+def test_scatter_reduce_invalid():
+    with pytest.raises(ValueError, match="Unsupported reduction method: median"):
+        scatter_reduce(torch.ones(3), torch.zeros(3, dtype=torch.long), reduce="median")
+
+
+@pytest.mark.parametrize("reduce", REDUCE_MODES)
+def test_scatter_reduce_dim(reduce):
+    torch.manual_seed(0)
+    src = torch.rand(4, 20, dtype=torch.float64) + 0.5
+    index = torch.randint(0, 6, (20,))
+    out = scatter_reduce(src, index, dim=1, dim_size=7, reduce=reduce)
+    expected = reference_scatter(src.T, index, 7, reduce).T
+    assert torch.allclose(out, expected)
+    # full-size index gives the same result
+    full_index = index.expand_as(src)
+    out = scatter_reduce(src, full_index, dim=1, dim_size=7, reduce=reduce)
+    assert torch.allclose(out, expected)
+
+
+def test_segment_ptr():
+    index = torch.tensor([0, 0, 2, 2, 2, 3])
+    assert segment_ptr(index, 5).tolist() == [0, 2, 2, 5, 6, 6]
+    assert segment_ptr(torch.zeros(0, dtype=torch.long), 2).tolist() == [0, 0, 0]
+
+
+@pytest.mark.parametrize("reduce", REDUCE_MODES)
+@pytest.mark.parametrize("dim", [0, 1, -1])
+def test_scatter_reduce_ptr(reduce, dim):
+    torch.manual_seed(0)
+    # sorted index with empty segments 1 and 5 (last)
+    index = torch.tensor([0, 0, 0, 2, 3, 3, 4, 4, 4, 4])
+    ptr = segment_ptr(index, 6)
+    shape = [3, 3]
+    shape[dim] = len(index)
+    # distinct values avoid ties where amax/amin gradients are not differentiable
+    src = torch.randperm(30, dtype=torch.float64).view(shape) / 10 + 0.5
+    src.requires_grad_()
+
+    out = scatter_reduce(src, index, dim=dim, reduce=reduce, ptr=ptr)
+    expected = scatter_reduce(src, index, dim=dim, dim_size=6, reduce=reduce)
+    assert torch.allclose(out, expected)
+    assert torch.autograd.gradcheck(
+        lambda src: scatter_reduce(src, index, dim=dim, reduce=reduce, ptr=ptr), src
+    )
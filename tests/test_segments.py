@@ -0,0 +1,355 @@
+import json
+
+import pandas as pd
+import pytest
+import torch
+from torch.optim.lr_scheduler import MultiStepLR
+
+from aviary.data import element_feature_table, load_element_embedding
+from aviary.networks import SimpleNetwork
+from aviary.roost.data import CompositionData, collate_batch
+from aviary.roost.model import Roost
+from aviary.scatter import segment_ptr
+from aviary.segments import (
+    AttentionPooling,
+    FrozenElementEmbedding,
+    MultiHeadAttentionPooling,
+    WeightedAttentionPooling,
+    segment_softmax_pool,
+)
+from aviary.utils import initialize_model, initialize_optim
+
+
+@pytest.mark.parametrize(
+    "elem_embedding, elem_emb_len",
+    [("matscholar200", 200), ("cgcnn92", 92), ("megnet16", 16), ("onehot112", 112)],
+)
+def test_frozen_element_embedding(elem_embedding, elem_emb_len):
+    lookup = FrozenElementEmbedding(elem_emb_len, elem_embedding)
+    assert lookup.elem_embedding == elem_embedding
+    assert lookup.weight.shape[1] == elem_emb_len
+
+    elem_features = load_element_embedding(elem_embedding)
+    atomic_nums = torch.tensor([8, 26, 1])
+    expected = torch.tensor(
+        [elem_features[el] for el in ("O", "Fe", "H")], dtype=torch.float32
+    )
+    assert torch.allclose(lookup(atomic_nums), expected)
+
+    # precomputed features pass through unchanged
+    assert lookup(expected) is expected
+
+    # lookup table is not saved in checkpoints
+    assert "weight" not in lookup.state_dict()
+
+
+def test_frozen_element_embedding_errors():
+    with pytest.raises(ValueError, match="has 200 features, expected elem_emb_len=92"):
+        FrozenElementEmbedding(92, "matscholar200")
+
+    # embeddings are not inferred from their width, a custom embedding of a dataset
+    # can have that of a built-in one
+    for elem_emb_len in (7, 200):
+        lookup = FrozenElementEmbedding(elem_emb_len)
+        assert lookup.weight is None
+        with pytest.raises(ValueError, match="no element embedding is known"):
+            lookup(torch.tensor([1, 2]))
+
+
+def test_frozen_element_embedding_custom(tmp_path):
+    elem_features = load_element_embedding("megnet16")
+    custom = {el: [-x for x in fea] for el, fea in elem_features.items()}
+    path = tmp_path / "custom16.json"
+    path.write_text(json.dumps(custom))
+
+    lookup = FrozenElementEmbedding(16, str(path))
+    expected = -torch.tensor(elem_features["Fe"], dtype=torch.float32)
+    assert torch.allclose(lookup(torch.tensor([26]))[0], expected)
+
+
+def test_roost_default_elem_embedding():
+    df = pd.DataFrame(
+        {"material_id": ["a", "b"], "composition": ["NaCl", "Fe2O3"], "y": [1.0, 2.0]}
+    )
+    dataset = CompositionData(df, {"y": "regression"})
+    inputs, *_ = collate_batch([dataset[0], dataset[1]])
+
+    # model_params of checkpoints from before the lookup table have no
+    # elem_embedding, models default to the embedding datasets default to
+    with torch.random.fork_rng():
+        model = Roost(
+            robust=False,
+            n_targets=[1],
+            elem_emb_len=dataset.elem_emb_len,
+            task_dict={"y": "regression"},
+        )
+    assert model.model_params["elem_embedding"] == dataset.elem_embedding
+    with torch.no_grad():
+        (out,) = model(*inputs)
+    assert out.shape == (2, 1)
+
+
+def test_roost_atomic_number_inputs():
+    df = pd.DataFrame(
+        {"material_id": ["a", "b"], "composition": ["NaCl", "Fe2O3"], "y": [1.0, 2.0]}
+    )
+    dataset = CompositionData(df, {"y": "regression"}, elem_embedding="megnet16")
+    inputs, *_ = collate_batch([dataset[0], dataset[1]])
+
+    # fork the RNG to not shift the global seed set in conftest for later tests
+    with torch.random.fork_rng():
+        model = Roost(
+            robust=False,
+            n_targets=[1],
+            elem_emb_len=16,
+            elem_embedding=dataset.elem_embedding,
+            task_dict={"y": "regression"},
+        )
+    assert model.model_params["elem_embedding"] == "megnet16"
+
+    # checkpoints from before the lookup table existed load with strict=True
+    state_dict = model.state_dict()
+    assert not any(key.startswith("elem_lookup") for key in state_dict)
+    model.load_state_dict(state_dict)
+
+    # atomic number inputs give the same output as precomputed element features
+    elem_weights, elem_z, *graph = inputs
+    table = torch.from_numpy(element_feature_table(dataset.elem_features))
+    with torch.no_grad():
+        out_z = model(elem_weights, elem_z, *graph)
+        out_fea = model(elem_weights, table[elem_z], *graph)
+    assert torch.allclose(out_z[0], out_fea[0])
+
+
+@pytest.mark.parametrize("pooling_cls", [AttentionPooling, WeightedAttentionPooling])
+def test_attention_pooling_gradcheck(pooling_cls):
+    torch.manual_seed(0)
+    pooling = pooling_cls(
+        gate_nn=torch.nn.Linear(4, 1), message_nn=torch.nn.Linear(4, 3)
+    ).double()
+    x = torch.randn(9, 4, dtype=torch.float64, requires_grad=True)
+    weights = torch.rand(9, 1, dtype=torch.float64) + 0.5
+    index = torch.tensor([0, 0, 1, 2, 2, 2, 1, 0, 2])
+    args = (index, weights) if pooling_cls is WeightedAttentionPooling else (index,)
+
+    out = pooling(x, *args)
+    # attention weights of each segment sum to 1, so equal messages pass through
+    torch.testing.assert_close(
+        pooling(torch.ones(9, 4, dtype=torch.float64), *args),
+        pooling.message_nn(torch.ones(3, 4, dtype=torch.float64)),
+    )
+    assert out.shape == (3, 3)
+    # detaching the softmax shift by the segment max does not change the gradients
+    assert torch.autograd.gradcheck(lambda x: pooling(x, *args), x)
+
+
+@pytest.mark.parametrize("weighted", [True, False])
+def test_segment_softmax_pool(weighted):
+    torch.manual_seed(0)
+    # unsorted index with an empty segment 3
+    index = torch.tensor([0, 0, 1, 2, 2, 2, 1, 0, 2, 4])
+    gate = torch.randn(10, 1, dtype=torch.float64, requires_grad=True)
+    messages = torch.randn(10, 5, dtype=torch.float64, requires_grad=True)
+    weights = torch.rand(10, 1, dtype=torch.float64) + 0.5
+    weights = weights.requires_grad_() if weighted else None
+
+    out = segment_softmax_pool(gate, messages, index, weights, dim_size=6)
+    expected = torch.zeros(6, 5, dtype=torch.float64)
+    for seg in index.unique():
+        mask = index == seg
+        attn = gate[mask].exp() * (weights[mask] if weighted else 1)
+        expected[seg] = (attn / attn.sum() * messages[mask]).sum(0)
+    torch.testing.assert_close(out, expected)
+
+    # same result reducing the segments of the sorted rows with CSR offsets
+    order = index.argsort(stable=True)
+    ptr = segment_ptr(index[order], 6)
+    out_sorted = segment_softmax_pool(
+        gate[order],
+        messages[order],
+        index[order],
+        weights[order] if weighted else None,
+        ptr=ptr,
+    )
+    torch.testing.assert_close(out_sorted, expected)
+
+    inputs = (gate, messages, weights) if weighted else (gate, messages)
+    assert torch.autograd.gradcheck(
+        lambda *args: segment_softmax_pool(args[0], args[1], index, *args[2:]),
+        inputs,
+    )
+
+
+def test_segment_softmax_pool_heads():
+    torch.manual_seed(0)
+    index = torch.tensor([0, 0, 1, 2, 2, 2, 1, 0, 2])
+    gate = torch.randn(9, 3, 1, dtype=torch.float64, requires_grad=True)
+    messages = torch.randn(9, 3, 4, dtype=torch.float64, requires_grad=True)
+    # weights shared by all heads are broadcast and get the summed gradient
+    weights = (torch.rand(9, 1, 1, dtype=torch.float64) + 0.5).requires_grad_()
+
+    out = segment_softmax_pool(gate, messages, index, weights)
+    assert out.shape == (3, 3, 4)
+    for head in range(3):
+        torch.testing.assert_close(
+            out[:, head],
+            segment_softmax_pool(gate[:, head], messages[:, head], index, weights[:, 0]),
+        )
+    assert torch.autograd.gradcheck(
+        lambda *args: segment_softmax_pool(args[0], args[1], index, args[2]),
+        (gate, messages, weights),
+    )
+
+
+def test_multi_head_attention_pooling_loads_head_list():
+    torch.manual_seed(0)
+    # checkpoints from before the heads were batched hold a list of pooling heads
+    heads = torch.nn.ModuleList(
+        WeightedAttentionPooling(
+            gate_nn=SimpleNetwork(6, 1, [8, 5]),
+            message_nn=SimpleNetwork(6, 4, [7]),
+        )
+        for _ in range(3)
+    ).double()
+    pooling = MultiHeadAttentionPooling(6, 4, 3, [8, 5], [7]).double()
+    pooling.load_state_dict(heads.state_dict())
+    assert pooling.gate_nn.fcs[1].weight.shape == (3, 5, 8)
+
+    x = torch.randn(9, 6, dtype=torch.float64, requires_grad=True)
+    weights = torch.rand(9, 1, dtype=torch.float64) + 0.5
+    index = torch.tensor([0, 0, 1, 3, 3, 3, 1, 0, 3])
+    out = pooling(x, index, weights, dim_size=5)
+    expected = torch.stack([head(x, index, weights, dim_size=5) for head in heads])
+    torch.testing.assert_close(out, expected.mean(0))
+
+    order = index.argsort(stable=True)
+    ptr = segment_ptr(index[order], 5)
+    out_sorted = pooling(x[order], index[order], weights[order], ptr=ptr)
+    torch.testing.assert_close(out_sorted, out)
+    assert torch.autograd.gradcheck(lambda x: pooling(x, index, weights), x)
+
+
+def test_roost_loads_per_head_checkpoint():
+    df = pd.DataFrame(
+        {"material_id": ["a", "b"], "composition": ["NaCl", "Fe2O3"], "y": [1.0, 2.0]}
+    )
+    dataset = CompositionData(df, {"y": "regression"}, elem_embedding="megnet16")
+    inputs, *_ = collate_batch([dataset[0], dataset[1]])
+
+    with torch.random.fork_rng():
+        model = Roost(
+            robust=False,
+            n_targets=[1],
+            elem_emb_len=16,
+            elem_embedding=dataset.elem_embedding,
+            task_dict={"y": "regression"},
+        )
+        new_model = Roost(**model.model_params)
+
+    # split the stacked parameters of every head as in checkpoints with head lists
+    pooling_names = {
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, MultiHeadAttentionPooling)
+    }
+    assert len(pooling_names) == 4  # 3 message passing layers and the crystal pool
+    old_state_dict = {}
+    for key, tensor in model.state_dict().items():
+        module_name = next(
+            (mod for mod in pooling_names if key.startswith(f"{mod}.")), None
+        )
+        if module_name is None:
+            old_state_dict[key] = tensor
+            continue
+        name = key.removeprefix(f"{module_name}.")
+        for head, head_tensor in enumerate(tensor):
+            old_state_dict[f"{module_name}.{head}.{name}"] = head_tensor
+
+    new_model.load_state_dict(old_state_dict)
+    with torch.no_grad():
+        torch.testing.assert_close(new_model(*inputs), model(*inputs))
+
+
+def make_head_list_checkpoint(path):
+    """Checkpoint of a Roost with lists of WeightedAttentionPooling heads as saved
+    before the heads were batched, incl. the AdamW state of all its parameters.
+    """
+    task_dict = {"y": "regression"}
+    model = Roost(
+        robust=False,
+        n_targets=[1],
+        elem_emb_len=16,
+        elem_embedding="megnet16",
+        task_dict=task_dict,
+    )
+    old_model = Roost(**model.model_params)
+    for name, module in list(old_model.named_modules()):
+        if not isinstance(module, MultiHeadAttentionPooling):
+            continue
+        gate_fcs, msg_fcs = module.gate_nn.fcs, module.message_nn.fcs
+        heads = torch.nn.ModuleList(
+            WeightedAttentionPooling(
+                gate_nn=SimpleNetwork(
+                    gate_fcs[0].in_features, 1, [fc.out_features for fc in gate_fcs]
+                ),
+                message_nn=SimpleNetwork(
+                    msg_fcs[0].in_features,
+                    module.message_nn.fc_out.out_features,
+                    [fc.out_features for fc in msg_fcs],
+                ),
+            )
+            for _ in range(module.num_heads)
+        )
+        parent_name, _, attr = name.rpartition(".")
+        setattr(old_model.get_submodule(parent_name), attr, heads)
+
+    optimizer = torch.optim.AdamW(old_model.parameters())
+    for param in old_model.parameters():
+        optimizer.state[param] = {
+            "step": torch.tensor(3.0),
+            "exp_avg": torch.randn_like(param),
+            "exp_avg_sq": torch.rand_like(param),
+        }
+    checkpoint = {
+        "model_params": model.model_params,
+        "state_dict": old_model.state_dict(),
+        "epoch": 3,
+        "best_val_score": {"y": 0.5},
+        "optimizer": optimizer.state_dict(),
+        "scheduler": MultiStepLR(optimizer, milestones=[]).state_dict(),
+    }
+    torch.save(checkpoint, path)
+    return old_model, optimizer
+
+
+def test_resume_and_transfer_from_head_list_checkpoint(tmp_path):
+    path = f"{tmp_path}/checkpoint.pth.tar"
+    old_model, old_optimizer = make_head_list_checkpoint(path)
+    old_params = dict(old_model.named_parameters())
+    pool_name = "material_nn.cry_pool"
+    old_heads = [old_params[f"{pool_name}.{head}.pow"] for head in range(3)]
+
+    model_params = old_model.model_params
+    model = initialize_model(Roost, model_params, device="cpu", resume=path)
+    optimizer, _ = initialize_optim(
+        model, "AdamW", 1e-3, 1e-6, 0.9, device="cpu", resume=path
+    )
+    pow_param = model.get_parameter(f"{pool_name}.pow")
+    torch.testing.assert_close(pow_param, torch.stack(old_heads).detach())
+    # Adam moments of the heads are stacked like their parameters
+    assert len(optimizer.state) == len(list(model.parameters()))
+    torch.testing.assert_close(
+        optimizer.state[pow_param]["exp_avg"],
+        torch.stack([old_optimizer.state[head]["exp_avg"] for head in old_heads]),
+    )
+    assert float(optimizer.state[pow_param]["step"]) == 3
+
+    # transfer keeps the material_nn incl. its stacked heads
+    transferred = initialize_model(Roost, model.model_params, device="cpu", transfer=path)
+    for name, param in model.named_parameters():
+        if name.startswith("material_nn."):
+            torch.testing.assert_close(transferred.get_parameter(name), param, msg=name)
+
+    # the converted optimizer state can be stepped with
+    sum(param.square().sum() for param in model.parameters()).backward()
+    optimizer.step()
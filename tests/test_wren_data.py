@@ -0,0 +1,148 @@
+import pandas as pd
+import pytest
+import torch
+
+from aviary.wren.data import (
+    WyckoffData,
+    collate_batch,
+    parse_protostructure_label,
+    parse_protostructure_labels,
+)
+from aviary.wren.model import Wren
+from aviary.wren.utils import relab_dict, relab_tables
+
+LABELS = [
+    "A20BC14D8E5F2_oP800_61_40c_2c_28c_16c_10c_4c:C-Cd-H-N-O-S",
+    "ABC6D2_mC40_15_e_e_3f_f:Ca-Fe-O-Si",
+    "A6B11CD7_aP50_2_6i_ac10i_i_7i:C-H-N-O",
+    "AB_cF8_225_a_b:Cl-Na",
+    "ABC3_cP5_221_a_b_c:Ba-O-Ti",
+]
+
+
+def test_relab_tables():
+    assert relab_tables.keys() == relab_dict.keys()
+    for spg_num, relabelings in relab_dict.items():
+        assert relab_tables[spg_num] == [str.maketrans(trans) for trans in relabelings]
+
+
+@pytest.mark.parametrize("label", LABELS)
+def test_parse_protostructure_label(label):
+    spg_num, multiplicities, elements, augmented_wyks = parse_protostructure_label(label)
+    _, _, expected_spg, *_ = label.split(":")[0].split("_")
+    assert spg_num == expected_spg
+    assert len(multiplicities) == len(elements)
+    assert set(elements) == set(label.split(":")[1].split("-"))
+
+    # equivalent Wyckoff sets are the unique relabelings of the first one
+    wyckoff_str = ",".join(augmented_wyks[0])
+    expected = {
+        tuple(wyckoff_str.translate(str.maketrans(trans)).split(","))
+        for trans in relab_dict[spg_num]
+    }
+    assert set(augmented_wyks) == expected
+    assert len(augmented_wyks) == len(expected)
+
+
+def test_parse_protostructure_label_values():
+    assert parse_protostructure_label("ABC3_cP5_221_a_b_c:Ba-O-Ti") == (
+        "221",
+        (1.0, 1.0, 3.0),
+        ("Ba", "O", "Ti"),
+        (("a", "b", "c"), ("b", "a", "d")),
+    )
+
+    with pytest.raises(ValueError, match="does not match Wyckoff letters"):
+        parse_protostructure_label("AB_cF8_225_a_b:Na")
+
+
+def test_parse_protostructure_labels():
+    parse_protostructure_label.cache_clear()
+    labels = [LABELS[1], LABELS[3], LABELS[1], LABELS[1], LABELS[3]]
+
+    parsed = parse_protostructure_labels(labels)
+    assert parsed == [parse_protostructure_label(label) for label in labels]
+    # each unique label is parsed once, later lookups hit the cache
+    cache_info = parse_protostructure_label.cache_info()
+    assert cache_info.misses == 2
+    assert cache_info.hits == len(labels)
+
+
+def test_wyckoff_data_collate_edges():
+    df = pd.DataFrame({"material_id": LABELS[1:], "wyckoff": LABELS[1:]})
+    df["composition"] = df["wyckoff"]
+    df["y"] = range(len(df))
+    dataset = WyckoffData(df, {"y": "regression"})
+    lean_dataset = WyckoffData(df, {"y": "regression"}, collate_edges=True)
+    assert len(dataset[0][0]) == 5
+    assert len(lean_dataset[0][0]) == 3
+
+    inputs, *_ = collate_batch([dataset[idx] for idx in range(len(df))])
+    lean_inputs, *_ = collate_batch([lean_dataset[idx] for idx in range(len(df))])
+    for tensor, lean_tensor in zip(inputs, lean_inputs):
+        assert torch.equal(tensor, lean_tensor)
+
+
+def test_wyckoff_data_get_batch():
+    df = pd.DataFrame({"material_id": LABELS[1:], "wyckoff": LABELS[1:]})
+    df["composition"] = df["wyckoff"]
+    df["y"] = range(len(df))
+    dataset = WyckoffData(df, {"y": "regression"})
+    rows = [3, 1, -4, 2]
+    inputs, targets, *ids = dataset.get_batch(rows)
+    ref_inputs, ref_targets, *ref_ids = collate_batch([dataset[row] for row in rows])
+    for tensor, ref_tensor in zip((*inputs, *targets), (*ref_inputs, *ref_targets)):
+        assert tensor.dtype == ref_tensor.dtype
+        assert torch.equal(tensor, ref_tensor)
+    assert ids == ref_ids
+
+
+def test_wyckoff_data_graph_sizes():
+    df = pd.DataFrame({"material_id": LABELS, "wyckoff": LABELS})
+    df["composition"] = df["wyckoff"]
+    df["y"] = range(len(df))
+    dataset = WyckoffData(df, {"y": "regression"})
+    n_nodes, n_edges = dataset.graph_sizes()
+    for idx in range(len(df)):
+        _, _, sym_fea, self_idx, _ = dataset[idx][0]
+        assert n_nodes[idx] == len(sym_fea)
+        assert n_edges[idx] == len(self_idx)
+
+
+def test_collate_batch_unique_wyckoff_positions():
+    df = pd.DataFrame({"material_id": LABELS, "wyckoff": LABELS})
+    df["composition"] = df["wyckoff"]
+    df["y"] = range(len(df))
+    dataset = WyckoffData(df, {"y": "regression"})
+    inputs, *_ = collate_batch([dataset[idx] for idx in range(len(df))])
+    weights, elem_fea, sym_fea, *_, aug_cry_idx, aug_gather_idx, aug_cry_ptr = inputs
+
+    # weights and elements are only held once per unique Wyckoff position
+    assert (
+        len(weights)
+        == len(elem_fea)
+        == sum(len(dataset[idx][0][0]) for idx in range(len(df)))
+    )
+    assert len(aug_gather_idx) == len(sym_fea) > len(weights)
+    assert torch.equal(aug_cry_ptr.diff(), torch.bincount(aug_cry_idx))
+
+    # model outputs match expanding weights and elements before embedding them
+    torch.manual_seed(0)
+    model = Wren(
+        robust=False,
+        n_targets=[1],
+        elem_emb_len=dataset.elem_emb_len,
+        sym_emb_len=dataset.sym_emb_len,
+        elem_embedding=dataset.elem_embedding,
+        task_dict={"y": "regression"},
+    )
+    expanded = (
+        weights[aug_gather_idx],
+        elem_fea[aug_gather_idx],
+        *inputs[2:-2],
+        None,
+        aug_cry_ptr,
+    )
+    (out,) = model(*inputs)
+    (ref_out,) = model(*expanded)
+    assert torch.allclose(out, ref_out, atol=1e-5)
@@ -149,3 +149,79 @@ def test_wren_regression(df_matbench_phonons_wyckoff):
     assert r2 > 0.7
     assert mae < 150
     assert rmse < 300
+
+
+def test_wren_regression_in_memory(df_matbench_phonons_wyckoff):
+    target_name = "last phdos peak"
+    task_dict = {target_name: "regression"}
+    model_name = "wren-reg-in-memory-test"
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    dataset = WyckoffData(df=df_matbench_phonons_wyckoff, task_dict=task_dict)
+    train_idx, test_idx = split(range(len(dataset)), random_state=42, test_size=0.2)
+    train_set = torch.utils.data.Subset(dataset, train_idx)
+    test_set = torch.utils.data.Subset(dataset, test_idx)
+
+    data_params = {
+        "batch_size": 128,
+        "num_workers": 0,
+        "pin_memory": False,
+        "shuffle": True,
+        "collate_fn": collate_batch,
+    }
+    model_params = {
+        "task_dict": task_dict,
+        "robust": True,
+        "n_targets": dataset.n_targets,
+        "elem_emb_len": dataset.elem_emb_len,
+        "sym_emb_len": dataset.sym_emb_len,
+        "elem_fea_len": 32,
+        "sym_fea_len": 32,
+        "n_graph": 1,
+    }
+
+    train_ensemble(
+        model_class=Wren,
+        model_name=model_name,
+        run_id=1,
+        ensemble_folds=1,
+        epochs=2,
+        train_set=train_set,
+        val_set=test_set,
+        log=False,
+        data_params=data_params,
+        setup_params={
+            "optim": "AdamW",
+            "learning_rate": 3e-4,
+            "weight_decay": 1e-6,
+            "momentum": 0.9,
+            "device": device,
+        },
+        restart_params={"resume": False, "fine_tune": None, "transfer": None},
+        model_params=model_params,
+        loss_dict={target_name: "L1"},
+        in_memory=True,
+    )
+
+    data_params["shuffle"] = False
+    preds = {}
+    for in_memory in (False, True):
+        results_dict = results_multitask(
+            model_class=Wren,
+            model_name=model_name,
+            run_id=1,
+            ensemble_folds=1,
+            test_set=test_set,
+            data_params=data_params,
+            robust=True,
+            task_dict=task_dict,
+            device=device,
+            eval_type="checkpoint",
+            save_results=False,
+            in_memory=in_memory,
+        )
+        preds[in_memory] = results_dict[target_name]["preds"]
+        assert len(results_dict[target_name]["targets"]) == len(test_set)
+
+    # InMemoryDataLoader gathers the same batches as the collate_fn DataLoader
+    np.testing.assert_allclose(preds[True], preds[False], rtol=1e-5, atol=1e-5)
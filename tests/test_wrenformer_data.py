@@ -0,0 +1,243 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from aviary.wrenformer.data import (
+    LengthBucketSampler,
+    PackedSequences,
+    WrenformerStreamData,
+    collate_batch,
+    collate_samples,
+    df_to_in_mem_dataloader,
+    padding_efficiency,
+    sequence_lengths,
+)
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+LABELS = [
+    "ABC6D2_mC40_15_e_e_3f_f:Ca-Fe-O-Si",
+    "AB_cF8_225_a_b:Cl-Na",
+    "ABC3_cP5_221_a_b_c:Ba-O-Ti",
+    "AB_cF8_225_a_b:Cl-Na",
+    "A6B11CD7_aP50_2_6i_ac10i_i_7i:C-H-N-O",
+]
+
+
+@pytest.mark.parametrize(
+    "embedding_type, inputs",
+    [
+        ("wyckoff", LABELS),
+        ("composition", ["Fe2O3", "NaCl", "SrTiO3", "NaCl", "Li3Fe2(PO4)3"]),
+    ],
+)
+def test_packed_dataloader(embedding_type, inputs):
+    df = pd.DataFrame({"inputs": inputs, "y": np.arange(len(inputs), dtype=float)})
+    kwargs = dict(
+        input_col="inputs",
+        target_col="y",
+        embedding_type=embedding_type,
+        device="cpu",
+        batch_size=3,
+        shuffle=True,
+    )
+    np.random.seed(0)
+    batches = list(df_to_in_mem_dataloader(df, packed=False, **kwargs))
+    np.random.seed(0)
+    packed_loader = df_to_in_mem_dataloader(df, **kwargs)
+    packed_batches = list(packed_loader)
+
+    assert isinstance(packed_loader.tensors[0], PackedSequences)
+    # duplicate inputs share their tokens
+    packed = packed_loader.tensors[0]
+    assert packed.row_start[1] == packed.row_start[3]
+
+    assert len(batches) == len(packed_batches) == 2
+    for (inputs, targets, ids), (packed_inputs, packed_targets, packed_ids) in zip(
+        batches, packed_batches
+    ):
+        assert len(inputs) == len(packed_inputs) == 2 + (embedding_type == "wyckoff")
+        assert torch.equal(inputs[0], packed_inputs[0])
+        assert torch.equal(inputs[1], packed_inputs[1])
+        if embedding_type == "wyckoff":
+            assert list(inputs[2]) == packed_inputs[2]
+        assert torch.equal(targets, packed_targets)
+        assert list(ids) == list(packed_ids)
+
+
+def test_packed_sequences_indexing():
+    tensors = [torch.ones(2, 3, 4), torch.full((1, 1, 4), 2.0), torch.ones(3, 2, 4)]
+    packed = PackedSequences.from_tensors(tensors)
+    assert len(packed) == 3
+    assert packed.features.shape == (6 + 1 + 6, 4)
+
+    for idx in (1, -1, np.int64(0), slice(1, None), np.array([2, 0])):
+        rows = packed[idx]
+        expected = [tensors[i] for i in np.atleast_1d(np.arange(3)[idx])]
+        (padded, mask, counts), *_ = collate_batch(rows, torch.zeros(len(rows)), [])
+        assert counts == [len(t) for t in expected]
+        assert padded.shape[0] == sum(counts)
+        assert (~mask).sum(dim=1).tolist() == [
+            t.shape[1] for t in expected for _ in range(len(t))
+        ]
+        assert torch.equal(padded[mask], torch.zeros(int(mask.sum()), 4))
+    assert packed.n_features == 4
+
+
+def test_padding_efficiency():
+    seq_len, n_equiv = np.array([2, 4, 4]), np.array([3, 1, 2])
+    # 6 + 4 real tokens padded to 4 tokens in each of 3 + 1 sequences
+    assert padding_efficiency(seq_len, n_equiv, [[0, 1]]) == 10 / 16
+    assert padding_efficiency(seq_len, n_equiv, [[0], [1, 2]]) == 1
+    assert padding_efficiency(seq_len, n_equiv, []) == 1
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_length_bucket_sampler(drop_last):
+    rng = np.random.default_rng(0)
+    seq_len, n_equiv = rng.integers(1, 30, 1000), rng.integers(1, 5, 1000)
+    sampler = LengthBucketSampler(
+        seq_len, n_equiv, batch_size=32, pool_size=4, drop_last=drop_last, seed=0
+    )
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 31 + (not drop_last)
+    rows = [row for batch in batches for row in batch]
+    assert len(rows) == len(set(rows)) == (992 if drop_last else 1000)
+    assert sorted(map(len, batches)) == [8] * (not drop_last) + [32] * 31
+
+    # batches change every epoch and pad much less than random batches
+    assert sorted(map(tuple, list(sampler))) != sorted(map(tuple, batches))
+    sampler.set_epoch(0)  # epochs are reproducible from the seed
+    assert list(sampler) == batches
+    random_batches = np.array_split(rng.permutation(1000), 32)
+    random_eff = padding_efficiency(seq_len, n_equiv, random_batches)
+    assert sampler.padding_efficiency() > 0.75 > 0.6 > random_eff
+
+    # without shuffling, rows are sorted by length into the most compact batches
+    sorted_batches = list(LengthBucketSampler(seq_len, n_equiv, 32, shuffle=False))
+    assert np.all(np.diff(seq_len[np.concatenate(sorted_batches)]) >= 0)
+
+
+@pytest.mark.parametrize("seed", [None, 3])
+def test_length_bucket_sampler_padding_efficiency_keeps_rng(seed):
+    seq_len = np.random.default_rng(0).integers(1, 30, 200)
+    sampler, ref_sampler = (
+        LengthBucketSampler(seq_len, batch_size=16, seed=seed) for _ in range(2)
+    )
+    np.random.seed(0)
+    assert 0 < sampler.padding_efficiency() <= 1
+    assert sampler.epoch == 0
+    assert sampler.batches is None
+    batches = list(sampler)
+    np.random.seed(0)
+    # the first training epoch is the same as without computing the efficiency
+    assert batches == list(ref_sampler)
+
+
+def test_length_bucket_sampler_errors():
+    with pytest.raises(ValueError, match="must have the same length"):
+        LengthBucketSampler([1, 2], [1])
+    with pytest.raises(ValueError, match="must be positive"):
+        LengthBucketSampler([1, 2], batch_size=0)
+
+
+@pytest.mark.parametrize("packed", [True, False])
+def test_bucketed_dataloader(packed):
+    df = pd.DataFrame({"inputs": LABELS * 4, "y": np.arange(4 * len(LABELS))})
+    loader = df_to_in_mem_dataloader(
+        df,
+        input_col="inputs",
+        target_col="y",
+        device="cpu",
+        packed=packed,
+        bucket_by_length=True,
+        batch_size=4,
+        shuffle=True,
+    )
+    assert isinstance(loader.batch_sampler, LengthBucketSampler)
+    assert len(loader) == 5
+
+    seq_len, n_equiv = sequence_lengths(loader.tensors[0])
+    assert seq_len.tolist() == [6, 2, 3, 2, 26] * 4
+    assert n_equiv.tolist() == [1, 2, 2, 2, 8] * 4
+
+    ids = []
+    for (padded, mask, counts), targets, batch_ids in loader:
+        assert padded.shape[:2] == mask.shape
+        # rows of equal length are batched together so nothing is padded
+        assert not mask.any()
+        assert targets.tolist()[0] == list(batch_ids)
+        assert counts == n_equiv[list(batch_ids)].tolist()
+        ids += list(batch_ids)
+    assert sorted(ids) == list(range(len(df)))
+
+
+def test_collate_batch_length_mask():
+    # real tokens whose features are all zero must not be masked
+    features = (torch.zeros(2, 3, 4), torch.ones(1, 1, 4))
+    (padded, mask, counts), *_ = collate_batch(features, torch.zeros(2), [0, 1])
+    assert counts == [2, 1]
+    assert mask.tolist() == [[False] * 3, [False] * 3, [False, True, True]]
+    assert padded.shape == (3, 3, 4)
+
+
+@pytest.mark.parametrize(
+    "embedding_type, inputs",
+    [("wyckoff", LABELS), ("composition", ["Fe2O3", "NaCl", "SrTiO3", "NaCl"])],
+)
+def test_nested_collate_batch(embedding_type, inputs):
+    df = pd.DataFrame({"inputs": inputs, "y": np.arange(len(inputs), dtype=float)})
+    kwargs = dict(
+        input_col="inputs", target_col="y", embedding_type=embedding_type, device="cpu"
+    )
+    batches = {}
+    for packed in (False, True):
+        for nested in (False, True):
+            loader = df_to_in_mem_dataloader(
+                df, packed=packed, nested=nested, batch_size=len(df), **kwargs
+            )
+            batches[packed, nested] = next(iter(loader))
+
+    (padded, mask, *counts), targets, _ = batches[True, False]
+    for packed in (False, True):
+        (nested, seq_lens, *nested_counts), nested_targets, _ = batches[packed, True]
+        assert nested.is_nested
+        assert nested.layout == torch.jagged
+        assert torch.equal(seq_lens, (~mask).sum(dim=1))
+        # jagged values hold exactly the unpadded tokens
+        assert torch.equal(nested.values(), padded[~mask])
+        assert nested_counts == counts
+        assert torch.equal(nested_targets, targets)
+
+
+@pytest.mark.skipif(pa is None, reason="pyarrow not installed")
+@pytest.mark.parametrize("nested", [False, True])
+def test_wrenformer_stream_data(tmp_path, nested):
+    df = pd.DataFrame(
+        {"material_id": [f"mat-{idx}" for idx in range(5)], "wyckoff": LABELS}
+    )
+    df["y"] = np.arange(len(df), dtype=float)
+    df.to_parquet(tmp_path / "shard-0.parquet", row_group_size=2)
+
+    dataset = WrenformerStreamData(tmp_path, target_col="y", id_col="material_id")
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=5, collate_fn=partial(collate_samples, nested=nested)
+    )
+    (features, *rest), targets, ids = next(iter(loader))
+    ref_loader = df_to_in_mem_dataloader(
+        df, target_col="y", id_col="material_id", device="cpu", nested=nested
+    )
+    (ref_features, *ref_rest), ref_targets, ref_ids = next(iter(ref_loader))
+    assert list(ids) == list(ref_ids)
+    assert torch.equal(targets, ref_targets)
+    if nested:
+        features, ref_features = features.values(), ref_features.values()
+    assert torch.equal(features, ref_features)
+    for tensor, ref_tensor in zip(rest, ref_rest):
+        assert torch.equal(torch.as_tensor(tensor), torch.as_tensor(ref_tensor))